@@ -1,22 +1,30 @@
 
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, g, has_request_context, make_response
 import os
 import json
 import datetime
 import base64
 import requests
 import re
-import unicodedata
 import uuid
+import hashlib
+import time
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 from io import BytesIO
+from urllib.parse import urlparse
 from flask import send_file
 import pandas as pd
+import numpy as np
 import ollama
 from functools import wraps
 import markdown
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func, desc, or_, and_
+from sqlalchemy import func, desc, or_, and_, case, select, insert, update, literal, union
+from sqlalchemy.orm import selectinload, contains_eager
 from flask_login import (
     LoginManager,
     UserMixin,
@@ -26,7 +34,7 @@ from flask_login import (
     current_user,
 )
 
-from models import db, Student, Violation, ViolationType, Teacher, SystemConfig, ClassRoom, WeeklyArchive, Subject, Grade, ChatConversation, BonusType, BonusRecord, Notification, GroupChatMessage, PrivateMessage, ChangeLog
+from models import db, Student, Violation, ViolationType, Teacher, SystemConfig, ClassRoom, WeeklyArchive, Subject, Grade, ChatConversation, BonusType, BonusRecord, Notification, GroupChatMessage, PrivateMessage, ChangeLog, SubjectAverage, WeekSnapshot, WeeklyClassStats, ClassAnalysisCache, ScoreLedger, Job, normalize_student_code
 
 
 # === HELPER FUNCTIONS CHO PHÂN QUYỀN ===
@@ -71,6 +79,53 @@ def get_accessible_students():
         return Student.query  # GVBM có thể xem tất cả HS để chấm điểm
     return Student.query.filter(Student.id == -1)  # Empty query
 
+STUDENT_PAGE_SIZE = 50
+
+def filter_students(q, class_name=None, search=None):
+    """Lọc query học sinh theo lớp và từ khóa (tên, mã số hoặc lớp)"""
+    if class_name:
+        q = q.filter(Student.student_class == class_name)
+    if search:
+        q = q.filter(or_(
+            Student.name.ilike(f"%{search}%"),
+            Student.student_code.ilike(f"%{search}%"),
+            Student.student_class.ilike(f"%{search}%")
+        ))
+    return q
+
+def paginate_students(q, after=None, before=None, limit=STUDENT_PAGE_SIZE):
+    """
+    Phân trang keyset theo student_code (không dùng OFFSET nên trang sau cũng nhanh như trang đầu).
+    
+    Args:
+        q: Query Student đã lọc (thường từ get_accessible_students())
+        after (str): Lấy các học sinh có mã > after (trang sau)
+        before (str): Lấy các học sinh có mã < before (trang trước)
+        limit (int): Số học sinh mỗi trang
+    
+    Returns:
+        dict: {'items': List[Student], 'next_cursor': str|None, 'prev_cursor': str|None}
+    """
+    if before:
+        rows = q.filter(Student.student_code < before)\
+            .order_by(Student.student_code.desc()).limit(limit + 1).all()
+        has_prev = len(rows) > limit
+        items = list(reversed(rows[:limit]))
+        has_next = True
+    else:
+        if after:
+            q = q.filter(Student.student_code > after)
+        rows = q.order_by(Student.student_code.asc()).limit(limit + 1).all()
+        has_next = len(rows) > limit
+        items = rows[:limit]
+        has_prev = bool(after)
+    
+    return {
+        'items': items,
+        'next_cursor': items[-1].student_code if items and has_next else None,
+        'prev_cursor': items[0].student_code if items and has_prev else None
+    }
+
 def can_access_student(student_id):
     """Kiểm tra quyền truy cập học sinh cụ thể"""
     if not current_user.is_authenticated:
@@ -119,11 +174,12 @@ def can_access_subject(subject_id):
         return True  # GVCN có thể xem tất cả môn
     return False
 
-def create_notification(title, message, notification_type, target_role='all', specific_recipient_id=None):
+def create_notification(title, message, notification_type, target_role='all', specific_recipient_id=None, commit=True):
     """
     Tạo thông báo mới
     - target_role: 'all', 'homeroom_teacher', 'subject_teacher', hoặc class name (VD: '12 Tin')
     - specific_recipient_id: Gửi cho 1 giáo viên cụ thể
+    - commit=False: chỉ thêm vào session, commit cùng transaction của thao tác ghi dữ liệu
     """
     if specific_recipient_id:
         # Gửi cho 1 người cụ thể
@@ -160,16 +216,19 @@ def create_notification(title, message, notification_type, target_role='all', sp
                 )
                 db.session.add(notif)
     
-    db.session.commit()
+    if commit:
+        db.session.commit()
 
 
-def log_change(change_type, description, student_id=None, student_name=None, student_class=None, old_value=None, new_value=None):
+def log_change(change_type, description, student_id=None, student_name=None, student_class=None, old_value=None, new_value=None, changed_by_id=None):
     """
     Ghi nhận thay đổi CSDL vào bảng ChangeLog.
     Gọi hàm này TRƯỚC db.session.commit() để đảm bảo cùng transaction.
+    changed_by_id: truyền vào khi ghi từ luồng nền (không có current_user).
     """
     try:
-        changed_by_id = current_user.id if current_user.is_authenticated else None
+        if changed_by_id is None:
+            changed_by_id = current_user.id if current_user.is_authenticated else None
         log_entry = ChangeLog(
             changed_by_id=changed_by_id,
             change_type=change_type,
@@ -214,12 +273,119 @@ if not os.path.exists(UPLOAD_FOLDER):
 def load_user(user_id):
     return db.session.get(Teacher, int(user_id))
 
+# === CACHE DỮ LIỆU DANH MỤC ===
+# Tuần hiện tại, danh sách lớp, loại vi phạm, loại điểm cộng, môn học được đọc ở hầu hết mọi trang
+# nhưng rất ít khi thay đổi -> giữ trong bộ nhớ tiến trình. Để đúng khi chạy nhiều worker, mỗi request
+# đọc 1 "version stamp" trong SystemConfig (1 truy vấn, lưu trong g); version khác thì bỏ cache.
+# Mọi thao tác ghi dữ liệu danh mục phải gọi invalidate_reference_cache() trước commit.
+
+REF_CACHE_VERSION_KEY = "ref_cache_version"
+_ref_cache = {'version': None, 'data': {}}
+_ref_cache_lock = threading.Lock()
+
+def get_cache_stamp(key):
+    """Đọc version stamp `key` trong SystemConfig (chỉ 1 lần cho mỗi request)"""
+    return get_cache_stamps(key)[0]
+
+def get_cache_stamps(*keys):
+    """Đọc nhiều version stamp cùng lúc (1 truy vấn IN cho các key chưa đọc trong request này)"""
+    stamps = g.setdefault('cache_stamps', {}) if has_request_context() else {}
+    missing = [key for key in keys if key not in stamps]
+    if missing:
+        found = dict(db.session.query(SystemConfig.key, SystemConfig.value).filter(SystemConfig.key.in_(missing)).all())
+        for key in missing:
+            stamps[key] = found.get(key, "")
+    return tuple(stamps[key] for key in keys)
+
+def bump_cache_stamps(keys):
+    """
+    Ghi version stamp mới cho các key để mọi tiến trình bỏ cache tương ứng.
+    Gọi TRƯỚC db.session.commit() để stamp mới được ghi cùng transaction với dữ liệu.
+    """
+    keys = set(keys)
+    if not keys:
+        return
+    existing = {c.key: c for c in SystemConfig.query.filter(SystemConfig.key.in_(keys)).all()}
+    now = datetime.datetime.utcnow()
+    for key in keys:
+        cfg = existing.get(key)
+        if not cfg:
+            cfg = SystemConfig(key=key, value="")
+            db.session.add(cfg)
+        cfg.value = uuid.uuid4().hex
+        cfg.last_updated = now
+    if has_request_context():
+        stamps = g.get('cache_stamps', {})
+        for key in keys:
+            stamps.pop(key, None)
+
+def get_reference_data(name, loader):
+    """Lấy dữ liệu danh mục từ cache tiến trình, gọi loader() nếu chưa có hoặc đã cũ"""
+    version = get_cache_stamp(REF_CACHE_VERSION_KEY)
+    with _ref_cache_lock:
+        if _ref_cache['version'] != version:
+            _ref_cache['version'] = version
+            _ref_cache['data'] = {}
+        if name in _ref_cache['data']:
+            return _ref_cache['data'][name]
+    
+    value = loader()
+    with _ref_cache_lock:
+        if _ref_cache['version'] == version:
+            _ref_cache['data'][name] = value
+    return value
+
+def invalidate_reference_cache():
+    """
+    Đổi version stamp để mọi tiến trình bỏ cache danh mục.
+    Gọi TRƯỚC db.session.commit() để version mới được ghi cùng transaction với dữ liệu.
+    """
+    bump_cache_stamps([REF_CACHE_VERSION_KEY])
+    with _ref_cache_lock:
+        _ref_cache['version'] = None
+        _ref_cache['data'] = {}
+
+def _snapshot(rows, *fields):
+    """Chuyển danh sách ORM object thành dữ liệu thuần (an toàn khi dùng chung giữa các request)"""
+    return [SimpleNamespace(**{f: getattr(r, f) for f in fields}) for r in rows]
+
+def get_current_week():
+    """Tuần hiện tại của hệ thống"""
+    def load():
+        cfg = SystemConfig.query.filter_by(key="current_week").first()
+        return int(cfg.value) if cfg else 1
+    return get_reference_data('current_week', load)
+
+def get_class_list():
+    """Danh sách lớp (id, name) sắp xếp theo tên"""
+    return get_reference_data('classes', lambda: _snapshot(
+        ClassRoom.query.order_by(ClassRoom.name).all(), 'id', 'name'))
+
+def get_class_names():
+    """Danh sách tên lớp sắp xếp theo tên"""
+    return [c.name for c in get_class_list()]
+
+def get_violation_types():
+    """Danh mục lỗi vi phạm"""
+    return get_reference_data('violation_types', lambda: _snapshot(
+        ViolationType.query.order_by(ViolationType.id).all(), 'id', 'name', 'points_deducted'))
+
+def get_bonus_types():
+    """Danh mục điểm cộng (điểm cao trước)"""
+    return get_reference_data('bonus_types', lambda: _snapshot(
+        BonusType.query.order_by(BonusType.points_added.desc()).all(), 'id', 'name', 'points_added', 'description'))
+
+def get_subjects():
+    """Danh sách môn học sắp xếp theo tên"""
+    return get_reference_data('subjects', lambda: _snapshot(
+        Subject.query.order_by(Subject.name).all(),
+        'id', 'name', 'code', 'description', 'num_tx_columns', 'num_gk_columns', 'num_hk_columns'))
+
 @app.context_processor
 def inject_global_data():
     try:
-        week_cfg = SystemConfig.query.filter_by(key="current_week").first()
-        current_week = int(week_cfg.value) if week_cfg else 1
-        classes = [c.name for c in ClassRoom.query.order_by(ClassRoom.name).all()]
+        current_week = get_current_week()
+        classes = get_class_names()
     except:
         current_week = 1
         classes = []
@@ -243,47 +409,6 @@ def markdown_filter(text):
     return markdown.markdown(text, extensions=['fenced_code', 'tables'])
 
 
-def normalize_student_code(code):
-    """
-    Chuẩn hóa mã học sinh để tăng khả năng matching khi OCR đọc sai format
-    
-    Xử lý:
-    - Bỏ dấu tiếng Việt (TOÁN → TOAN, Đạt → DAT)
-    - Uppercase toàn bộ
-    - Chuẩn hóa khoảng trắng (nhiều space → 1 space, trim đầu cuối)
-    - Giữ nguyên dấu gạch ngang (-)
-    
-    Examples:
-        "34 TOÁN - 001035" → "34 TOAN - 001035"
-        "12  tin-001" → "12 TIN-001"
-        "11a1  -  005" → "11A1 - 005"
-        "Nguyễn Văn A" → "NGUYEN VAN A"
-    
-    Args:
-        code (str): Mã học sinh cần chuẩn hóa
-    
-    Returns:
-        str: Mã đã chuẩn hóa
-    """
-    if not code:
-        return ""
-    
-    # 1. Bỏ dấu tiếng Việt bằng unicodedata
-    code = unicodedata.normalize('NFD', str(code))
-    code = ''.join(char for char in code if unicodedata.category(char) != 'Mn')
-    
-    # 2. Uppercase
-    code = code.upper()
-    
-    # 3. Chuẩn hóa khoảng trắng: nhiều space → 1 space
-    code = re.sub(r'\s+', ' ', code)
-    
-    # 4. Trim đầu cuối
-    code = code.strip()
-    
-    return code
-
-
 def get_current_iso_week():
     today = datetime.datetime.now()
     iso_year, iso_week, _ = today.isocalendar()
@@ -293,38 +418,278 @@ def format_date_vn(date_obj):
     return date_obj.strftime('%d/%m')
 
 def save_weekly_archive(week_num):
-    try:
-        WeeklyArchive.query.filter_by(week_number=week_num).delete()
-        students = Student.query.all()
-        for s in students:
-            deductions = db.session.query(func.sum(Violation.points_deducted))\
-                .filter(Violation.student_id == s.id, Violation.week_number == week_num)\
-                .scalar() or 0
-            archive = WeeklyArchive(
-                week_number=week_num, student_id=s.id, student_name=s.name,
-                student_code=s.student_code, student_class=s.student_class,
-                final_score=s.current_score, total_deductions=deductions
-            )
-            db.session.add(archive)
-        db.session.commit()
-        return True
-    except Exception as e:
-        print(f"Archive Error: {e}")
-        db.session.rollback()
-        return False
+    """
+    Lưu điểm cuối tuần của toàn bộ học sinh vào WeeklyArchive bằng 1 lệnh INSERT ... SELECT
+    (tổng điểm trừ / điểm cộng trong tuần gom bằng GROUP BY student_id).
+    Không commit - gọi trong transaction của reset_week để lưu trữ và reset điểm cùng thành công / thất bại.
+    
+    Returns:
+        dict: {'rows': số dòng lưu trữ, 'replaced': số dòng cũ của tuần bị thay, 'seconds': thời gian chạy}
+    """
+    started = time.perf_counter()
+    replaced = WeeklyArchive.query.filter_by(week_number=week_num).delete(synchronize_session=False)
+    
+    deduct = db.session.query(Violation.student_id, func.sum(Violation.points_deducted).label('total'))\
+        .filter(Violation.week_number == week_num).group_by(Violation.student_id).subquery()
+    bonus = db.session.query(BonusRecord.student_id, func.sum(BonusRecord.points_added).label('total'))\
+        .filter(BonusRecord.week_number == week_num).group_by(BonusRecord.student_id).subquery()
+    source = select(
+        literal(week_num), Student.id, Student.name, Student.student_code, Student.student_class,
+        Student.current_score, func.coalesce(deduct.c.total, 0), func.coalesce(bonus.c.total, 0),
+        literal(datetime.datetime.utcnow())
+    ).outerjoin(deduct, deduct.c.student_id == Student.id)\
+        .outerjoin(bonus, bonus.c.student_id == Student.id)
+    result = db.session.execute(insert(WeeklyArchive).from_select([
+        'week_number', 'student_id', 'student_name', 'student_code', 'student_class',
+        'final_score', 'total_deductions', 'total_bonuses', 'created_at'
+    ], source))
+    
+    return {'rows': result.rowcount, 'replaced': replaced, 'seconds': round(time.perf_counter() - started, 3)}
+
+# === SỔ ĐIỂM NỀ NẾP (ScoreLedger) ===
+# Mọi thay đổi điểm nề nếp được ghi thêm 1 dòng kèm điểm lũy kế của học sinh trong tuần (đầu tuần = 100).
+# Điểm hiện tại = dòng cuối của tuần đang mở, biểu đồ trong tuần = các dòng của (học sinh, tuần),
+# "điểm tại thời điểm" = dòng cuối trước thời điểm đó - đều là 1 lần đọc theo chỉ mục.
+# Student.current_score chỉ là bản sao dòng cuối của tuần đang mở, luôn ghi cùng transaction với sổ.
+# Học sinh chưa có dòng nào trong tuần đang mở (CSDL nâng cấp chưa chạy rebuild_score_ledger.py) lấy
+# current_score làm điểm đầu thay vì 100 - không ghi đè điểm đã có.
+
+SCORE_BASE = 100
+
+def ledger_totals_subquery(week_number, student_ids=None):
+    """Subquery (student_id, running_total) - dòng cuối trong sổ của từng học sinh trong tuần"""
+    last = db.session.query(ScoreLedger.student_id, func.max(ScoreLedger.id).label('last_id'))\
+        .filter(ScoreLedger.week_number == week_number)
+    if student_ids is not None:
+        last = last.filter(ScoreLedger.student_id.in_(student_ids))
+    last = last.group_by(ScoreLedger.student_id).subquery()
+    return db.session.query(ScoreLedger.student_id, ScoreLedger.running_total)\
+        .join(last, ScoreLedger.id == last.c.last_id).subquery()
+
+def load_running_totals(student_ids, week_number, totals=None):
+    """
+    Nạp điểm lũy kế trong tuần của nhiều học sinh bằng 1 truy vấn.
+    Chưa có dòng nào: tuần đang mở -> current_score, tuần khác -> 100.
+    
+    Returns:
+        dict: {(student_id, week_number): điểm lũy kế} - truyền tiếp cho record_score_event
+    """
+    totals = {} if totals is None else totals
+    missing = {sid for sid in student_ids if (sid, week_number) not in totals}
+    if missing:
+        sub = ledger_totals_subquery(week_number, missing)
+        found = dict(db.session.query(sub.c.student_id, sub.c.running_total).all())
+        unseeded = missing - set(found)
+        if unseeded and week_number == get_current_week():
+            found.update(db.session.query(Student.id, func.coalesce(Student.current_score, SCORE_BASE))
+                         .filter(Student.id.in_(unseeded)).all())
+        for sid in missing:
+            totals[(sid, week_number)] = found.get(sid, SCORE_BASE)
+    return totals
+
+def record_score_event(student, delta, event_type, week_number=None, note=None, totals=None):
+    """
+    Ghi 1 sự kiện điểm nề nếp vào sổ và trả về (điểm trước, điểm sau) trong tuần của sự kiện.
+    totals: dict dùng chung khi ghi nhiều sự kiện trong 1 lượt (xem load_running_totals).
+    current_score chỉ đổi khi sự kiện thuộc tuần đang mở. Không commit.
+    """
+    current_week = get_current_week()
+    week_number = current_week if week_number is None else week_number
+    totals = load_running_totals([student.id], week_number, totals)
+    old = totals[(student.id, week_number)]
+    new = old + delta
+    totals[(student.id, week_number)] = new
+    db.session.add(ScoreLedger(student_id=student.id, week_number=week_number, event_type=event_type,
+                               delta=delta, running_total=new, note=note[:200] if note else None))
+    if week_number == current_week:
+        student.current_score = new
+    return old, new
+
+def get_score_as_of(student_id, when):
+    """Điểm nề nếp của học sinh tại thời điểm `when` (dòng cuối trong sổ trước đó), None nếu chưa có dữ liệu"""
+    return ScoreLedger.query.filter(ScoreLedger.student_id == student_id, ScoreLedger.created_at <= when)\
+        .order_by(ScoreLedger.created_at.desc(), ScoreLedger.id.desc()).first()
+
+def sync_current_scores(week_number, student_ids=None, fallback=None):
+    """
+    Chép dòng cuối trong sổ của tuần vào current_score - 1 lệnh UPDATE cho mọi học sinh hoặc các học sinh
+    `student_ids`. Chưa có dòng nào: giữ nguyên current_score (fallback=None) hoặc đặt bằng `fallback`. Không commit.
+    """
+    ledger = ledger_totals_subquery(week_number, student_ids)
+    total = select(ledger.c.running_total).where(ledger.c.student_id == Student.id).scalar_subquery()
+    missing = Student.current_score if fallback is None else fallback
+    stmt = update(Student).values(current_score=func.coalesce(total, missing, SCORE_BASE))
+    if student_ids is not None:
+        stmt = stmt.where(Student.id.in_(student_ids))
+    db.session.execute(stmt.execution_options(synchronize_session=False))
+
+# === TỔNG HỢP NỀ NẾP THEO LỚP / TUẦN (WeeklyClassStats) ===
+# Mỗi (tuần, lớp) 1 dòng + 1 dòng toàn trường (class_name = ''). Tuần đã kết thúc lấy điểm từ WeeklyArchive
+# (ghi khi reset_week), tuần đang mở lấy current_score. Mỗi lần ghi vi phạm / điểm cộng chỉ tính lại dòng của
+# các lớp bị ảnh hưởng, dòng toàn trường được cộng dồn từ các dòng lớp (không quét lại cả trường).
+# Tuần đã kết thúc được "đóng băng" khi reset_week (cùng WeeklyArchive): sửa vi phạm của tuần cũ chỉ ghi vào
+# sổ điểm, không cập nhật lưu trữ / tổng hợp - chạy rebuild_weekly_class_stats.py nếu cần tính lại.
+# Phân tích xu hướng nhiều tuần chỉ cần 1 truy vấn theo chỉ mục (class_name, week_number).
+
+def compute_weekly_class_stats(week_number, class_names=None, from_archive=None):
+    """
+    Tính các dòng WeeklyClassStats của 1 tuần cho các lớp `class_names` (chỉ các lớp này) hoặc
+    mọi lớp + dòng toàn trường (class_names=None), chưa thêm vào session.
+    from_archive=None: tự xác định (tuần < tuần hiện tại -> đọc WeeklyArchive).
+    
+    Returns:
+        List[WeeklyClassStats] hoặc None nếu không có gì để tính (tuần chưa được lưu trữ)
+    """
+    if from_archive is None:
+        from_archive = week_number < get_current_week()
+    if class_names is not None:
+        class_names = {c for c in class_names if c}
+        if not class_names:
+            return None
+    
+    if from_archive:
+        class_col, score = WeeklyArchive.student_class, func.coalesce(WeeklyArchive.final_score, 100)
+        base_filter = [WeeklyArchive.week_number == week_number]
+    else:
+        class_col, score = Student.student_class, func.coalesce(Student.current_score, 100)
+        base_filter = []
+    score_cols = [
+        func.count(),
+        func.avg(score),
+        func.sum(case((score >= 90, 1), else_=0)),
+        func.sum(case((and_(score >= 70, score < 90), 1), else_=0)),
+        func.sum(case((score < 70, 1), else_=0))
+    ]
+    
+    # 1. Điểm & xếp loại: GROUP BY lớp + 1 dòng toàn trường
+    q = db.session.query(class_col, *score_cols).filter(*base_filter)
+    if class_names is not None:
+        q = q.filter(class_col.in_(class_names))
+    stats = {row[0]: row[1:] for row in q.group_by(class_col).all()}
+    if class_names is None:
+        stats[''] = db.session.query(*score_cols).filter(*base_filter).one()
+    if from_archive and not any(row[0] for row in stats.values()):
+        return None  # Tuần chưa được lưu trữ
+    
+    # 2. Điểm trừ & số lượt từng loại lỗi: GROUP BY lớp, loại lỗi
+    vq = db.session.query(Student.student_class, Violation.violation_type_name,
+                          func.count(Violation.id), func.sum(Violation.points_deducted))\
+        .join(Student, Violation.student_id == Student.id)\
+        .filter(Violation.week_number == week_number)\
+        .group_by(Student.student_class, Violation.violation_type_name)
+    if class_names is not None:
+        vq = vq.filter(Student.student_class.in_(class_names))
+    type_counts, deductions = {}, {}
+    for class_name, type_name, count, points in vq.all():
+        for key in (('', class_name) if class_names is None else (class_name,)):
+            counts = type_counts.setdefault(key, {})
+            counts[type_name] = counts.get(type_name, 0) + count
+            deductions[key] = deductions.get(key, 0) + (points or 0)
+    
+    keys = set(stats) if class_names is None else class_names
+    rows = []
+    for key in keys:
+        count, avg, good, fair, weak = stats.get(key, (0, None, 0, 0, 0))
+        # Lưu đủ mọi loại lỗi (sắp xếp giảm dần) để dòng toàn trường cộng dồn được từ các dòng lớp
+        top = sorted(type_counts.get(key, {}).items(), key=lambda x: x[1], reverse=True)
+        rows.append(WeeklyClassStats(
+            week_number=week_number, class_name=key, student_count=count or 0,
+            avg_score=round(float(avg), 2) if avg is not None else 0,
+            count_good=int(good or 0), count_fair=int(fair or 0), count_weak=int(weak or 0),
+            total_deductions=int(deductions.get(key, 0)),
+            top_violations=json.dumps(top, ensure_ascii=False)
+        ))
+    return rows
+
+def refresh_school_stats(week_number):
+    """Dựng lại dòng toàn trường của 1 tuần bằng cách cộng dồn các dòng lớp đã tổng hợp. Không commit."""
+    class_rows = WeeklyClassStats.query.filter(WeeklyClassStats.week_number == week_number,
+                                               WeeklyClassStats.class_name != '').all()
+    count = sum(r.student_count or 0 for r in class_rows)
+    type_counts = {}
+    for r in class_rows:
+        for name, n in json.loads(r.top_violations or '[]'):
+            type_counts[name] = type_counts.get(name, 0) + n
+    WeeklyClassStats.query.filter_by(week_number=week_number, class_name='').delete(synchronize_session=False)
+    db.session.add(WeeklyClassStats(
+        week_number=week_number, class_name='', student_count=count,
+        avg_score=round(sum((r.avg_score or 0) * (r.student_count or 0) for r in class_rows) / count, 2) if count else 0,
+        count_good=sum(r.count_good or 0 for r in class_rows),
+        count_fair=sum(r.count_fair or 0 for r in class_rows),
+        count_weak=sum(r.count_weak or 0 for r in class_rows),
+        total_deductions=sum(r.total_deductions or 0 for r in class_rows),
+        top_violations=json.dumps(sorted(type_counts.items(), key=lambda x: x[1], reverse=True), ensure_ascii=False)
+    ))
+
+def refresh_weekly_class_stats(week_number, class_names=None, from_archive=None):
+    """
+    Tính lại & ghi đè các dòng WeeklyClassStats của 1 tuần (xem compute_weekly_class_stats).
+    Chỉ tính lại một số lớp -> dòng toàn trường cộng dồn lại từ các dòng lớp.
+    Không commit - gọi trước db.session.commit() của thao tác ghi dữ liệu.
+    """
+    rows = compute_weekly_class_stats(week_number, class_names, from_archive)
+    if rows is None:
+        return
+    stale = WeeklyClassStats.query.filter(WeeklyClassStats.week_number == week_number)
+    if class_names is not None:
+        stale = stale.filter(WeeklyClassStats.class_name.in_([r.class_name for r in rows]))
+    stale.delete(synchronize_session=False)
+    db.session.add_all(rows)
+    if class_names is not None:
+        refresh_school_stats(week_number)
+
+def refresh_conduct_stats(class_names):
+    """Sau khi ghi vi phạm / điểm cộng / học sinh: tính lại tổng hợp tuần đang mở cho các lớp bị ảnh hưởng (tuần cũ đã đóng băng)"""
+    refresh_weekly_class_stats(get_current_week(), class_names)
+
+def get_weekly_class_stats(class_name, weeks):
+    """
+    Tổng hợp nề nếp của 1 lớp ('' = toàn trường) qua nhiều tuần - 1 truy vấn theo chỉ mục.
+    Tuần đã kết thúc chưa có dữ liệu tổng hợp (dữ liệu trước khi có bảng này) nhưng đã được lưu trữ thì tính
+    bổ sung & lưu lại; tuần đang mở chưa có thì tính tạm (không lưu); tuần tương lai không trả về.
+    
+    Returns:
+        dict: {tuần: WeeklyClassStats}
+    """
+    current_week = get_current_week()
+    weeks = [w for w in weeks if w <= current_week]
+    
+    def load():
+        rows = WeeklyClassStats.query.filter(WeeklyClassStats.class_name == class_name,
+                                             WeeklyClassStats.week_number.in_(weeks)).all()
+        return {r.week_number: r for r in rows}
+    
+    result = load()
+    missing = [w for w in weeks if w not in result and w < current_week]
+    if missing:
+        archived = [w for (w,) in db.session.query(WeeklyArchive.week_number)
+                    .filter(WeeklyArchive.week_number.in_(missing)).distinct()]
+        if archived:
+            for w in archived:
+                refresh_weekly_class_stats(w, from_archive=True)
+            db.session.commit()
+            result = load()
+    if current_week in weeks and current_week not in result:
+        rows = compute_weekly_class_stats(current_week, {class_name} if class_name else None, from_archive=False) or []
+        result.update({r.week_number: r for r in rows if r.class_name == class_name})
+    return result
 
 def is_reset_needed():
     """Kiểm tra xem đã sang tuần thực tế mới chưa để hiện cảnh báo"""
     try:
         current_iso_week = get_current_iso_week()
-        last_reset_cfg = SystemConfig.query.filter_by(key="last_reset_week_id").first()
+        # Đọc qua cache danh mục (reset_week luôn invalidate_reference_cache())
+        def load():
+            cfg = SystemConfig.query.filter_by(key="last_reset_week_id").first()
+            return cfg.value if cfg else None
+        last_reset_week_id = get_reference_data('last_reset_week_id', load)
         
         # Nếu chưa từng reset lần nào -> Cần báo
-        if not last_reset_cfg:
+        if not last_reset_week_id:
             return True
             
         # Nếu tuần thực tế khác tuần đã lưu -> Cần báo
-        if current_iso_week != last_reset_cfg.value:
+        if current_iso_week != last_reset_week_id:
             return True
     except:
         pass
@@ -413,68 +778,140 @@ def calculate_week_from_date(date_obj):
     _, week_num, _ = date_obj.isocalendar()
     return week_num
 
-def parse_excel_file(file):
+VIOLATION_FILE_COLUMNS = ['Mã học sinh', 'Loại vi phạm', 'Điểm trừ', 'Ngày vi phạm']
+VIOLATION_DATE_FORMATS = ['%Y-%m-%d %H:%M', '%d/%m/%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y', '%Y-%m-%d']
+ALLOWED_VIOLATION_EXTENSIONS = {'xlsx', 'xls', 'csv'}
+VIOLATION_WEEK_RANGE = (1, 53)  # tuần hợp lệ (theo tuần ISO của ngày vi phạm)
+VIOLATION_CSV_CHUNK = 20000  # số dòng CSV đọc mỗi lượt - giữ bộ nhớ ổn định với file log cả học kỳ
+
+def parse_violation_dates(column):
+    """Chuyển cột ngày vi phạm sang datetime theo lần lượt các định dạng VIOLATION_DATE_FORMATS (NaT = không hợp lệ)"""
+    if pd.api.types.is_datetime64_any_dtype(column):
+        return column
+    text = column.astype(str).str.strip()
+    dates = pd.Series(pd.NaT, index=column.index, dtype='datetime64[us]')
+    for fmt in VIOLATION_DATE_FORMATS:
+        missing = dates.isna()
+        if not missing.any():
+            break
+        dates[missing] = pd.to_datetime(text[missing], format=fmt, errors='coerce')
+    return dates
+
+def parse_violation_frame(df, first_row):
+    """
+    Chuyển 1 DataFrame (1 sheet Excel hoặc 1 lượt CSV) thành danh sách vi phạm bằng các phép toán theo cột.
+    first_row: số dòng trong file của dòng đầu tiên (dùng cho thông báo lỗi).
+    
+    Returns:
+        Tuple[List[dict], List[str]]: (violations, errors) - dòng lỗi bị bỏ qua
+    """
+    row_numbers = pd.Series(range(first_row, first_row + len(df)), index=df.index)
+    codes = df['Mã học sinh'].astype('string').str.strip()
+    names = df['Loại vi phạm'].astype('string').str.strip()
+    points = pd.to_numeric(df['Điểm trừ'], errors='coerce')
+    dates = parse_violation_dates(df['Ngày vi phạm'])
+    
+    # Tuần: lấy từ cột "Tuần" nếu có, còn trống thì tính theo tuần ISO của ngày vi phạm
+    weeks = pd.to_numeric(df['Tuần'], errors='coerce') if 'Tuần' in df.columns else pd.Series(float('nan'), index=df.index)
+    weeks = weeks.fillna(dates.dt.isocalendar().week.astype('float'))
+    
+    checks = [
+        (codes.isna() | (codes == ''), lambda i: "Thiếu mã học sinh"),
+        (names.isna() | (names == ''), lambda i: "Thiếu loại vi phạm"),
+        (points.isna(), lambda i: f"Điểm trừ không hợp lệ: {df['Điểm trừ'][i]}"),
+        (dates.isna(), lambda i: f"Định dạng ngày không hợp lệ: {df['Ngày vi phạm'][i]}"),
+        (points <= 0, lambda i: f"Điểm trừ phải lớn hơn 0: {df['Điểm trừ'][i]}"),
+        (~weeks.between(*VIOLATION_WEEK_RANGE) | (weeks % 1 != 0), lambda i: f"Tuần không hợp lệ: {df.get('Tuần', weeks)[i]}"),
+    ]
+    errors = []  # (số dòng, lỗi) - mỗi dòng chỉ báo lỗi đầu tiên
+    bad = pd.Series(False, index=df.index)
+    for mask, message in checks:
+        errors += [(row_numbers[i], message(i)) for i in df.index[mask & ~bad]]
+        bad |= mask
+    
+    good = ~bad
+    keys = ['student_code', 'violation_type_name', 'points_deducted', 'date_committed', 'week_number', 'row_number']
+    columns = zip(codes[good].tolist(), names[good].tolist(), points[good].astype('int64').tolist(),
+                  dates[good].dt.to_pydatetime().tolist(), weeks[good].astype('int64').tolist(), row_numbers[good].tolist())
+    return [dict(zip(keys, values)) for values in columns], [f"Dòng {row}: {message}" for row, message in sorted(errors)]
+
+def parse_violation_file(file):
     """
-    Parse Excel file using pandas
+    Đọc file vi phạm (Excel .xlsx/.xls hoặc CSV) theo từng lượt
     
     Expected columns:
     - Mã học sinh (student_code)
     - Loại vi phạm (violation_type_name)
     - Điểm trừ (points_deducted)
-    - Ngày vi phạm (date_committed) - format: YYYY-MM-DD HH:MM or DD/MM/YYYY HH:MM
+    - Ngày vi phạm (date_committed) - format: YYYY-MM-DD HH:MM or DD/MM/YYYY HH:MM (hoặc chỉ ngày)
     - Tuần (week_number) - optional, auto-calculate if empty
     
-    Returns:
-        List[dict]: Violations data
+    CSV được đọc từng VIOLATION_CSV_CHUNK dòng, Excel đọc 1 lần.
+    file: file upload (FileStorage) hoặc đường dẫn file đã lưu
+    
+    Yields:
+        Tuple[List[dict], List[str]]: (violations, errors) của từng lượt
     """
+    is_csv = (getattr(file, 'filename', None) or str(file)).lower().endswith('.csv')
     try:
-        df = pd.read_excel(file)
-        
-        # Validate required columns
-        required_cols = ['Mã học sinh', 'Loại vi phạm', 'Điểm trừ', 'Ngày vi phạm']
-        for col in required_cols:
-            if col not in df.columns:
-                raise ValueError(f"Thiếu cột bắt buộc: {col}")
-        
-        violations = []
-        for idx, row in df.iterrows():
-            # Parse datetime
-            date_str = str(row['Ngày vi phạm'])
-            try:
-                # Try YYYY-MM-DD HH:MM format
-                date_committed = datetime.datetime.strptime(date_str, '%Y-%m-%d %H:%M')
-            except:
-                try:
-                    # Try DD/MM/YYYY HH:MM format
-                    date_committed = datetime.datetime.strptime(date_str, '%d/%m/%Y %H:%M')
-                except:
-                    try:
-                        # Try date only YYYY-MM-DD
-                        date_committed = datetime.datetime.strptime(date_str.split()[0], '%Y-%m-%d')
-                    except:
-                        raise ValueError(f"Dòng {idx+2}: Định dạng ngày không hợp lệ: {date_str}")
-            
-            # Calculate week_number if not provided
-            week_number = row.get('Tuần', None)
-            if pd.isna(week_number):
-                week_number = calculate_week_from_date(date_committed)
-            
-            violations.append({
-                'student_code': str(row['Mã học sinh']).strip(),
-                'violation_type_name': str(row['Loại vi phạm']).strip(),
-                'points_deducted': int(row['Điểm trừ']),
-                'date_committed': date_committed,
-                'week_number': int(week_number)
-            })
-        
-        return violations
+        if is_csv:
+            frames = pd.read_csv(file, dtype=str, encoding='utf-8-sig', skipinitialspace=True, chunksize=VIOLATION_CSV_CHUNK)
+        else:
+            frames = [pd.read_excel(file)]
+        
+        first_row = 2  # dòng 1 là tiêu đề
+        for df in frames:
+            missing = [col for col in VIOLATION_FILE_COLUMNS if col not in df.columns]
+            if missing:
+                raise ValueError(f"Thiếu cột bắt buộc: {', '.join(missing)}")
+            yield parse_violation_frame(df, first_row)
+            first_row += len(df)
     except Exception as e:
-        raise ValueError(f"Lỗi đọc file Excel: {str(e)}")
-
-def import_violations_to_db(violations_data):
+        raise ValueError(f"Lỗi đọc file {'CSV' if is_csv else 'Excel'}: {str(e)}")
+
+VIOLATION_IMPORT_CHUNK = 500  # số dòng mỗi lượt ghi + commit khi nhập vi phạm hàng loạt
+
+def load_students_by_code(codes, batch_size=900):
+    """Map mã học sinh -> Student cho danh sách mã (truy vấn IN theo từng lô để không vượt giới hạn tham số SQLite)"""
+    codes = list({c for c in codes if c})
+    students = {}
+    for i in range(0, len(codes), batch_size):
+        for s in Student.query.filter(Student.student_code.in_(codes[i:i + batch_size])).all():
+            students[s.student_code] = s
+    return students
+
+def validate_violation_row(v_data, students_by_code):
+    """Kiểm tra 1 dòng vi phạm trước khi ghi, trả về (student, dòng đã chuẩn hóa kiểu) hoặc raise ValueError"""
+    code = str(v_data.get('student_code') or '').strip()
+    student = students_by_code.get(code)
+    if not student:
+        raise ValueError(f"Không tìm thấy học sinh '{code}'")
+    name = str(v_data.get('violation_type_name') or '').strip()
+    if not name:
+        raise ValueError("Thiếu loại vi phạm")
+    try:
+        points = int(v_data['points_deducted'])
+        week_number = int(v_data['week_number'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Điểm trừ / tuần không hợp lệ")
+    if points <= 0:
+        raise ValueError(f"Điểm trừ phải lớn hơn 0: {points}")
+    if not VIOLATION_WEEK_RANGE[0] <= week_number <= VIOLATION_WEEK_RANGE[1]:
+        raise ValueError(f"Tuần không hợp lệ: {week_number}")
+    date_committed = v_data.get('date_committed')
+    if not isinstance(date_committed, datetime.datetime):
+        raise ValueError(f"Ngày vi phạm không hợp lệ: {date_committed}")
+    return student, {'violation_type_name': name[:200], 'points_deducted': points,
+                     'date_committed': date_committed, 'week_number': week_number}
+
+def import_violations_to_db(violations_data, chunk_size=VIOLATION_IMPORT_CHUNK, changed_by_id=None, progress=None):
     """
     Import violations to database
     
+    Mã học sinh được tra 1 lần cho cả file, mỗi dòng được kiểm tra trước (dòng lỗi bị bỏ qua, không ảnh hưởng
+    các dòng khác). Mỗi lượt `chunk_size` dòng: INSERT hàng loạt Violation / ScoreLedger / ChangeLog,
+    1 lệnh UPDATE điểm cho các học sinh của lượt rồi commit; lượt lỗi khi ghi được rollback riêng.
+    
     Args:
         violations_data: List[dict] with keys:
             - student_code
@@ -482,49 +919,82 @@ def import_violations_to_db(violations_data):
             - points_deducted
             - date_committed
             - week_number
+        chunk_size: số dòng mỗi lượt commit
+        changed_by_id: người ghi nhận trong ChangeLog khi chạy ngoài request (mặc định current_user)
+        progress: progress(số dòng hợp lệ đã ghi) - gọi sau mỗi lượt commit
     
     Returns:
         Tuple[List[str], int]: (errors, success_count)
     """
     errors = []
     success_count = 0
+    classes = set()
     
+    # 1. Tra mã học sinh cho cả file + kiểm tra từng dòng
+    students_by_code = load_students_by_code(str(v.get('student_code') or '').strip() for v in violations_data)
+    valid_rows = []
     for idx, v_data in enumerate(violations_data):
         try:
-            # 1. Tìm học sinh
-            student = Student.query.filter_by(student_code=v_data['student_code']).first()
-            if not student:
-                errors.append(f"Dòng {idx+1}: Không tìm thấy học sinh '{v_data['student_code']}'")
-                continue
-            
-            # 2. Lưu vào lịch sử vi phạm
-            violation = Violation(
-                student_id=student.id,
-                violation_type_name=v_data['violation_type_name'],
-                points_deducted=v_data['points_deducted'],
-                date_committed=v_data['date_committed'],
-                week_number=v_data['week_number']
-            )
-            
-            db.session.add(violation)
-            
-            # 3. CẬP NHẬT TRỪ ĐIỂM NGAY LẬP TỨC (Đây là đoạn quan trọng mới thêm)
-            current = student.current_score if student.current_score is not None else 100
-            student.current_score = current - v_data['points_deducted']
+            student, row = validate_violation_row(v_data, students_by_code)
+            # Giữ sẵn thông tin cần ghi (Student hết hạn sau mỗi commit, đọc lại sẽ tốn 1 truy vấn / học sinh)
+            valid_rows.append((v_data.get('row_number', idx + 1),
+                               SimpleNamespace(id=student.id, name=student.name, student_class=student.student_class), row))
+        except ValueError as e:
+            errors.append(f"Dòng {v_data.get('row_number', idx+1)}: {str(e)}")
+    
+    current_week = get_current_week()
+    if changed_by_id is None and getattr(current_user, 'is_authenticated', False):
+        changed_by_id = current_user.id
+    chunk_size = max(1, int(chunk_size or VIOLATION_IMPORT_CHUNK))
+    
+    # 2. Ghi theo từng lượt
+    for start in range(0, len(valid_rows), chunk_size):
+        chunk = valid_rows[start:start + chunk_size]
+        try:
+            totals = {}
+            for week in {row['week_number'] for _, _, row in chunk}:
+                load_running_totals({st.id for _, st, row in chunk if row['week_number'] == week}, week, totals)
             
-            log_change('bulk_violation', f'Nhập vi phạm hàng loạt: {v_data["violation_type_name"]} (-{v_data["points_deducted"]} điểm)', student_id=student.id, student_name=student.name, student_class=student.student_class, old_value=current, new_value=student.current_score)
+            violations, ledger, logs = [], [], []
+            for _, student, row in chunk:
+                key = (student.id, row['week_number'])
+                current = totals[key]
+                totals[key] = new_score = current - row['points_deducted']
+                violations.append(dict(row, student_id=student.id))
+                ledger.append({'student_id': student.id, 'week_number': row['week_number'], 'event_type': 'violation',
+                               'delta': -row['points_deducted'], 'running_total': new_score,
+                               'note': row['violation_type_name']})
+                logs.append({'changed_by_id': changed_by_id, 'change_type': 'bulk_violation', 'student_id': student.id,
+                             'student_name': student.name, 'student_class': student.student_class,
+                             'description': f'Nhập vi phạm hàng loạt: {row["violation_type_name"]} (-{row["points_deducted"]} điểm)',
+                             'old_value': str(current), 'new_value': str(new_score)})
             
-            success_count += 1
+            db.session.execute(insert(Violation), violations)
+            db.session.execute(insert(ScoreLedger), ledger)
+            db.session.execute(insert(ChangeLog), logs)
+            # Mỗi học sinh của lượt chỉ được cập nhật điểm 1 lần (điểm cuối trong sổ của tuần đang mở)
+            chunk_weeks = {row['week_number'] for _, _, row in chunk}
+            if current_week in chunk_weeks:
+                sync_current_scores(current_week, {st.id for _, st, row in chunk if row['week_number'] == current_week})
+            bump_cache_stamps([conduct_stamp_key(w) for w in chunk_weeks])
+            db.session.commit()
             
+            classes |= {st.student_class for _, st, _ in chunk}
+            success_count += len(chunk)
         except Exception as e:
-            errors.append(f"Dòng {idx+1}: {str(e)}")
             db.session.rollback()
+            errors.append(f"Dòng {chunk[0][0]}-{chunk[-1][0]}: Lỗi lưu database: {str(e)}")
+        if progress:
+            progress(start + len(chunk))
     
-    try:
-        db.session.commit()
-    except Exception as e:
-        db.session.rollback()
-        errors.append(f"Lỗi lưu database: {str(e)}")
+    # 3. Tổng hợp theo lớp / tuần cho các lượt đã ghi
+    if success_count:
+        try:
+            refresh_conduct_stats(classes)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            errors.append(f"Lỗi cập nhật tổng hợp: {str(e)}")
     
     return errors, success_count
 
@@ -643,26 +1113,27 @@ def logout():
 def index():
     search = request.args.get('search', '').strip()
     selected_class = request.args.get('class_select', '').strip()
-    q = get_accessible_students()  # Filter by role
-    if selected_class: q = q.filter_by(student_class=selected_class)
-    if search: q = q.filter(or_(Student.name.ilike(f"%{search}%"), Student.student_code.ilike(f"%{search}%")))
-    students = q.order_by(Student.student_code.asc()).all()
+    q = filter_students(get_accessible_students(), selected_class, search)  # Filter by role
+    page = paginate_students(q.options(selectinload(Student.violations)),
+                             after=request.args.get('after'), before=request.args.get('before'))
+    students = page['items']
     
     # Calculate GPA for each student
-    week_cfg = SystemConfig.query.filter_by(key="current_week").first()
-    current_week = int(week_cfg.value) if week_cfg else 1
+    current_week = get_current_week()
     
     # Determine current semester and school year
     # Simple logic: weeks 1-20 = semester 1, weeks 21-40 = semester 2
     semester = 1 if current_week <= 20 else 2
     school_year = "2023-2024"  # Could be made dynamic later
     
-    student_gpas = {}
-    for student in students:
-        gpa = calculate_student_gpa(student.id, semester, school_year)
-        student_gpas[student.id] = gpa
+    # Tính GPA cho cả trang trong 1 truy vấn thay vì 1 truy vấn/học sinh
+    student_gpas = calculate_gpa_batch([s.id for s in students], semester, school_year)
+    # Hạng trong lớp của các học sinh trên trang
+    student_ranks = get_class_ranks({s.student_class for s in students}, semester, school_year)
     
-    return render_template('index.html', students=students, student_gpas=student_gpas, search_query=search, selected_class=selected_class)
+    return render_template('index.html', students=students, student_gpas=student_gpas, student_ranks=student_ranks, page=page,
+                           pager_args={'search': search, 'class_select': selected_class},
+                           search_query=search, selected_class=selected_class)
 
 def calculate_student_gpa(student_id, semester, school_year):
     """
@@ -672,38 +1143,325 @@ def calculate_student_gpa(student_id, semester, school_year):
     Returns:
         float: GPA value (0.0 - 10.0) or None if no grades
     """
-    grades = Grade.query.filter_by(
-        student_id=student_id,
-        semester=semester,
-        school_year=school_year
+    return calculate_gpa_batch([student_id], semester, school_year).get(student_id)
+
+def calculate_gpa_batch(students, semester, school_year):
+    """
+    Tính GPA cho nhiều học sinh cùng lúc.
+    Đọc điểm TB môn đã tổng hợp sẵn trong SubjectAverage bằng 1 truy vấn,
+    sau đó tính GPA bằng pandas cho toàn bộ danh sách.
+    Formula: (TX + GK*2 + HK*3) / 6 cho từng môn, sau đó lấy trung bình các môn
+    
+    Args:
+        students: Danh sách student_id, hoặc Query Student đã lọc (dùng làm subquery)
+        semester (int): Học kỳ
+        school_year (str): Năm học
+    
+    Returns:
+        dict: {student_id: gpa} - học sinh chưa đủ điểm sẽ không có trong dict
+    """
+    if hasattr(students, 'with_entities'):
+        id_filter = SubjectAverage.student_id.in_(students.with_entities(Student.id).order_by(None).subquery().select())
+    else:
+        student_ids = list(students)
+        if not student_ids:
+            return {}
+        id_filter = SubjectAverage.student_id.in_(student_ids)
+    
+    rows = db.session.query(SubjectAverage.student_id, SubjectAverage.subject_avg).filter(
+        id_filter,
+        SubjectAverage.semester == semester,
+        SubjectAverage.school_year == school_year,
+        SubjectAverage.subject_avg.isnot(None)
     ).all()
     
-    if not grades:
-        return None
+    if not rows:
+        return {}
     
-    # Group by subject
-    grades_by_subject = {}
-    for grade in grades:
-        if grade.subject_id not in grades_by_subject:
-            grades_by_subject[grade.subject_id] = {'TX': [], 'GK': [], 'HK': []}
-        grades_by_subject[grade.subject_id][grade.grade_type].append(grade.score)
-    
-    # Calculate average for each subject
-    subject_averages = []
-    for subject_id, data in grades_by_subject.items():
-        if data['TX'] and data['GK'] and data['HK']:
-            avg_tx = sum(data['TX']) / len(data['TX'])
-            avg_gk = sum(data['GK']) / len(data['GK'])
-            avg_hk = sum(data['HK']) / len(data['HK'])
-            subject_avg = round((avg_tx + avg_gk * 2 + avg_hk * 3) / 6, 2)
-            subject_averages.append(subject_avg)
-    
-    if not subject_averages:
-        return None
+    df = pd.DataFrame(rows, columns=['student_id', 'subject_avg'])
+    gpa = df.groupby('student_id')['subject_avg'].mean()
+    
+    return {int(sid): round(float(val), 2) for sid, val in gpa.items()}
+
+
+def _build_subject_average_values(avg_rows):
+    """
+    Gom kết quả AVG(score) GROUP BY (student, subject, semester, school_year, grade_type)
+    thành giá trị cho bảng SubjectAverage.
+    
+    Returns:
+        dict: {(student_id, subject_id, semester, school_year): {avg_tx, avg_gk, avg_hk, subject_avg}}
+    """
+    values = {}
+    for student_id, subject_id, semester, school_year, grade_type, avg in avg_rows:
+        key = (student_id, subject_id, semester, school_year)
+        item = values.setdefault(key, {'avg_tx': None, 'avg_gk': None, 'avg_hk': None, 'subject_avg': None})
+        if grade_type in ('TX', 'GK', 'HK'):
+            item['avg_' + grade_type.lower()] = avg
+    
+    for item in values.values():
+        if item['avg_tx'] is not None and item['avg_gk'] is not None and item['avg_hk'] is not None:
+            item['subject_avg'] = round((item['avg_tx'] + item['avg_gk'] * 2 + item['avg_hk'] * 3) / 6, 2)
+    return values
+
+
+def refresh_subject_averages(keys):
+    """
+    Tính lại SubjectAverage cho các khóa (student_id, subject_id, semester, school_year).
+    Gọi hàm này TRƯỚC db.session.commit() để đảm bảo cùng transaction với thao tác ghi điểm.
+    """
+    keys = {(int(st), int(sub), int(sem), year) for st, sub, sem, year in keys}
+    if not keys:
+        return
+    
+    student_ids = {k[0] for k in keys}
+    subject_ids = {k[1] for k in keys}
+    semesters = {k[2] for k in keys}
+    years = {k[3] for k in keys}
+    
+    # Autoflush đảm bảo các thay đổi Grade đang chờ đã được tính vào
+    avg_rows = db.session.query(
+        Grade.student_id, Grade.subject_id, Grade.semester, Grade.school_year, Grade.grade_type, func.avg(Grade.score)
+    ).filter(
+        Grade.student_id.in_(student_ids),
+        Grade.subject_id.in_(subject_ids),
+        Grade.semester.in_(semesters),
+        Grade.school_year.in_(years)
+    ).group_by(Grade.student_id, Grade.subject_id, Grade.semester, Grade.school_year, Grade.grade_type).all()
+    values = _build_subject_average_values(avg_rows)
+    
+    existing = SubjectAverage.query.filter(
+        SubjectAverage.student_id.in_(student_ids),
+        SubjectAverage.subject_id.in_(subject_ids),
+        SubjectAverage.semester.in_(semesters),
+        SubjectAverage.school_year.in_(years)
+    ).all()
+    existing = {(a.student_id, a.subject_id, a.semester, a.school_year): a for a in existing}
+    
+    for key in keys:
+        row = existing.get(key)
+        data = values.get(key)
+        if data is None:
+            # Không còn điểm nào -> xóa dòng tổng hợp
+            if row:
+                db.session.delete(row)
+            continue
+        if not row:
+            row = SubjectAverage(student_id=key[0], subject_id=key[1], semester=key[2], school_year=key[3])
+            db.session.add(row)
+        for field, val in data.items():
+            setattr(row, field, val)
+    
+    # Báo cho cache xếp hạng GPA (theo lớp) và phổ điểm (theo môn) bị ảnh hưởng
+    classes = db.session.query(Student.student_class).filter(Student.id.in_(student_ids)).distinct().all()
+    bump_cache_stamps([grade_stamp_key(c) for (c,) in classes] + [subject_stamp_key(sub) for sub in subject_ids])
+
+
+def rebuild_subject_averages():
+    """
+    Xây lại toàn bộ bảng SubjectAverage từ bảng Grade (dùng để backfill).
+    
+    Returns:
+        int: Số dòng tổng hợp đã ghi
+    """
+    avg_rows = db.session.query(
+        Grade.student_id, Grade.subject_id, Grade.semester, Grade.school_year, Grade.grade_type, func.avg(Grade.score)
+    ).group_by(Grade.student_id, Grade.subject_id, Grade.semester, Grade.school_year, Grade.grade_type).all()
+    values = _build_subject_average_values(avg_rows)
+    
+    SubjectAverage.query.delete()
+    now = datetime.datetime.utcnow()
+    db.session.bulk_insert_mappings(SubjectAverage, [
+        dict(student_id=k[0], subject_id=k[1], semester=k[2], school_year=k[3], updated_at=now, **data)
+        for k, data in values.items()
+    ])
+    bump_cache_stamps([grade_stamp_key(c) for (c,) in db.session.query(Student.student_class).distinct().all()] +
+                      [subject_stamp_key(sub_id) for (sub_id,) in db.session.query(Subject.id).all()])
+    db.session.commit()
+    return len(values)
+
+
+def get_subject_averages(student_id, semester, school_year=None):
+    """
+    Lấy điểm TB các môn của 1 học sinh từ bảng SubjectAverage.
+    
+    Returns:
+        dict: {subject_id: SubjectAverage}
+    """
+    q = SubjectAverage.query.filter_by(student_id=student_id, semester=semester)
+    if school_year is not None:
+        q = q.filter_by(school_year=school_year)
+    # Nếu không lọc năm học: năm học mới nhất được ưu tiên
+    return {a.subject_id: a for a in q.order_by(SubjectAverage.school_year.asc()).all()}
+
+
+# === XẾP HẠNG & PHÂN VỊ (GPA, ĐIỂM RÈN LUYỆN) ===
+# - Điểm rèn luyện: xếp hạng trực tiếp bằng window function RANK()/CUME_DIST() trong SQL
+# - GPA: xếp hạng vector hóa bằng pandas trên kết quả calculate_gpa_batch, cache theo
+#   (lớp, học kỳ, năm học) cho đến khi điểm của lớp thay đổi (stamp "grades:<lớp>")
+
+_gpa_rank_cache = {}
+_gpa_rank_cache_lock = threading.Lock()
+
+STUDENTS_STAMP_KEY = "students"  # Đổi khi thêm / xóa học sinh hoặc học sinh chuyển lớp
+
+def grade_stamp_key(class_name):
+    """Key version stamp điểm số của 1 lớp trong SystemConfig"""
+    return f"grades:{class_name}"
+
+def subject_stamp_key(subject_id):
+    """Key version stamp điểm số của 1 môn trong SystemConfig"""
+    return f"grades_subject:{subject_id}"
+
+def get_grade_level(class_name):
+    """Khối của lớp (VD: '10A1' -> '10', '12 Tin' -> '12'), None nếu tên lớp không bắt đầu bằng số"""
+    m = re.match(r'\s*(\d+)', class_name or '')
+    return m.group(1) if m else None
+
+def _rank_values(values):
+    """
+    Xếp hạng vector hóa: điểm cao nhất hạng 1 (đồng điểm đồng hạng),
+    phân vị = % số học sinh có điểm <= điểm của học sinh đó.
+    
+    Returns:
+        dict: {student_id: {'rank', 'percentile', 'size'}}
+    """
+    series = pd.Series(values, dtype='float64').dropna()
+    if series.empty:
+        return {}
+    ranks = series.rank(method='min', ascending=False).astype(int)
+    percentiles = (series.rank(method='max', pct=True) * 100).round(1)
+    size = len(series)
+    return {int(sid): {'rank': int(r), 'percentile': float(p), 'size': size}
+            for sid, r, p in zip(series.index, ranks, percentiles)}
+
+def _conduct_ranks(*criteria):
+    """Xếp hạng điểm rèn luyện (current_score) của nhóm học sinh bằng 1 truy vấn window function"""
+    rows = db.session.query(
+        Student.id,
+        Student.student_class,
+        func.rank().over(order_by=Student.current_score.desc()),
+        func.cume_dist().over(order_by=Student.current_score.asc()),
+        func.count().over()
+    ).filter(*criteria).all()
+    return {sid: {'rank': rank, 'percentile': round(float(cume) * 100, 1), 'size': size}
+            for sid, _, rank, cume, size in rows}, rows
+
+def _class_gpas(class_name, roster, semester, school_year):
+    """GPA (đã cache) của các học sinh trong lớp; cache bị bỏ khi điểm/danh sách lớp/môn học thay đổi"""
+    key = (class_name, semester, school_year)
+    stamp = get_cache_stamps(REF_CACHE_VERSION_KEY, grade_stamp_key(class_name)) + (frozenset(roster),)
+    with _gpa_rank_cache_lock:
+        entry = _gpa_rank_cache.get(key)
+    if entry and entry['stamp'] == stamp:
+        return entry
+    
+    gpas = calculate_gpa_batch(list(roster), semester, school_year)
+    entry = {'stamp': stamp, 'gpas': gpas, 'ranks': _rank_values(gpas)}
+    with _gpa_rank_cache_lock:
+        _gpa_rank_cache[key] = entry
+    return entry
+
+def get_class_ranks(class_names, semester, school_year):
+    """
+    Hạng & phân vị trong lớp của mọi học sinh thuộc các lớp cho trước.
+    
+    Returns:
+        dict: {student_id: {'gpa': {'rank', 'percentile', 'size'} | None, 'conduct': {...}}}
+    """
+    result = {}
+    for class_name in set(class_names):
+        conduct, rows = _conduct_ranks(Student.student_class == class_name)
+        gpa_ranks = _class_gpas(class_name, [r[0] for r in rows], semester, school_year)['ranks']
+        for sid in conduct:
+            result[sid] = {'gpa': gpa_ranks.get(sid), 'conduct': conduct[sid]}
+    return result
+
+def get_student_ranks(student, semester, school_year):
+    """
+    Hạng & phân vị của 1 học sinh trong lớp và trong khối.
+    
+    Returns:
+        dict: {'class': {'gpa', 'conduct'}, 'level': {'gpa', 'conduct'} | None, 'level_name': str | None}
+    """
+    result = {'class': get_class_ranks([student.student_class], semester, school_year).get(student.id),
+              'level': None, 'level_name': get_grade_level(student.student_class)}
+    level = result['level_name']
+    if not level:
+        return result
+    
+    level_classes = [c for (c,) in db.session.query(Student.student_class).distinct().all() if get_grade_level(c) == level]
+    conduct, rows = _conduct_ranks(Student.student_class.in_(level_classes))
+    rosters = {}
+    for sid, class_name, *_ in rows:
+        rosters.setdefault(class_name, []).append(sid)
+    level_gpas = {}
+    for class_name, roster in rosters.items():
+        level_gpas.update(_class_gpas(class_name, roster, semester, school_year)['gpas'])
+    
+    result['level'] = {'gpa': _rank_values(level_gpas).get(student.id), 'conduct': conduct.get(student.id)}
+    return result
+
+
+def build_transcripts(student_ids, semester, school_year):
+    """
+    Dựng bảng điểm (học bạ) cho 1 hoặc nhiều học sinh với số truy vấn cố định:
+    - 1 truy vấn Subject LEFT JOIN Grade (giữ cả môn chưa có điểm)
+    - 1 truy vấn SubjectAverage cho điểm TB môn
+    
+    Args:
+        student_ids (list[int]): Danh sách id học sinh
+        semester (int): Học kỳ
+        school_year (str): Năm học
     
-    # Calculate overall GPA
-    gpa = round(sum(subject_averages) / len(subject_averages), 2)
-    return gpa
+    Returns:
+        dict: {student_id: {'transcript_data': [...], 'gpa': float|None}}
+              mỗi phần tử transcript_data gồm subject, tx_scores, gk_scores, hk_scores, avg_score
+    """
+    student_ids = [int(sid) for sid in student_ids]
+    if not student_ids:
+        return {}
+    
+    rows = db.session.query(Subject, Grade).outerjoin(Grade, and_(
+        Grade.subject_id == Subject.id,
+        Grade.student_id.in_(student_ids),
+        Grade.semester == semester,
+        Grade.school_year == school_year
+    )).order_by(Subject.name, Grade.column_index, Grade.id).all()
+    
+    averages = db.session.query(SubjectAverage.student_id, SubjectAverage.subject_id, SubjectAverage.subject_avg).filter(
+        SubjectAverage.student_id.in_(student_ids),
+        SubjectAverage.semester == semester,
+        SubjectAverage.school_year == school_year
+    ).all()
+    avg_map = {(st, sub): avg for st, sub, avg in averages}
+    
+    subjects = []
+    scores = {}  # (student_id, subject_id) -> {'TX': [], 'GK': [], 'HK': []}
+    for subject, grade in rows:
+        if not subjects or subjects[-1].id != subject.id:
+            subjects.append(subject)
+        if grade is not None:
+            scores.setdefault((grade.student_id, subject.id), {'TX': [], 'GK': [], 'HK': []})\
+                .setdefault(grade.grade_type, []).append(grade.score)
+    
+    result = {}
+    for sid in student_ids:
+        transcript_data = []
+        for subject in subjects:
+            data = scores.get((sid, subject.id), {})
+            transcript_data.append({
+                'subject': subject,
+                'tx_scores': data.get('TX', []),
+                'gk_scores': data.get('GK', []),
+                'hk_scores': data.get('HK', []),
+                'avg_score': avg_map.get((sid, subject.id))
+            })
+        
+        valid_averages = [item['avg_score'] for item in transcript_data if item['avg_score'] is not None]
+        gpa = round(sum(valid_averages) / len(valid_averages), 2) if valid_averages else None
+        result[sid] = {'transcript_data': transcript_data, 'gpa': gpa}
+    return result
 
 
 @app.route("/dashboard")
@@ -711,42 +1469,86 @@ def calculate_student_gpa(student_id, semester, school_year):
 def dashboard():
     show_reset_warning = is_reset_needed()
     
-    # 1. Lấy số thứ tự tuần hiện tại
-    w_cfg = SystemConfig.query.filter_by(key="current_week").first()
-    current_week = int(w_cfg.value) if w_cfg else 1
-    
     s_class = request.args.get("class_select")
     
-    # 2. Thống kê điểm số (Filter by role)
     # Nếu GVCN và không chọn lớp cụ thể, tự động filter assigned_class
     if not s_class and current_user.role == 'homeroom_teacher' and current_user.assigned_class:
         s_class = current_user.assigned_class
     
-    q = get_accessible_students()  # Already filtered by role
-    if s_class: 
-        q = q.filter_by(student_class=s_class)
-    c_tot = q.filter(Student.current_score >= 90).count()
-    c_kha = q.filter(Student.current_score >= 70, Student.current_score < 90).count()
-    c_tb = q.filter(Student.current_score < 70).count()
-    
-    # 3. Thống kê lỗi (CHỈ LẤY CỦA TUẦN HIỆN TẠI)
-    vios_q = db.session.query(Violation.violation_type_name, func.count(Violation.violation_type_name).label("c"))
-    
-    # Lọc theo tuần hiện tại
-    vios_q = vios_q.filter(Violation.week_number == current_week)
-    
-    if s_class: 
-        vios_q = vios_q.join(Student).filter(Student.student_class == s_class)
-        
-    top = vios_q.group_by(Violation.violation_type_name).order_by(desc("c")).limit(5).all()
-    
+    # Số liệu biểu đồ được tải riêng qua /api/dashboard_stats (có cache)
     return render_template("dashboard.html", 
                            show_reset_warning=show_reset_warning,
                            selected_class=s_class, 
-                           pie_labels=json.dumps(["Tốt", "Khá", "Cần cố gắng"]), 
-                           pie_data=json.dumps([c_tot, c_kha, c_tb]), 
-                           bar_labels=json.dumps([n for n, _ in top]), 
-                           bar_data=json.dumps([c for _, c in top]))
+                           subjects=get_subjects())
+
+DASHBOARD_STATS_TTL = 60  # giây - số liệu dashboard dùng chung giữa các giáo viên trong khoảng này
+_dashboard_stats_cache = {}
+_dashboard_stats_cache_lock = threading.Lock()
+
+def build_dashboard_stats(class_name, week_number):
+    """
+    Số liệu biểu đồ dashboard (trong phạm vi học sinh current_user được xem):
+    xếp loại theo current_score trong 1 truy vấn SUM(CASE) + top 5 vi phạm của tuần.
+    """
+    q = get_accessible_students()  # Already filtered by role
+    if class_name: 
+        q = q.filter(Student.student_class == class_name)
+    c_tot, c_kha, c_tb = q.with_entities(
+        func.sum(case((Student.current_score >= 90, 1), else_=0)),
+        func.sum(case((and_(Student.current_score >= 70, Student.current_score < 90), 1), else_=0)),
+        func.sum(case((Student.current_score < 70, 1), else_=0))
+    ).one()
+    
+    # Thống kê lỗi (CHỈ LẤY CỦA TUẦN HIỆN TẠI)
+    vios_q = db.session.query(Violation.violation_type_name, func.count(Violation.violation_type_name).label("c"))\
+        .filter(Violation.week_number == week_number)
+    if class_name: 
+        vios_q = vios_q.join(Student).filter(Student.student_class == class_name)
+    top = vios_q.group_by(Violation.violation_type_name).order_by(desc("c")).limit(5).all()
+    
+    return {
+        'week': week_number,
+        'class_name': class_name or None,
+        'pie_labels': ["Tốt", "Khá", "Cần cố gắng"],
+        'pie_data': [int(c_tot or 0), int(c_kha or 0), int(c_tb or 0)],
+        'bar_labels': [n for n, _ in top],
+        'bar_data': [c for _, c in top]
+    }
+
+def get_dashboard_stats(class_name, week_number):
+    """
+    Số liệu biểu đồ dashboard đã cache theo (phạm vi quyền, lớp, tuần).
+    Hết hạn sau DASHBOARD_STATS_TTL giây hoặc ngay khi vi phạm / điểm cộng của tuần hay danh sách học sinh thay đổi.
+    """
+    if current_user.role == 'homeroom_teacher':
+        scope = f"class:{current_user.assigned_class or ''}"
+    else:
+        scope = current_user.role
+    key = (scope, class_name or '', week_number)
+    stamp = get_cache_stamps(conduct_stamp_key(week_number), STUDENTS_STAMP_KEY)
+    now = time.monotonic()
+    with _dashboard_stats_cache_lock:
+        entry = _dashboard_stats_cache.get(key)
+    if entry and entry[0] == stamp and now - entry[1] < DASHBOARD_STATS_TTL:
+        return entry[2]
+    
+    data = build_dashboard_stats(class_name, week_number)
+    with _dashboard_stats_cache_lock:
+        _dashboard_stats_cache[key] = (stamp, now, data)
+    return data
+
+@app.route("/api/dashboard_stats")
+@login_required
+def dashboard_stats_api():
+    """API JSON số liệu biểu đồ dashboard của tuần hiện tại"""
+    s_class = request.args.get("class_select", "").strip()
+    if not s_class and current_user.role == 'homeroom_teacher' and current_user.assigned_class:
+        s_class = current_user.assigned_class
+    
+    response = jsonify(get_dashboard_stats(s_class, get_current_week()))
+    response.cache_control.private = True
+    response.cache_control.max_age = DASHBOARD_STATS_TTL
+    return response
 
 
 # === STUDENT PORTAL ROUTES ===
@@ -764,10 +1566,10 @@ def student_required(f):
 def student_login():
     if request.method == "POST":
         code = request.form.get("student_code", "").strip()
-        # Chuẩn hóa mã
+        # Chuẩn hóa mã rồi tra theo cột normalized_code (có chỉ mục)
         norm_code = normalize_student_code(code)
         
-        student = Student.query.filter_by(student_code=norm_code).first()
+        student = Student.query.filter_by(normalized_code=norm_code).first() if norm_code else None
         if student:
             session['student_id'] = student.id
             session['student_name'] = student.name
@@ -792,8 +1594,7 @@ def get_student_ai_advice(student):
         import prompts
         
         # Lấy vi phạm tuần hiện tại
-        week_cfg = SystemConfig.query.filter_by(key="current_week").first()
-        current_week = int(week_cfg.value) if week_cfg else 1
+        current_week = get_current_week()
         
         violations = Violation.query.filter_by(
             student_id=student.id, 
@@ -840,8 +1641,7 @@ def student_dashboard():
         return redirect(url_for('student_logout'))
         
     # Lấy dữ liệu hiển thị
-    week_cfg = SystemConfig.query.filter_by(key="current_week").first()
-    current_week = int(week_cfg.value) if week_cfg else 1
+    current_week = get_current_week()
     
     # 1. Vi phạm tuần này
     current_violations = Violation.query.filter_by(
@@ -857,26 +1657,29 @@ def student_dashboard():
     
     # 3. Điểm số các môn (GPA)
     semester = 1 if current_week <= 20 else 2
+    school_year = "2023-2024"  # Could be made dynamic later
     grades = Grade.query.filter_by(
         student_id=student_id,
-        semester=semester
+        semester=semester,
+        school_year=school_year
     ).all()
     
     # Group grades
     transcript = {}
-    subjects = Subject.query.all()
+    subjects = get_subjects()
     for sub in subjects:
         transcript[sub.name] = {'TX': [], 'GK': [], 'HK': [], 'TB': None}
         
-    for g in grades:
-        if g.subject.name in transcript:
-            transcript[g.subject.name][g.grade_type].append(g.score)
+    for grade in grades:
+        if grade.subject.name in transcript:
+            transcript[grade.subject.name][grade.grade_type].append(grade.score)
             
-    # Tính TB môn
-    for sub_name, data in transcript.items():
-        if data['TX'] and data['GK'] and data['HK']:
-            avg = (sum(data['TX'])/len(data['TX']) + sum(data['GK'])/len(data['GK'])*2 + sum(data['HK'])/len(data['HK'])*3) / 6
-            data['TB'] = round(avg, 2)
+    # TB môn lấy từ bảng tổng hợp
+    averages = get_subject_averages(student_id, semester, school_year)
+    for sub in subjects:
+        avg = averages.get(sub.id)
+        if avg and avg.subject_avg is not None:
+            transcript[sub.name]['TB'] = avg.subject_avg
             
     # 4. Lấy lời khuyên AI (Optional - có thể load async)
     ai_advice = get_student_ai_advice(student)
@@ -967,19 +1770,56 @@ def student_chat_api():
     return jsonify({"reply": reply})
 
 
+_analysis_locks = weakref.WeakValueDictionary()  # stats_hash -> Lock, tự giải phóng khi không còn request nào giữ
+_analysis_locks_lock = threading.Lock()
+
+def get_cached_analysis(prompt, class_name, weeks):
+    """
+    Gọi AI phân tích nề nếp, dùng lại kết quả cũ nếu đã phân tích đúng prompt này (cùng lớp, tuần, số liệu).
+    Các request trùng nhau trong cùng tiến trình chờ nhau thay vì cùng gọi model.
+    
+    Returns:
+        tuple: (analysis_text, error_message, cached)
+    """
+    stats_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    with _analysis_locks_lock:
+        lock = _analysis_locks.get(stats_hash)
+        if lock is None:
+            lock = _analysis_locks[stats_hash] = threading.Lock()
+    
+    with lock:
+        cached = ClassAnalysisCache.query.filter_by(stats_hash=stats_hash).first()
+        if cached:
+            return cached.analysis, None, True
+        
+        analysis_text, error = _call_gemini(prompt)
+        if error:
+            return None, error, False
+        
+        db.session.add(ClassAnalysisCache(stats_hash=stats_hash, class_name=class_name,
+                                          weeks=",".join(str(w) for w in weeks), analysis=analysis_text))
+        try:
+            db.session.commit()
+        except Exception as e:
+            # Tiến trình khác vừa lưu cùng kết quả
+            print(f"Analysis Cache Error: {e}")
+            db.session.rollback()
+        return analysis_text, None, False
+
+@app.route("/api/analyze_class_stats", methods=["POST"])
 @login_required
 def analyze_class_stats():
     """
     API Phân tích tình hình nề nếp.
     - Có khả năng TỰ ĐỘNG chọn tuần hiện tại nếu không nhận được tham số.
+    - Số liệu mọi tuần lấy trong 1 truy vấn; kết quả AI được cache theo hash của số liệu.
     """
     try:
         data = request.get_json() or {} # Thêm or {} để tránh lỗi nếu data None
         s_class = data.get("class_name", "")
         
         # 1. Lấy tuần hiện tại của hệ thống (QUAN TRỌNG)
-        sys_week_cfg = SystemConfig.query.filter_by(key="current_week").first()
-        sys_week = int(sys_week_cfg.value) if sys_week_cfg else 1
+        sys_week = get_current_week()
 
         # 2. Xử lý tham số tuần từ Frontend
         weeks_input = data.get("weeks", [])
@@ -999,46 +1839,14 @@ def analyze_class_stats():
 
         stats_summary = [] 
 
-        # 3. Quét qua từng tuần để lấy số liệu
+        # 3. Lấy số liệu tổng hợp của mọi tuần trong 1 truy vấn (bảng WeeklyClassStats)
+        weekly_stats = get_weekly_class_stats(s_class, weeks_input)
         for w in weeks_input:
-            # Logic: Tuần nhỏ hơn tuần hệ thống là Lịch sử (Archive), ngược lại là Hiện tại (Student)
-            is_history = (w < sys_week)
-            
-            # --- Lấy thống kê Điểm số & Sĩ số ---
-            if is_history:
-                # Lấy từ kho lưu trữ
-                q = WeeklyArchive.query.filter_by(week_number=w)
-                if s_class: q = q.filter_by(student_class=s_class)
-                archives = q.all()
-                
-                total_students = len(archives)
-                if total_students > 0:
-                    avg_score = sum(a.final_score for a in archives) / total_students
-                    c_tot = sum(1 for a in archives if a.final_score >= 90)
-                    c_tb = sum(1 for a in archives if a.final_score < 70)
-                else:
-                    avg_score, c_tot, c_tb = 0, 0, 0
-            else:
-                # Lấy từ dữ liệu thực tế đang chạy
-                q = Student.query
-                if s_class: q = q.filter_by(student_class=s_class)
-                students = q.all()
-                
-                total_students = len(students)
-                if total_students > 0:
-                    avg_score = sum(s.current_score for s in students) / total_students
-                    c_tot = sum(1 for s in students if s.current_score >= 90)
-                    c_tb = sum(1 for s in students if s.current_score < 70)
-                else:
-                    avg_score, c_tot, c_tb = 0, 0, 0
-
-            # --- Lấy Top vi phạm ---
-            vios_q = db.session.query(Violation.violation_type_name, func.count(Violation.violation_type_name).label("c"))
-            vios_q = vios_q.filter(Violation.week_number == w)
-            if s_class:
-                vios_q = vios_q.join(Student).filter(Student.student_class == s_class)
-            
-            top_violations = vios_q.group_by(Violation.violation_type_name).order_by(desc("c")).limit(3).all()
+            st = weekly_stats.get(w)
+            avg_score = st.avg_score if st else 0
+            c_tot = st.count_good if st else 0
+            c_tb = st.count_weak if st else 0
+            top_violations = json.loads(st.top_violations)[:3] if st else []
             
             violations_text = ", ".join([f"{name} ({count})" for name, count in top_violations])
             if not violations_text: violations_text = "Không có vi phạm đáng kể"
@@ -1072,18 +1880,76 @@ def analyze_class_stats():
             4. Viết đoạn văn khoảng 4-5 câu.
             """
         
-        # Gọi AI
-        analysis_text, error = _call_gemini(prompt)
+        # Gọi AI (hoặc lấy kết quả đã phân tích cho đúng số liệu này)
+        analysis_text, error, cached = get_cached_analysis(prompt, s_class, weeks_input)
         
         if error: 
             return jsonify({"error": error}), 500
             
-        return jsonify({"analysis": analysis_text})
+        return jsonify({"analysis": analysis_text, "cached": cached})
 
     except Exception as e:
         print(f"Analyze Error: {e}")
         return jsonify({"error": str(e)}), 500
 
+# === GHI VI PHẠM HÀNG LOẠT ===
+
+def find_students_by_codes(codes):
+    """
+    Tìm học sinh theo danh sách mã (VD: mã OCR đọc được) - giữ thứ tự, bỏ mã không khớp.
+    Khớp chính xác bằng 1 truy vấn IN, mã còn lại khớp theo cột normalized_code (1 truy vấn IN có chỉ mục).
+    """
+    codes = [str(code).strip() for code in codes if code and str(code).strip()]
+    exact = {s.student_code: s for s in Student.query.filter(Student.student_code.in_({c.upper() for c in codes})).all()}
+    missing = {normalize_student_code(c) for c in codes if c.upper() not in exact}
+    normalized = {}
+    if missing:
+        for st in Student.query.filter(Student.normalized_code.in_(missing)).order_by(Student.id).all():
+            normalized.setdefault(st.normalized_code, st)
+    students = []
+    for code in codes:
+        s = exact.get(code.upper()) or normalized.get(normalize_student_code(code))
+        if s:
+            students.append(s)
+    return students
+
+def record_violations_bulk(students, rules, week_number, log_label='Vi phạm'):
+    """
+    Ghi mỗi lỗi trong `rules` cho mỗi học sinh trong `students`: Violation, ScoreLedger và ChangeLog
+    bằng 3 lệnh INSERT hàng loạt (điểm lũy kế tính trong bộ nhớ từ 1 lần nạp sổ điểm),
+    rồi 1 lệnh UPDATE chép điểm vào current_score. Không commit.
+    
+    Returns:
+        dict: {lớp: số vi phạm đã ghi}
+    """
+    if not students or not rules:
+        return {}
+    changed_by_id = current_user.id if current_user.is_authenticated else None
+    totals = load_running_totals([s.id for s in students], week_number)
+    violations, ledger, logs = [], [], []
+    class_counts = {}
+    for rule in rules:
+        for s in students:
+            key = (s.id, week_number)
+            old_score = totals[key]
+            totals[key] = new_score = old_score - rule.points_deducted
+            violations.append({'student_id': s.id, 'violation_type_name': rule.name,
+                               'points_deducted': rule.points_deducted, 'week_number': week_number})
+            ledger.append({'student_id': s.id, 'week_number': week_number, 'event_type': 'violation',
+                           'delta': -rule.points_deducted, 'running_total': new_score, 'note': rule.name[:200]})
+            logs.append({'changed_by_id': changed_by_id, 'change_type': 'violation', 'student_id': s.id,
+                         'student_name': s.name, 'student_class': s.student_class,
+                         'description': f'{log_label}: {rule.name} (-{rule.points_deducted} điểm)',
+                         'old_value': str(old_score), 'new_value': str(new_score)})
+            class_counts[s.student_class] = class_counts.get(s.student_class, 0) + 1
+    
+    db.session.execute(insert(Violation), violations)
+    db.session.execute(insert(ScoreLedger), ledger)
+    db.session.execute(insert(ChangeLog), logs)
+    if week_number == get_current_week():
+        sync_current_scores(week_number, {s.id for s in students})
+    return class_counts
+
 @app.route("/add_violation", methods=["GET", "POST"])
 @login_required
 def add_violation():
@@ -1101,83 +1967,48 @@ def add_violation():
             flash("Vui lòng chọn ít nhất một lỗi vi phạm!", "error")
             return redirect(url_for("add_violation"))
 
-        w_cfg = SystemConfig.query.filter_by(key="current_week").first()
-        current_week = int(w_cfg.value) if w_cfg else 1
-        count = 0
+        current_week = get_current_week()
 
-        # Process each violation type
-        for rule_id in selected_rule_ids:
+        # 1 truy vấn IN cho các lỗi đã chọn (giữ thứ tự chọn)
+        rule_ids = [int(r) for r in selected_rule_ids if str(r).isdigit()]
+        rules_by_id = {r.id: r for r in ViolationType.query.filter(ViolationType.id.in_(rule_ids)).all()}
+        rules = [rules_by_id[r] for r in rule_ids if r in rules_by_id]
+
+        # A. Danh sách từ Dropdown chọn tay / B. Danh sách từ OCR (Áp dụng normalize)
+        students, log_label = [], 'Vi phạm'
+        if selected_student_ids:
+            student_ids = [int(s_id) for s_id in selected_student_ids if str(s_id).isdigit()]
+            students_by_id = {s.id: s for s in Student.query.filter(Student.id.in_(student_ids)).all()}
+            students = [students_by_id[s_id] for s_id in student_ids if s_id in students_by_id]
+        elif ocr_json:
             try:
-                rule = db.session.get(ViolationType, int(rule_id))
-            except:
-                continue
-            
-            if not rule:
-                continue
+                students = find_students_by_codes(json.loads(ocr_json))
+                log_label = 'Vi phạm (OCR)'
+            except Exception as e:
+                print(f"OCR Error: {e}")
 
-            # A. Xử lý danh sách từ Dropdown chọn tay
-            if selected_student_ids:
-                for s_id in selected_student_ids:
-                    student = db.session.get(Student, int(s_id))
-                    if student:
-                        old_score = student.current_score or 100
-                        student.current_score = old_score - rule.points_deducted
-                        db.session.add(Violation(student_id=student.id, violation_type_name=rule.name, points_deducted=rule.points_deducted, week_number=current_week))
-                        log_change('violation', f'Vi phạm: {rule.name} (-{rule.points_deducted} điểm)', student_id=student.id, student_name=student.name, student_class=student.student_class, old_value=old_score, new_value=student.current_score)
-                        count += 1
-            
-            # B. Xử lý danh sách từ OCR (Áp dụng normalize)
-            elif ocr_json:
-                try:
-                    student_codes = json.loads(ocr_json)
-                    for code in student_codes:
-                        if not code: continue
-                        
-                        # Tìm kiếm với normalized code
-                        code_normalized = normalize_student_code(str(code).strip())
-                        s = None
-                        
-                        # Thử exact match trước
-                        s = Student.query.filter_by(student_code=str(code).strip().upper()).first()
-                        
-                        # Thử normalized match nếu không tìm thấy
-                        if not s:
-                            all_students = Student.query.all()
-                            for student in all_students:
-                                if normalize_student_code(student.student_code) == code_normalized:
-                                    s = student
-                                    break
-                        
-                        if s:
-                            old_score = s.current_score or 100
-                            s.current_score = old_score - rule.points_deducted
-                            db.session.add(Violation(student_id=s.id, violation_type_name=rule.name, points_deducted=rule.points_deducted, week_number=current_week))
-                            log_change('violation', f'Vi phạm (OCR): {rule.name} (-{rule.points_deducted} điểm)', student_id=s.id, student_name=s.name, student_class=s.student_class, old_value=old_score, new_value=s.current_score)
-                            count += 1
-                except Exception as e:
-                    print(f"OCR Error: {e}")
+        class_counts = record_violations_bulk(students, rules, current_week, log_label)
+        count = sum(class_counts.values())
 
         if count > 0:
-            db.session.commit()
-            
-            # Tạo thông báo cho GVCN các lớp bị ảnh hưởng
-            affected_classes = set()
-            if selected_student_ids:
-                for s_id in selected_student_ids:
-                    student = db.session.get(Student, int(s_id))
-                    if student and student.student_class:
-                        affected_classes.add(student.student_class)
+            refresh_conduct_stats(class_counts)
+            bump_cache_stamps([conduct_stamp_key(current_week)])
             
-            for class_name in affected_classes:
+            # Thông báo cho GVCN các lớp bị ảnh hưởng - commit cùng transaction ghi vi phạm
+            for class_name, class_count in class_counts.items():
+                if not class_name:
+                    continue
                 try:
                     create_notification(
                         title=f"⚠️ Vi phạm mới - Lớp {class_name}",
-                        message=f"{current_user.full_name} đã ghi nhận {count} vi phạm cho học sinh lớp {class_name}",
+                        message=f"{current_user.full_name} đã ghi nhận {class_count} vi phạm cho học sinh lớp {class_name}",
                         notification_type='violation',
-                        target_role=class_name
+                        target_role=class_name,
+                        commit=False
                     )
                 except:
                     pass  # Không để lỗi notification làm gián đoạn chức năng chính
+            db.session.commit()
             
             flash(f"Đã ghi nhận {count} vi phạm (cho {len(selected_student_ids) if selected_student_ids else 'nhiều'} học sinh x {len(selected_rule_ids)} lỗi).", "success")
         else:
@@ -1185,9 +2016,8 @@ def add_violation():
         
         return redirect(url_for("add_violation"))
 
-    # GET: Truyền thêm danh sách học sinh để hiển thị trong Dropdown (filtered by role)
-    students = get_accessible_students().order_by(Student.student_class, Student.name).all()
-    return render_template("add_violation.html", rules=ViolationType.query.all(), students=students)
+    # GET: Danh sách học sinh được tải dần qua /api/students khi tìm kiếm
+    return render_template("add_violation.html", rules=get_violation_types())
 
 
 
@@ -1196,35 +2026,79 @@ def add_violation():
 def bulk_import_violations():
     """Display bulk import page"""
     students = Student.query.order_by(Student.student_class, Student.name).all()
-    violation_types = ViolationType.query.all()
+    violation_types = get_violation_types()
     return render_template("bulk_import_violations.html", 
                           students=students, 
                           violation_types=violation_types)
 
-@app.route("/process_bulk_violations", methods=["POST"])
-@login_required
-def process_bulk_violations():
+def run_violation_import_job(report, source, changed_by_id):
     """
-    Process bulk violation import from either:
+    Tác vụ nền nhập vi phạm hàng loạt.
+    source: đường dẫn file đã lưu (Excel / CSV, xóa khi xong) hoặc danh sách vi phạm nhập tay.
+    """
+    errors, success_count, processed = [], 0, 0
+    from_file = isinstance(source, str)
+    streamed = from_file and source.lower().endswith('.csv')  # CSV đọc từng lượt - chưa biết tổng số dòng
+    try:
+        batches = parse_violation_file(source) if from_file else [(source, [])]
+        for batch, parse_errors in batches:
+            errors += parse_errors
+            base = processed + len(parse_errors)
+            total = None if streamed else base + len(batch)
+            report(base, total)
+            batch_errors, batch_count = import_violations_to_db(batch, changed_by_id=changed_by_id,
+                                                                progress=lambda done: report(base + done, total))
+            errors += batch_errors
+            success_count += batch_count
+            processed = base + len(batch)
+        report(processed, processed)
+    finally:
+        if from_file and os.path.exists(source):
+            os.remove(source)
+    
+    if errors:
+        return {
+            "status": "partial" if success_count > 0 else "error",
+            "errors": errors,
+            "success": success_count,
+            "message": f"Đã import {success_count} vi phạm. Có {len(errors)} lỗi."
+        }
+    return {
+        "status": "success",
+        "success": success_count,
+        "message": f"✅ Đã import thành công {success_count} vi phạm!"
+    }
+
+@app.route("/process_bulk_violations", methods=["POST"])
+@login_required
+def process_bulk_violations():
+    """
+    Process bulk violation import from either:
     - Manual form entry (JSON array from frontend)
-    - Excel file upload
+    - Excel / CSV file upload
+    Chạy nền: trả về job_id, kết quả đọc qua /api/jobs/<id>
     """
     try:
         # Check source type
         excel_file = request.files.get('excel_file')
         manual_data = request.form.get('manual_violations_json')
         
-        violations_to_import = []
-        
         if excel_file and excel_file.filename:
-            # Process Excel file
-            violations_to_import = parse_excel_file(excel_file)
+            ext = os.path.splitext(excel_file.filename)[1].lower().lstrip('.')
+            if ext not in ALLOWED_VIOLATION_EXTENSIONS:
+                return jsonify({"status": "error", "message": "Chỉ chấp nhận file Excel (.xlsx, .xls) hoặc CSV (.csv)"}), 400
+            
+            # Lưu file tạm cho tác vụ nền (Validate & Import từng lượt, CSV lớn không phải nạp hết vào bộ nhớ)
+            if not os.path.exists("uploads"):
+                os.makedirs("uploads")
+            source = os.path.join("uploads", f"import_violations_{uuid.uuid4().hex[:8]}.{ext}")
+            excel_file.save(source)
         elif manual_data:
             # Process manual JSON data
-            violations_to_import = json.loads(manual_data)
+            source = json.loads(manual_data)
             
             # Convert date strings to datetime objects
-            for v in violations_to_import:
+            for v in source:
                 if isinstance(v['date_committed'], str):
                     v['date_committed'] = datetime.datetime.strptime(v['date_committed'], '%Y-%m-%dT%H:%M')
                 if 'week_number' not in v or v['week_number'] is None:
@@ -1232,22 +2106,13 @@ def process_bulk_violations():
         else:
             return jsonify({"status": "error", "message": "Không có dữ liệu để import"}), 400
         
-        # Validate & Import
-        errors, success_count = import_violations_to_db(violations_to_import)
-        
-        if errors:
-            return jsonify({
-                "status": "partial" if success_count > 0 else "error",
-                "errors": errors,
-                "success": success_count,
-                "message": f"Đã import {success_count} vi phạm. Có {len(errors)} lỗi."
-            })
-        
+        job = submit_job('violation_import', run_violation_import_job, source, current_user.id, created_by_id=current_user.id)
         return jsonify({
-            "status": "success",
-            "count": success_count,
-            "message": f"✅ Đã import thành công {success_count} vi phạm!"
-        })
+            "status": "queued",
+            "job_id": job.id,
+            "status_url": url_for('job_status_api', job_id=job.id),
+            "message": "Đang xử lý dữ liệu vi phạm..."
+        }), 202
         
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -1339,16 +2204,13 @@ def upload_ocr():
                 if student:
                     match_method = "Exact match (uppercase)"
                 
-                # Lần 2: Nếu không tìm thấy, thử normalized match
+                # Lần 2: Nếu không tìm thấy, thử normalized match (cột normalized_code có chỉ mục)
                 if not student:
                     ocr_code_normalized = normalize_student_code(ocr_code_raw)
-                    all_students = Student.query.all()
-                    
-                    for s in all_students:
-                        if normalize_student_code(s.student_code) == ocr_code_normalized:
-                            student = s
-                            match_method = f"Normalized match (chuẩn hóa: '{ocr_code_normalized}')"
-                            break
+                    student = Student.query.filter_by(normalized_code=ocr_code_normalized)\
+                        .order_by(Student.id).first()
+                    if student:
+                        match_method = f"Normalized match (chuẩn hóa: '{ocr_code_normalized}')"
                 
                 if student:
                     # ✅ Tìm thấy học sinh
@@ -1409,15 +2271,22 @@ def batch_violation(): return redirect(url_for('add_violation'))
 @app.route("/manage_students")
 @login_required
 def manage_students():
-    # Lấy danh sách học sinh (filtered by role)
-    students = get_accessible_students().order_by(Student.student_code.asc()).all()
-    class_list = ClassRoom.query.order_by(ClassRoom.name).all()
-    return render_template("manage_students.html", students=students, class_list=class_list)
+    search = request.args.get('search', '').strip()
+    selected_class = request.args.get('class_select', '').strip()
+    # Lấy danh sách học sinh (filtered by role), phân trang theo mã số
+    q = filter_students(get_accessible_students(), selected_class, search)
+    page = paginate_students(q, after=request.args.get('after'), before=request.args.get('before'))
+    class_list = get_class_list()
+    return render_template("manage_students.html", students=page['items'], page=page, class_list=class_list,
+                           pager_args={'search': search, 'class_select': selected_class},
+                           search_query=search, selected_class=selected_class)
 
 @app.route("/add_student", methods=["POST"])
 @login_required
 def add_student():
     db.session.add(Student(name=request.form["student_name"], student_code=request.form["student_code"], student_class=request.form["student_class"]))
+    refresh_conduct_stats({request.form["student_class"]})
+    bump_cache_stamps([STUDENTS_STAMP_KEY])
     db.session.commit()
     flash("Thêm học sinh thành công", "success")
     return redirect(url_for("manage_students"))
@@ -1428,7 +2297,10 @@ def delete_student(student_id):
     s = db.session.get(Student, student_id)
     if s:
         Violation.query.filter_by(student_id=student_id).delete()
+        ScoreLedger.query.filter_by(student_id=student_id).delete()
         db.session.delete(s)
+        refresh_conduct_stats({s.student_class})
+        bump_cache_stamps([STUDENTS_STAMP_KEY])
         db.session.commit()
         flash("Đã xóa học sinh", "success")
     return redirect(url_for("manage_students"))
@@ -1444,7 +2316,11 @@ def edit_student(student_id):
     if request.method == "POST":
         s.name = request.form["student_name"]
         s.student_code = request.form["student_code"]
+        old_class = s.student_class
         s.student_class = request.form["student_class"]
+        if old_class != s.student_class:
+            refresh_conduct_stats({old_class, s.student_class})
+            bump_cache_stamps([STUDENTS_STAMP_KEY])
         db.session.commit()
         flash("Cập nhật thành công", "success")
         return redirect(url_for("manage_students"))
@@ -1456,6 +2332,7 @@ def edit_student(student_id):
 def add_class():
     if not ClassRoom.query.filter_by(name=request.form["class_name"]).first():
         db.session.add(ClassRoom(name=request.form["class_name"]))
+        invalidate_reference_cache()
         db.session.commit()
     return redirect(url_for("manage_students"))
 #chỉnh sửa lớp học
@@ -1483,7 +2360,9 @@ def edit_class(class_id):
             students_in_class = Student.query.filter_by(student_class=old_name).all()
             for s in students_in_class:
                 s.student_class = new_name
-                
+            
+            refresh_conduct_stats({old_name, new_name})
+            invalidate_reference_cache()
             db.session.commit()
             flash(f"Đã đổi tên lớp '{old_name}' thành '{new_name}' và cập nhật {len(students_in_class)} học sinh.", "success")
         else:
@@ -1508,6 +2387,7 @@ def delete_class(class_id):
                 flash(f"Không thể xóa lớp '{cls.name}' vì đang có {student_count} học sinh. Hãy chuyển hoặc xóa học sinh trước.", "error")
             else:
                 db.session.delete(cls)
+                invalidate_reference_cache()
                 db.session.commit()
                 flash(f"Đã xóa lớp {cls.name}", "success")
     except Exception as e:
@@ -1518,16 +2398,20 @@ def delete_class(class_id):
 def manage_rules():
     if request.method == "POST":
         db.session.add(ViolationType(name=request.form["rule_name"], points_deducted=int(request.form["points"])))
+        invalidate_reference_cache()
         db.session.commit()
         flash("Đã thêm lỗi vi phạm", "success")
         return redirect(url_for("manage_rules"))
-    return render_template("manage_rules.html", rules=ViolationType.query.all())
+    return render_template("manage_rules.html", rules=get_violation_types())
 
 @app.route("/delete_rule/<int:rule_id>", methods=["POST"])
 @login_required
 def delete_rule(rule_id):
     r = db.session.get(ViolationType, rule_id)
-    if r: db.session.delete(r); db.session.commit()
+    if r:
+        db.session.delete(r)
+        invalidate_reference_cache()
+        db.session.commit()
     return redirect(url_for("manage_rules"))
 
 @app.route("/edit_rule/<int:rule_id>", methods=["GET", "POST"])
@@ -1537,6 +2421,7 @@ def edit_rule(rule_id):
     if request.method == "POST":
         r.name = request.form["rule_name"]
         r.points_deducted = int(request.form["points"])
+        invalidate_reference_cache()
         db.session.commit()
         flash("Đã sửa lỗi vi phạm", "success")
         return redirect(url_for("manage_rules"))
@@ -1612,47 +2497,26 @@ def api_chatbot():
         student = s_list[0]
         
         # Thu thập dữ liệu từ CSDL
-        week_cfg = SystemConfig.query.filter_by(key="current_week").first()
-        current_week = int(week_cfg.value) if week_cfg else 1
+        current_week = get_current_week()
         semester = 1
         school_year = "2023-2024"
         
-        # Lấy điểm học tập
-        grades = Grade.query.filter_by(
-            student_id=student.id,
-            semester=semester,
-            school_year=school_year
-        ).all()
+        # Lấy điểm học tập (đọc từ bảng tổng hợp SubjectAverage)
+        averages = db.session.query(SubjectAverage, Subject.name).join(Subject).filter(
+            SubjectAverage.student_id == student.id,
+            SubjectAverage.semester == semester,
+            SubjectAverage.school_year == school_year,
+            SubjectAverage.subject_avg.isnot(None)
+        ).order_by(Subject.name).all()
         
         grades_data = {}
-        if grades:
-            grades_by_subject = {}
-            for grade in grades:
-                if grade.subject_id not in grades_by_subject:
-                    grades_by_subject[grade.subject_id] = {
-                        'subject_name': grade.subject.name,
-                        'TX': [],
-                        'GK': [],
-                        'HK': []
-                    }
-                grades_by_subject[grade.subject_id][grade.grade_type].append(grade.score)
-            
-            for subject_id, data in grades_by_subject.items():
-                subject_name = data['subject_name']
-                avg_score = None
-                
-                if data['TX'] and data['GK'] and data['HK']:
-                    avg_tx = sum(data['TX']) / len(data['TX'])
-                    avg_gk = sum(data['GK']) / len(data['GK'])
-                    avg_hk = sum(data['HK']) / len(data['HK'])
-                    avg_score = round((avg_tx + avg_gk * 2 + avg_hk * 3) / 6, 2)
-                    
-                    grades_data[subject_name] = {
-                        'TX': round(avg_tx, 1),
-                        'GK': round(avg_gk, 1),
-                        'HK': round(avg_hk, 1),
-                        'TB': avg_score
-                    }
+        for avg, subject_name in averages:
+            grades_data[subject_name] = {
+                'TX': round(avg.avg_tx, 1),
+                'GK': round(avg.avg_gk, 1),
+                'HK': round(avg.avg_hk, 1),
+                'TB': avg.subject_avg
+            }
         
         # Lấy vi phạm
         violations = Violation.query.filter_by(student_id=student.id).order_by(Violation.date_committed.desc()).all()
@@ -1736,6 +2600,263 @@ def edit_profile():
 
 # --- TÌM HÀM history() VÀ THAY THẾ BẰNG ĐOẠN NÀY ---
 
+def get_week_tier_counts(week_number, class_name=None):
+    """
+    Số học sinh Tốt (>=90) / Khá (70-89) / Cần cố gắng (<70) theo điểm tuần = 100 - tổng điểm trừ trong tuần.
+    1 truy vấn: GROUP BY student_id cho điểm trừ, LEFT JOIN học sinh và đếm bằng SUM(CASE).
+    
+    Returns:
+        list: [tốt, khá, cần cố gắng]
+    """
+    deduct = db.session.query(
+        Violation.student_id,
+        func.sum(Violation.points_deducted).label('total')
+    ).filter(Violation.week_number == week_number).group_by(Violation.student_id).subquery()
+    score = 100 - func.coalesce(deduct.c.total, 0)
+    
+    q = db.session.query(
+        func.sum(case((score >= 90, 1), else_=0)),
+        func.sum(case((and_(score >= 70, score < 90), 1), else_=0)),
+        func.sum(case((score < 70, 1), else_=0))
+    ).select_from(Student).outerjoin(deduct, deduct.c.student_id == Student.id)
+    if class_name:
+        q = q.filter(Student.student_class == class_name)
+    return [int(v or 0) for v in q.one()]
+
+# === XẾP HẠNG NỀ NẾP LỚP THEO TUẦN ===
+# Dùng chung cho /history, /weekly_report và file Excel báo cáo tuần.
+# Kết quả được cache theo tuần; mọi thao tác ghi vi phạm / điểm cộng của 1 tuần phải gọi
+# bump_cache_stamps([conduct_stamp_key(tuần)]) trước commit.
+
+HE_SO_PHAT = 15.0  # Điểm lớp = 100 - (điểm trừ trung bình mỗi HS) * HE_SO_PHAT
+_class_ranking_cache = {}
+_class_ranking_cache_lock = threading.Lock()
+
+def conduct_stamp_key(week_number):
+    """Key version stamp dữ liệu nề nếp (vi phạm, điểm cộng) của 1 tuần trong SystemConfig"""
+    return f"conduct:{week_number}"
+
+def build_class_rankings(week_number):
+    """
+    Tính sĩ số, tổng điểm trừ trong tuần và điểm TB của mọi lớp trong 1 truy vấn
+    (học sinh LEFT JOIN vi phạm của tuần, GROUP BY student_class).
+    Điểm lớp = 100 - (tổng điểm trừ / sĩ số) * HE_SO_PHAT (tối thiểu 0), lớp không có HS được 100.
+    
+    Returns:
+        list: [{'name', 'student_count', 'weekly_deduct', 'avg_score'}] sắp xếp điểm cao xuống thấp
+    """
+    rows = db.session.query(
+        Student.student_class,
+        func.count(func.distinct(Student.id)),
+        func.coalesce(func.sum(Violation.points_deducted), 0)
+    ).outerjoin(Violation, and_(Violation.student_id == Student.id, Violation.week_number == week_number))\
+        .group_by(Student.student_class).all()
+    stats = {name: (count, total) for name, count, total in rows}
+    
+    class_rankings = []
+    for cls in get_class_list():
+        student_count, total_deduct_class = stats.get(cls.name, (0, 0))
+        if student_count > 0:
+            avg_deduct = total_deduct_class / student_count
+            avg_score = 100 - (avg_deduct * HE_SO_PHAT)
+            if avg_score < 0: avg_score = 0
+        else:
+            total_deduct_class = 0
+            avg_score = 100
+        
+        class_rankings.append({
+            "name": cls.name,
+            "student_count": student_count,
+            "weekly_deduct": total_deduct_class,
+            "avg_score": round(avg_score, 2)
+        })
+    
+    # Sắp xếp từ cao xuống thấp
+    class_rankings.sort(key=lambda x: x['avg_score'], reverse=True)
+    return class_rankings
+
+def get_class_rankings(week_number, include_empty=True):
+    """
+    Bảng xếp hạng nề nếp các lớp trong 1 tuần (đã cache).
+    Cache bị bỏ khi vi phạm / điểm cộng của tuần, danh sách lớp hoặc học sinh thay đổi.
+    include_empty=False: bỏ các lớp chưa có học sinh.
+    """
+    stamp = get_cache_stamps(REF_CACHE_VERSION_KEY, STUDENTS_STAMP_KEY, conduct_stamp_key(week_number))
+    with _class_ranking_cache_lock:
+        entry = _class_ranking_cache.get(week_number)
+    if entry and entry[0] == stamp:
+        rankings = entry[1]
+    else:
+        rankings = build_class_rankings(week_number)
+        with _class_ranking_cache_lock:
+            _class_ranking_cache[week_number] = (stamp, rankings)
+    
+    return [dict(r) for r in rankings if include_empty or r['student_count'] > 0]
+
+# === SNAPSHOT TUẦN ĐÃ KẾT THÚC ===
+# Sau khi reset_week, các tuần < current_week không còn được ghi thêm dữ liệu -> lưu sẵn toàn bộ số liệu
+# tổng hợp của tuần vào WeekSnapshot (JSON). Các trang / file Excel của tuần cũ đọc từ snapshot,
+# chỉ tuần đang mở mới tính trực tiếp từ bảng Violation.
+# Snapshot lưu kèm stamp conduct:<tuần>; nếu dữ liệu tuần cũ bị sửa muộn (xóa vi phạm, nhập Excel
+# vào tuần cũ) thì stamp đổi và snapshot được tạo lại ở lần đọc kế tiếp.
+
+SNAPSHOT_MAX_AGE = 24 * 3600  # Thời gian trình duyệt giữ file Excel của tuần đã kết thúc (giây)
+TOP_VIOLATIONS_LIMIT = 5
+
+def _tier_index(score):
+    """0: Tốt (>=90), 1: Khá (70-89), 2: Cần cố gắng (<70)"""
+    if score >= 90: return 0
+    if score >= 70: return 1
+    return 2
+
+def build_week_snapshot(week_number):
+    """
+    Tổng hợp số liệu 1 tuần (3 truy vấn): điểm trừ / điểm cộng theo học sinh, danh sách vi phạm, xếp hạng lớp.
+    Lớp của học sinh được ghi theo thời điểm tạo snapshot.
+    
+    Returns:
+        dict: {
+            'week', 'class_rankings',
+            'tier_counts': {lớp hoặc '' (toàn trường): [tốt, khá, cần cố gắng]},
+            'top_violations': {lớp hoặc '': [[tên lỗi, số lượt]]},
+            'students': [{'id', 'code', 'name', 'class', 'deductions', 'bonuses'}],
+            'violations': [{'id', 'date', 'type', 'points', 'student_id', 'code', 'name', 'class'}]
+        }
+    """
+    deduct = db.session.query(Violation.student_id, func.sum(Violation.points_deducted).label('total'))\
+        .filter(Violation.week_number == week_number).group_by(Violation.student_id).subquery()
+    bonus = db.session.query(BonusRecord.student_id, func.sum(BonusRecord.points_added).label('total'))\
+        .filter(BonusRecord.week_number == week_number).group_by(BonusRecord.student_id).subquery()
+    rows = db.session.query(Student.id, Student.student_code, Student.name, Student.student_class,
+                            func.coalesce(deduct.c.total, 0), func.coalesce(bonus.c.total, 0))\
+        .outerjoin(deduct, deduct.c.student_id == Student.id)\
+        .outerjoin(bonus, bonus.c.student_id == Student.id)\
+        .order_by(Student.student_class, Student.student_code).all()
+    
+    students = []
+    tier_counts = {'': [0, 0, 0]}
+    for sid, code, name, class_name, deductions, bonuses in rows:
+        students.append({'id': sid, 'code': code, 'name': name, 'class': class_name,
+                         'deductions': int(deductions), 'bonuses': int(bonuses)})
+        tier = _tier_index(100 - deductions)
+        tier_counts[''][tier] += 1
+        tier_counts.setdefault(class_name, [0, 0, 0])[tier] += 1
+    
+    vio_rows = db.session.query(Violation.id, Violation.date_committed, Violation.violation_type_name,
+                                Violation.points_deducted, Student.id, Student.student_code, Student.name, Student.student_class)\
+        .join(Student, Violation.student_id == Student.id)\
+        .filter(Violation.week_number == week_number)\
+        .order_by(Violation.date_committed.desc(), Violation.id.desc()).all()
+    violations = []
+    type_counts = {}
+    for vid, date, type_name, points, sid, code, name, class_name in vio_rows:
+        violations.append({'id': vid, 'date': date.isoformat() if date else None, 'type': type_name, 'points': points,
+                           'student_id': sid, 'code': code, 'name': name, 'class': class_name})
+        for key in ('', class_name):
+            counts = type_counts.setdefault(key, {})
+            counts[type_name] = counts.get(type_name, 0) + 1
+    top_violations = {
+        key: sorted(counts.items(), key=lambda x: x[1], reverse=True)[:TOP_VIOLATIONS_LIMIT]
+        for key, counts in type_counts.items()
+    }
+    
+    return {
+        'week': week_number,
+        'class_rankings': build_class_rankings(week_number),
+        'tier_counts': tier_counts,
+        'top_violations': top_violations,
+        'students': students,
+        'violations': violations
+    }
+
+def save_week_snapshot(week_number):
+    """
+    Tạo (hoặc tạo lại) snapshot của 1 tuần. Không commit - gọi trong transaction của reset_week.
+    
+    Returns:
+        WeekSnapshot
+    """
+    data = json.dumps(build_week_snapshot(week_number), ensure_ascii=False)
+    stamp = get_cache_stamp(conduct_stamp_key(week_number))
+    snap = WeekSnapshot.query.filter_by(week_number=week_number).first()
+    if not snap:
+        snap = WeekSnapshot(week_number=week_number)
+        db.session.add(snap)
+    snap.stamp = stamp
+    snap.data = data
+    snap.created_at = datetime.datetime.utcnow()
+    return snap
+
+def get_week_snapshot(week_number):
+    """
+    Snapshot của tuần đã kết thúc, None nếu là tuần đang mở (hoặc tương lai) -> phải tính trực tiếp.
+    Tuần cũ chưa có snapshot (hoặc dữ liệu đã bị sửa sau đó) được tạo lại tại đây.
+    
+    Returns:
+        SimpleNamespace(week, etag, data) hoặc None
+    """
+    if not week_number or week_number >= get_current_week():
+        return None
+    
+    snap = WeekSnapshot.query.filter_by(week_number=week_number).first()
+    if not snap or snap.stamp != get_cache_stamp(conduct_stamp_key(week_number)):
+        try:
+            snap = save_week_snapshot(week_number)
+            db.session.commit()
+        except Exception as e:
+            # VD: 2 request cùng tạo snapshot -> trùng week_number, dùng bản đã được ghi
+            print(f"Snapshot Error: {e}")
+            db.session.rollback()
+            snap = WeekSnapshot.query.filter_by(week_number=week_number).first()
+            if not snap:
+                return None
+    
+    etag = hashlib.md5(f"{snap.week_number}:{snap.stamp}:{snap.created_at.isoformat()}".encode()).hexdigest()
+    return SimpleNamespace(week=snap.week_number, etag=etag, data=json.loads(snap.data))
+
+def snapshot_violations(data, class_name=None):
+    """Danh sách vi phạm trong snapshot dưới dạng đối tượng có cùng thuộc tính với Violation (kèm .student)"""
+    result = []
+    for v in data['violations']:
+        if class_name and v['class'] != class_name:
+            continue
+        result.append(SimpleNamespace(
+            id=v['id'],
+            date_committed=datetime.datetime.fromisoformat(v['date']) if v['date'] else None,
+            violation_type_name=v['type'],
+            points_deducted=v['points'],
+            week_number=data['week'],
+            student_id=v['student_id'],
+            student=SimpleNamespace(id=v['student_id'], student_code=v['code'], name=v['name'], student_class=v['class'])
+        ))
+    return result
+
+def snapshot_file_response(snap, build_response):
+    """
+    Trả file xuất từ snapshot với ETag + Cache-Control dài hạn;
+    trình duyệt đã có bản cùng ETag thì trả 304, không cần tạo lại file.
+    """
+    if snap.etag in request.if_none_match:
+        response = make_response("", 304)
+    else:
+        response = build_response()
+    response.set_etag(snap.etag)
+    response.cache_control.no_cache = None  # send_file mặc định đặt no-cache
+    response.cache_control.private = True
+    response.cache_control.max_age = SNAPSHOT_MAX_AGE
+    return response
+
+def snapshot_page_response(html):
+    """
+    Trang HTML của tuần đã kết thúc: nội dung tuần không đổi nhưng thanh điều hướng phụ thuộc người dùng
+    (thông báo, tuần hiện tại) -> dùng ETag theo nội dung, trình duyệt phải hỏi lại nhưng nhận 304 nếu không đổi.
+    """
+    response = make_response(html)
+    response.add_etag()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 @app.route("/history")
 @login_required
 def history():
@@ -1754,37 +2875,28 @@ def history():
     bar_labels = []      
     bar_data = []        
 
-    if selected_week:
-        # A. LẤY CHI TIẾT VI PHẠM (để hiện bảng danh sách lỗi)
-        query = db.session.query(Violation).join(Student).filter(Violation.week_number == selected_week)
+    snap = get_week_snapshot(selected_week)
+    if snap:
+        # Tuần đã kết thúc: đọc toàn bộ số liệu từ snapshot
+        violations = snapshot_violations(snap.data, selected_class)
+        pie_data = snap.data['tier_counts'].get(selected_class, [0, 0, 0])
+        top = snap.data['top_violations'].get(selected_class, [])
+        bar_labels = [t[0] for t in top]
+        bar_data = [t[1] for t in top]
+        if not selected_class:
+            class_rankings = snap.data['class_rankings']
+    elif selected_week:
+        # A. LẤY CHI TIẾT VI PHẠM (để hiện bảng danh sách lỗi) - nạp sẵn học sinh qua JOIN
+        query = db.session.query(Violation).join(Student).options(contains_eager(Violation.student))\
+            .filter(Violation.week_number == selected_week)
         if selected_class:
             query = query.filter(Student.student_class == selected_class)
-        violations = query.order_by(Violation.date_committed.desc()).all()
+        violations = query.order_by(Violation.date_committed.desc(), Violation.id.desc()).all()
 
         # B. TÍNH TOÁN BIỂU ĐỒ TRÒN & CỘT
         # Thay vì lấy từ Archive, ta tính toán trực tiếp ("Real-time")
-        
-        # Lấy danh sách học sinh cần tính
-        q_students = Student.query
-        if selected_class: q_students = q_students.filter_by(student_class=selected_class)
-        students = q_students.all()
-
-        count_tot, count_kha, count_tb = 0, 0, 0
-
-        # Tính điểm cho từng học sinh trong tuần đã chọn
-        for s in students:
-            # Tổng điểm trừ của học sinh này trong tuần đó
-            s_deduct = db.session.query(func.sum(Violation.points_deducted))\
-                .filter(Violation.student_id == s.id, Violation.week_number == selected_week)\
-                .scalar() or 0
-            
-            s_score = 100 - s_deduct
-            
-            if s_score >= 90: count_tot += 1
-            elif s_score >= 70: count_kha += 1
-            else: count_tb += 1
-
-        pie_data = [count_tot, count_kha, count_tb]
+        # Điểm tuần của mỗi HS = 100 - tổng điểm trừ trong tuần (1 truy vấn GROUP BY student_id)
+        pie_data = get_week_tier_counts(selected_week, selected_class)
 
         # Top vi phạm
         vios_chart_q = db.session.query(Violation.violation_type_name, func.count(Violation.id).label("c"))\
@@ -1795,46 +2907,13 @@ def history():
         bar_labels = [t[0] for t in top]
         bar_data = [t[1] for t in top]
 
-        # C. TÍNH BẢNG XẾP HẠNG (QUAN TRỌNG: ĐÃ SỬA LẠI LOGIC)
-        # Chỉ tính khi không lọc lớp cụ thể
+        # C. TÍNH BẢNG XẾP HẠNG - Chỉ tính khi không lọc lớp cụ thể
         if not selected_class:
-            all_classes_obj = ClassRoom.query.all()
-            for cls in all_classes_obj:
-                # 1. Lấy tất cả học sinh của lớp
-                students_in_class = Student.query.filter_by(student_class=cls.name).all()
-                student_count = len(students_in_class)
-
-                if student_count > 0:
-                    # 2. Tính tổng điểm trừ của cả lớp trong tuần này
-                    total_deduct_class = db.session.query(func.sum(Violation.points_deducted))\
-                        .join(Student)\
-                        .filter(Student.student_class == cls.name, Violation.week_number == selected_week)\
-                        .scalar() or 0
-                    
-                    # 3. Tính điểm trung bình chuẩn: (Tổng điểm tất cả HS) / Số lượng HS
-                    # Tổng điểm tất cả HS = (100 * Số HS) - Tổng điểm trừ
-                    HE_SO_PHAT = 15.0
-                    
-                    avg_deduct = total_deduct_class / student_count
-                    avg_score = 100 - (avg_deduct * HE_SO_PHAT)
-                    
-                    if avg_score < 0: avg_score = 0
-                else:
-                    total_deduct_class = 0
-                    avg_score = 100 
-
-                class_rankings.append({
-                    "name": cls.name,
-                    "weekly_deduct": total_deduct_class,
-                    "avg_score": round(avg_score, 2)
-                })
-            
-            # Sắp xếp từ cao xuống thấp
-            class_rankings.sort(key=lambda x: x['avg_score'], reverse=True)
+            class_rankings = get_class_rankings(selected_week)
 
-    all_classes = [c.name for c in ClassRoom.query.order_by(ClassRoom.name).all()]
+    all_classes = get_class_names()
 
-    return render_template("history.html", 
+    html = render_template("history.html", 
                            weeks=weeks, 
                            selected_week=selected_week, 
                            selected_class=selected_class,
@@ -1844,6 +2923,7 @@ def history():
                            pie_data=json.dumps(pie_data),
                            bar_labels=json.dumps(bar_labels),
                            bar_data=json.dumps(bar_data))
+    return snapshot_page_response(html) if snap else html
 
 # --- THÊM ROUTE MỚI ĐỂ XUẤT EXCEL ---
 
@@ -1857,12 +2937,22 @@ def export_history():
         flash("Vui lòng chọn tuần để xuất báo cáo", "error")
         return redirect(url_for('history'))
 
-    # Truy vấn giống hệt bên trên
-    query = db.session.query(Violation).join(Student).filter(Violation.week_number == selected_week)
-    if selected_class:
-        query = query.filter(Student.student_class == selected_class)
-    
-    violations = query.order_by(Violation.date_committed.desc()).all()
+    snap = get_week_snapshot(selected_week)
+    if snap:
+        return snapshot_file_response(snap, lambda: build_history_export(selected_week, selected_class, snap))
+    return build_history_export(selected_week, selected_class)
+
+def build_history_export(selected_week, selected_class, snap=None):
+    """File Excel danh sách vi phạm 1 tuần (từ snapshot nếu tuần đã kết thúc)"""
+    if snap:
+        violations = snapshot_violations(snap.data, selected_class)
+    else:
+        # Truy vấn giống hệt bên trên
+        query = db.session.query(Violation).join(Student).options(contains_eager(Violation.student))\
+            .filter(Violation.week_number == selected_week)
+        if selected_class:
+            query = query.filter(Student.student_class == selected_class)
+        violations = query.order_by(Violation.date_committed.desc(), Violation.id.desc()).all()
     
     # Tạo dữ liệu cho Excel
     data = []
@@ -1879,7 +2969,7 @@ def export_history():
     
     # Xuất file
     if data:
-        df = pd.read_json(json.dumps(data))
+        df = pd.DataFrame(data)
     else:
         df = pd.DataFrame([{"Thông báo": "Không có dữ liệu vi phạm"}])
 
@@ -1905,77 +2995,75 @@ def export_history():
 @login_required
 def weekly_report():
     # 1. Lấy tuần hiện tại của hệ thống
-    w_cfg = SystemConfig.query.filter_by(key="current_week").first()
-    sys_week = int(w_cfg.value) if w_cfg else 1
+    sys_week = get_current_week()
     
     # 2. Lấy tuần được chọn từ URL (nếu không có thì mặc định là tuần hệ thống)
     selected_week = request.args.get('week', sys_week, type=int)
     
-    # 3. Lấy danh sách vi phạm chi tiết để hiện bảng
-    vios = db.session.query(Violation, Student).join(Student).filter(Violation.week_number == selected_week).all()
+    # 3. Lấy danh sách vi phạm chi tiết để hiện bảng + 4. Bảng xếp hạng thi đua (bỏ qua lớp chưa có học sinh)
+    snap = get_week_snapshot(selected_week)
+    if snap:
+        vios = [SimpleNamespace(Violation=v, Student=v.student) for v in snapshot_violations(snap.data)]
+        class_rankings = [r for r in snap.data['class_rankings'] if r['student_count'] > 0]
+    else:
+        vios = db.session.query(Violation, Student).join(Student).filter(Violation.week_number == selected_week).all()
+        class_rankings = get_class_rankings(selected_week, include_empty=False)
     
     total_errors = len(vios)
     total_points = sum(v.Violation.points_deducted for v in vios)
     
-    # 4. Tính toán Bảng xếp hạng (ĐÃ SỬA LOGIC)
-    all_classes = ClassRoom.query.all()
-    class_data = []
-    
-    for cls in all_classes:
-        # Lấy danh sách học sinh thực tế của lớp
-        students_in_class = Student.query.filter_by(student_class=cls.name).all()
-        student_count = len(students_in_class)
-        
-        # Bỏ qua nếu lớp không có học sinh (tránh chia cho 0)
-        if student_count == 0:
-            continue
-        
-        # Tính tổng điểm trừ của cả lớp trong tuần đó
-        weekly_deduct = db.session.query(func.sum(Violation.points_deducted))\
-            .join(Student)\
-            .filter(Student.student_class == cls.name, Violation.week_number == selected_week)\
-            .scalar() or 0
-        
-        # --- CÔNG THỨC CHUẨN: (Tổng điểm có sẵn - Tổng trừ) / Số lượng HS ---
-        HE_SO_PHAT = 15.0 
-        
-        # Công thức: 100 - (Điểm trừ trung bình * Hệ số)
-        avg_deduct = weekly_deduct / student_count
-        avg_score = 100 - (avg_deduct * HE_SO_PHAT)
-        
-        # Đảm bảo không bị âm điểm
-        if avg_score < 0: avg_score = 0
-        
-        class_data.append({
-            'name': cls.name,
-            'avg_score': round(avg_score, 2),
-            'weekly_deduct': weekly_deduct
-        })
-    
-    # Sắp xếp từ cao xuống thấp
-    class_rankings = sorted(class_data, key=lambda x: x['avg_score'], reverse=True)
-    
-    return render_template("weekly_report.html", 
+    html = render_template("weekly_report.html", 
                            violations=vios, 
                            selected_week=selected_week, 
                            system_week=sys_week, 
                            total_points=total_points, 
                            total_errors=total_errors, 
                            class_rankings=class_rankings)
+    return snapshot_page_response(html) if snap else html
 
 @app.route("/export_report")
 @login_required
 def export_report():
     week = request.args.get('week', type=int)
     if not week: return "Vui lòng chọn tuần", 400
-    violations = db.session.query(Violation, Student).join(Student).filter(Violation.week_number == week).all()
-    data = [{"Tên": r.Student.name, "Lớp": r.Student.student_class, "Lỗi": r.Violation.violation_type_name} for r in violations]
-    df = pd.read_json(json.dumps(data)) if data else pd.DataFrame([{"Thông báo": "Trống"}])
+    snap = get_week_snapshot(week)
+    if snap:
+        return snapshot_file_response(snap, lambda: build_report_export(week, snap))
+    return build_report_export(week)
+
+def build_report_export(week, snap=None):
+    """File Excel báo cáo tuần: danh sách vi phạm + bảng xếp hạng lớp (từ snapshot nếu tuần đã kết thúc)"""
+    if snap:
+        data = [{"Tên": v['name'], "Lớp": v['class'], "Lỗi": v['type']} for v in snap.data['violations']]
+        rankings = [r for r in snap.data['class_rankings'] if r['student_count'] > 0]
+    else:
+        violations = db.session.query(Violation, Student).join(Student).filter(Violation.week_number == week).all()
+        data = [{"Tên": r.Student.name, "Lớp": r.Student.student_class, "Lỗi": r.Violation.violation_type_name} for r in violations]
+        rankings = get_class_rankings(week, include_empty=False)
+    df = pd.DataFrame(data) if data else pd.DataFrame([{"Thông báo": "Trống"}])
+    df_rank = pd.DataFrame([{"Hạng": i, "Lớp": r['name'], "Sĩ số": r['student_count'], "Điểm trừ": r['weekly_deduct'], "Điểm TB": r['avg_score']}
+                            for i, r in enumerate(rankings, 1)])
     output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer: df.to_excel(writer, index=False)
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False)
+        if not df_rank.empty:
+            df_rank.to_excel(writer, index=False, sheet_name="Xep_Hang")
     output.seek(0)
     return send_file(output, download_name=f"Report_{week}.xlsx", as_attachment=True, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
+def get_student_weeks(student_id):
+    """
+    Các tuần học sinh có vi phạm / điểm cộng (mới nhất trước) - 1 truy vấn UNION chỉ quét chỉ mục
+    (student_id, week_number) của học sinh, không phụ thuộc tổng dữ liệu toàn trường.
+    """
+    weeks = union(
+        select(Violation.week_number).where(Violation.student_id == student_id),
+        select(BonusRecord.week_number).where(BonusRecord.student_id == student_id)
+    ).subquery()
+    return [w for (w,) in db.session.execute(
+        select(weeks.c.week_number).where(weeks.c.week_number.is_not(None)).order_by(weeks.c.week_number.desc())
+    )]
+
 # --- Thay thế hàm student_detail cũ ---
 @app.route("/student/<int:student_id>")
 @login_required
@@ -1990,14 +3078,11 @@ def student_detail(student_id):
         flash("Học sinh không tồn tại.", "error")
         return redirect(url_for('manage_students'))
 
-    # 1. Lấy danh sách các tuần có dữ liệu (từ cả violations và bonuses)
-    violation_weeks = [w[0] for w in db.session.query(Violation.week_number).distinct().all()]
-    bonus_weeks = [w[0] for w in db.session.query(BonusRecord.week_number).distinct().all()]
-    weeks = sorted(set(violation_weeks + bonus_weeks), reverse=True)
+    # 1. Lấy danh sách các tuần học sinh có dữ liệu (từ cả violations và bonuses)
+    weeks = get_student_weeks(student_id)
     
     # 2. Xác định tuần được chọn (Mặc định là tuần hiện tại của hệ thống)
-    w_cfg = SystemConfig.query.filter_by(key="current_week").first()
-    sys_current_week = int(w_cfg.value) if w_cfg else 1
+    sys_current_week = get_current_week()
     
     selected_week = request.args.get('week', type=int)
     if not selected_week:
@@ -2011,33 +3096,23 @@ def student_detail(student_id):
     bonuses = BonusRecord.query.filter_by(student_id=student_id, week_number=selected_week)\
         .order_by(BonusRecord.date_awarded.asc()).all()
 
-    # 5. Tính toán dữ liệu biểu đồ (Reset về 100 mỗi đầu tuần)
+    # 5. Dữ liệu biểu đồ: đọc thẳng điểm lũy kế trong sổ điểm của tuần (Reset về 100 mỗi đầu tuần)
     chart_labels = ["Đầu tuần"]
-    chart_scores = [100]
-    
-    # Kết hợp violations và bonuses theo thời gian
-    events = []
-    for v in violations:
-        events.append({'type': 'violation', 'date': v.date_committed, 'points': -v.points_deducted, 'name': v.violation_type_name})
-    for b in bonuses:
-        events.append({'type': 'bonus', 'date': b.date_awarded, 'points': b.points_added, 'name': b.bonus_type_name})
-    
-    # Sắp xếp theo thời gian
-    events.sort(key=lambda x: x['date'])
+    chart_scores = [SCORE_BASE]
     
-    current_score = 100
-    for event in events:
-        current_score += event['points']  # -points cho violation, +points cho bonus
-        date_str = event['date'].strftime('%d/%m')
-        chart_labels.append(date_str)
-        chart_scores.append(current_score)
+    entries = db.session.query(ScoreLedger.created_at, ScoreLedger.running_total)\
+        .filter(ScoreLedger.student_id == student_id, ScoreLedger.week_number == selected_week,
+                ScoreLedger.event_type != 'reset')\
+        .order_by(ScoreLedger.id).all()
+    for created_at, running_total in entries:
+        chart_labels.append(created_at.strftime('%d/%m'))
+        chart_scores.append(running_total)
     
     # Tính tổng
-    total_deducted = sum(v.points_deducted for v in violations)
     total_added = sum(b.points_added for b in bonuses)
     
-    # Điểm hiển thị trên thẻ (Score Card)
-    display_score = 100 - total_deducted + total_added
+    # Điểm hiển thị trên thẻ (Score Card) = dòng cuối của tuần trong sổ
+    display_score = chart_scores[-1]
 
     # Cảnh báo nếu điểm thấp
     warning = None
@@ -2057,6 +3132,36 @@ def student_detail(student_id):
                            warning=warning)
 
 
+@app.route("/api/students/<int:student_id>/score")
+@login_required
+def student_score_api(student_id):
+    """
+    Điểm nề nếp của học sinh tại 1 thời điểm (?as_of=YYYY-MM-DD hoặc ISO datetime, mặc định: hiện tại)
+    - đọc 1 dòng trong sổ điểm.
+    """
+    if not can_access_student(student_id):
+        return jsonify({"error": "Không có quyền truy cập học sinh này"}), 403
+    
+    as_of = request.args.get('as_of', '').strip()
+    try:
+        when = datetime.datetime.fromisoformat(as_of) if as_of else datetime.datetime.utcnow()
+    except ValueError:
+        return jsonify({"error": "as_of không hợp lệ (YYYY-MM-DD hoặc YYYY-MM-DDTHH:MM)"}), 400
+    if as_of and len(as_of) == 10:
+        when = when.replace(hour=23, minute=59, second=59)  # Cả ngày as_of
+    
+    entry = get_score_as_of(student_id, when)
+    if not entry:
+        return jsonify({"student_id": student_id, "as_of": when.isoformat(), "score": None, "week_number": None})
+    return jsonify({
+        "student_id": student_id,
+        "as_of": when.isoformat(),
+        "score": entry.running_total,
+        "week_number": entry.week_number,
+        "event_type": entry.event_type,
+        "recorded_at": entry.created_at.isoformat()
+    })
+
 # --- Thay thế hàm api generate_report cũ (Cập nhật cho Ollama & Context Tuần) ---
 @app.route("/api/generate_report/<int:student_id>", methods=["POST"])
 @login_required
@@ -2145,12 +3250,12 @@ def manage_subjects():
             num_hk_columns=num_hk
         )
         db.session.add(subject)
+        invalidate_reference_cache()
         db.session.commit()
         flash(f"Đã thêm môn {name}", "success")
         return redirect(url_for("manage_subjects"))
     
-    subjects = Subject.query.order_by(Subject.name).all()
-    return render_template("manage_subjects.html", subjects=subjects)
+    return render_template("manage_subjects.html", subjects=get_subjects())
 
 @app.route("/edit_subject/<int:subject_id>", methods=["GET", "POST"])
 @login_required
@@ -2169,6 +3274,7 @@ def edit_subject(subject_id):
         subject.num_gk_columns = int(request.form.get("num_gk_columns", 1))
         subject.num_hk_columns = int(request.form.get("num_hk_columns", 1))
         
+        invalidate_reference_cache()
         db.session.commit()
         flash("Đã cập nhật môn học!", "success")
         return redirect(url_for("manage_subjects"))
@@ -2182,6 +3288,7 @@ def delete_subject(subject_id):
     subject = db.session.get(Subject, subject_id)
     if subject:
         db.session.delete(subject)
+        invalidate_reference_cache()
         db.session.commit()
         flash("Đã xóa môn học!", "success")
     return redirect(url_for("manage_subjects"))
@@ -2193,17 +3300,34 @@ def manage_grades():
     search = request.args.get('search', '').strip()
     selected_class = request.args.get('class_select', '').strip()
     
-    q = get_accessible_students()  # Filter by role
-    if selected_class:
-        q = q.filter_by(student_class=selected_class)
-    if search:
-        q = q.filter(or_(
-            Student.name.ilike(f"%{search}%"),
-            Student.student_code.ilike(f"%{search}%")
-        ))
-    
-    students = q.order_by(Student.student_code.asc()).all()
-    return render_template("manage_grades.html", students=students, search_query=search, selected_class=selected_class)
+    q = filter_students(get_accessible_students(), selected_class, search)  # Filter by role
+    page = paginate_students(q, after=request.args.get('after'), before=request.args.get('before'))
+    return render_template("manage_grades.html", students=page['items'], page=page,
+                           pager_args={'search': search, 'class_select': selected_class},
+                           search_query=search, selected_class=selected_class)
+
+@app.route("/api/students")
+@login_required
+def students_api():
+    """
+    API danh sách học sinh (phân trang keyset) cho tải dần / ô tìm kiếm
+    Query: search, class_select, after, limit (tối đa 200)
+    """
+    limit = min(max(request.args.get('limit', STUDENT_PAGE_SIZE, type=int), 1), 200)
+    q = filter_students(get_accessible_students(),
+                        request.args.get('class_select', '').strip(),
+                        request.args.get('search', '').strip())
+    page = paginate_students(q, after=request.args.get('after'), limit=limit)
+    return jsonify({
+        "students": [{
+            "id": s.id,
+            "student_code": s.student_code,
+            "name": s.name,
+            "student_class": s.student_class,
+            "current_score": s.current_score
+        } for s in page['items']],
+        "next_cursor": page['next_cursor']
+    })
 
 @app.route("/student_grades/<int:student_id>", methods=["GET", "POST"])
 @login_required
@@ -2276,6 +3400,7 @@ def student_grades(student_id):
             log_change('grade', f'Thêm điểm {grade_type} môn {subject_name}: {score_float}', student_id=student_id, student_name=student.name, student_class=student.student_class, new_value=score_float)
             flash("Đã thêm điểm!", "success")
         
+        refresh_subject_averages([(student_id, subject_id, semester, school_year)])
         db.session.commit()
         
         # Thông báo cho GVCN lớp
@@ -2293,7 +3418,7 @@ def student_grades(student_id):
         
         return redirect(url_for("student_grades", student_id=student_id))
     
-    subjects = Subject.query.order_by(Subject.name).all()
+    subjects = get_subjects()
     semester = int(request.args.get('semester', 1))
     school_year = request.args.get('school_year', '2023-2024')
     
@@ -2328,6 +3453,663 @@ def student_grades(student_id):
         assigned_subject_id=assigned_subject_id
     )
 
+def _gradebook_columns(subject, observed):
+    """Danh sách cột điểm của 1 môn: TX1..TXn, GK, HK (đánh số nếu có nhiều cột)"""
+    columns = []
+    limits = {'TX': subject.num_tx_columns or 0, 'GK': subject.num_gk_columns or 0, 'HK': subject.num_hk_columns or 0}
+    for grade_type in ('TX', 'GK', 'HK'):
+        count = max([limits[grade_type]] + [idx for t, idx in observed if t == grade_type])
+        for idx in range(1, count + 1):
+            label = grade_type if count == 1 and grade_type != 'TX' else f"{grade_type}{idx}"
+            columns.append((grade_type, idx, label))
+    return columns
+
+def build_class_gradebook(class_name, semester, school_year, subject_id=None):
+    """
+    Dựng bảng điểm cả lớp dạng ma trận học sinh x môn x (cột TX, GK, HK, TB).
+    Toàn bộ điểm được lấy bằng 1 truy vấn Student LEFT JOIN Grade rồi pivot bằng pandas,
+    TB môn đọc từ bảng SubjectAverage (1 truy vấn) - trùng khớp với học bạ / xếp hạng.
+    
+    Args:
+        class_name (str): Tên lớp
+        semester (int): Học kỳ
+        school_year (str): Năm học
+        subject_id (int, optional): Chỉ lấy 1 môn
+    
+    Returns:
+        dict: {
+            'students': [{'id', 'student_code', 'name'}],
+            'subjects': [{'id', 'name', 'columns': [label, ..., 'TB']}],
+            'scores': {student_id: {subject_id: {label: score}}}
+        }
+    """
+    subjects_q = Subject.query.order_by(Subject.name)
+    if subject_id:
+        subjects_q = subjects_q.filter(Subject.id == subject_id)
+    subjects = subjects_q.all()
+    
+    grade_join = [Grade.student_id == Student.id, Grade.semester == semester, Grade.school_year == school_year]
+    if subject_id:
+        grade_join.append(Grade.subject_id == subject_id)
+    
+    rows = get_accessible_students().filter(Student.student_class == class_name)\
+        .outerjoin(Grade, and_(*grade_join))\
+        .with_entities(Student.id, Student.student_code, Student.name,
+                       Grade.subject_id, Grade.grade_type, Grade.column_index, Grade.score)\
+        .order_by(Student.student_code.asc()).all()
+    
+    df = pd.DataFrame(rows, columns=['student_id', 'student_code', 'name', 'subject_id', 'grade_type', 'column_index', 'score'])
+    students = df[['student_id', 'student_code', 'name']].drop_duplicates('student_id')
+    grades = df.dropna(subset=['subject_id']).fillna({'column_index': 1})\
+        .astype({'subject_id': 'int64', 'column_index': 'int64'})
+    
+    if grades.empty:
+        matrix = pd.DataFrame(index=students['student_id'])
+    else:
+        matrix = grades.pivot_table(index='student_id', columns=['subject_id', 'grade_type', 'column_index'],
+                                    values='score', aggfunc='first')
+        matrix = matrix.reindex(students['student_id'])
+    
+    student_ids = [int(sid) for sid in students['student_id']]
+    avg_q = db.session.query(SubjectAverage.student_id, SubjectAverage.subject_id, SubjectAverage.subject_avg).filter(
+        SubjectAverage.student_id.in_(student_ids),
+        SubjectAverage.semester == semester,
+        SubjectAverage.school_year == school_year
+    )
+    if subject_id:
+        avg_q = avg_q.filter(SubjectAverage.subject_id == subject_id)
+    avg_map = {(st, sub): avg for st, sub, avg in avg_q.all()} if student_ids else {}
+    
+    observed = {}
+    for sub_id, grade_type, idx in matrix.columns:
+        observed.setdefault(sub_id, set()).add((grade_type, idx))
+    
+    subjects_info = []
+    scores = {int(sid): {} for sid in students['student_id']}
+    for subject in subjects:
+        columns = _gradebook_columns(subject, observed.get(subject.id, set()))
+        subjects_info.append({'id': subject.id, 'name': subject.name, 'columns': [c[2] for c in columns] + ['TB']})
+        
+        # Lấy các cột của môn (cột chưa có điểm -> NaN)
+        keys = [(subject.id, t, i) for t, i, _ in columns]
+        sub_frame = matrix.reindex(columns=keys) if len(matrix.columns) else pd.DataFrame(index=matrix.index, columns=keys, dtype=float)
+        
+        for sid, values in zip(sub_frame.index, sub_frame.itertuples(index=False)):
+            cell = {label: (None if pd.isna(v) else float(v)) for (_, _, label), v in zip(columns, values)}
+            cell['TB'] = avg_map.get((int(sid), subject.id))
+            scores[int(sid)][subject.id] = cell
+    
+    return {
+        'students': [{'id': int(r.student_id), 'student_code': r.student_code, 'name': r.name} for r in students.itertuples()],
+        'subjects': subjects_info,
+        'scores': scores
+    }
+
+def _gradebook_params():
+    """Đọc tham số lọc chung cho các route bảng điểm lớp"""
+    class_name = request.args.get('class_select', '').strip()
+    if not class_name and current_user.role == 'homeroom_teacher' and current_user.assigned_class:
+        class_name = current_user.assigned_class
+    semester = request.args.get('semester', 1, type=int)
+    school_year = request.args.get('school_year', '2023-2024')
+    subject_id = request.args.get('subject_id', type=int)
+    return class_name, semester, school_year, subject_id
+
+@app.route("/class_gradebook")
+@login_required
+def class_gradebook():
+    """Bảng điểm cả lớp (ma trận học sinh x môn)"""
+    class_name, semester, school_year, subject_id = _gradebook_params()
+    gradebook = build_class_gradebook(class_name, semester, school_year, subject_id) if class_name else None
+    subjects = get_subjects()
+    can_edit = bool(gradebook and subject_id and can_access_subject(subject_id))
+    return render_template("class_gradebook.html",
+                           gradebook=gradebook,
+                           can_edit=can_edit,
+                           subjects=subjects,
+                           selected_class=class_name,
+                           selected_subject_id=subject_id,
+                           semester=semester,
+                           school_year=school_year)
+
+@app.route("/api/class_gradebook")
+@login_required
+def class_gradebook_api():
+    """API JSON bảng điểm cả lớp"""
+    class_name, semester, school_year, subject_id = _gradebook_params()
+    if not class_name:
+        return jsonify({"error": "Vui lòng chọn lớp"}), 400
+    gradebook = build_class_gradebook(class_name, semester, school_year, subject_id)
+    # JSON chỉ nhận key dạng chuỗi
+    gradebook['scores'] = {str(sid): {str(sub): cell for sub, cell in subs.items()} for sid, subs in gradebook['scores'].items()}
+    return jsonify({
+        "class_name": class_name,
+        "semester": semester,
+        "school_year": school_year,
+        **gradebook
+    })
+
+@app.route("/export_class_gradebook")
+@login_required
+def export_class_gradebook():
+    """Xuất bảng điểm cả lớp ra file Excel"""
+    class_name, semester, school_year, subject_id = _gradebook_params()
+    if not class_name:
+        flash("Vui lòng chọn lớp để xuất bảng điểm", "error")
+        return redirect(url_for('class_gradebook'))
+    gradebook = build_class_gradebook(class_name, semester, school_year, subject_id)
+    
+    data = []
+    for st in gradebook['students']:
+        row = {"Mã HS": st['student_code'], "Họ Tên": st['name']}
+        for sub in gradebook['subjects']:
+            cell = gradebook['scores'][st['id']][sub['id']]
+            for label in sub['columns']:
+                row[f"{sub['name']} - {label}"] = cell.get(label)
+        data.append(row)
+    df = pd.DataFrame(data) if data else pd.DataFrame([{"Thông báo": "Không có học sinh"}])
+    
+    sheet_name = f"HK{semester}"
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name=sheet_name)
+        writer.sheets[sheet_name].freeze_panes = "C2"
+    output.seek(0)
+    
+    filename = f"BangDiem_{class_name}_HK{semester}_{school_year}.xlsx".replace(" ", "_")
+    return send_file(output, download_name=filename, as_attachment=True, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+GRADE_TYPES = ('TX', 'GK', 'HK')
+
+def upsert_grades(cells, semester, school_year):
+    """
+    Thêm/cập nhật nhiều ô điểm trong 1 transaction.
+    - Kiểm tra quyền môn học (can_access_subject) 1 lần cho mỗi môn
+    - Kiểm tra quyền học sinh bằng 1 truy vấn IN qua get_accessible_students()
+    - Lấy trước toàn bộ điểm đã có bằng 1 truy vấn, ghi ChangeLog hàng loạt
+    - Gửi 1 thông báo tổng hợp cho GVCN mỗi lớp
+    Nếu có ô không hợp lệ thì không ghi gì cả.
+    
+    Args:
+        cells: List[dict] với các key student_id, subject_id, grade_type, column_index, score
+        semester (int): Học kỳ
+        school_year (str): Năm học
+    
+    Returns:
+        dict: {'created': int, 'updated': int, 'unchanged': int, 'errors': List[str]}
+    """
+    result = {'created': 0, 'updated': 0, 'unchanged': 0, 'errors': []}
+    errors = result['errors']
+    
+    # 1. Chuẩn hóa & kiểm tra dữ liệu từng ô
+    parsed = {}
+    cell_numbers = {}  # key -> số thứ tự ô (để báo lỗi giới hạn cột)
+    for idx, cell in enumerate(cells):
+        try:
+            column_index = cell.get('column_index')
+            key = (int(cell['student_id']), int(cell['subject_id']), str(cell['grade_type']).upper(),
+                   1 if column_index is None else int(column_index))
+            score = float(cell['score'])
+        except (KeyError, TypeError, ValueError):
+            errors.append(f"Ô {idx+1}: Dữ liệu không hợp lệ")
+            continue
+        if key[2] not in GRADE_TYPES:
+            errors.append(f"Ô {idx+1}: Loại điểm '{key[2]}' không hợp lệ")
+        elif key[3] < 1:
+            errors.append(f"Ô {idx+1}: Số thứ tự cột điểm phải từ 1")
+        elif not 0 <= score <= 10:  # NaN / inf cũng bị loại
+            errors.append(f"Ô {idx+1}: Điểm phải từ 0 đến 10")
+        else:
+            parsed[key] = score  # Ô trùng nhau -> lấy giá trị sau cùng
+            cell_numbers[key] = idx + 1
+    
+    subject_ids = {k[1] for k in parsed}
+    student_ids = {k[0] for k in parsed}
+    
+    # 2. Quyền môn học & giới hạn số cột
+    subjects = {s.id: s for s in Subject.query.filter(Subject.id.in_(subject_ids)).all()} if subject_ids else {}
+    for sub_id in subject_ids:
+        if sub_id not in subjects:
+            errors.append(f"Không tìm thấy môn học id={sub_id}")
+        elif not can_access_subject(sub_id):
+            errors.append(f"Bạn không có quyền sửa điểm môn {subjects[sub_id].name}!")
+    for key in parsed:
+        st_id, sub_id, grade_type, col = key
+        subject = subjects.get(sub_id)
+        if not subject:
+            continue
+        limit = getattr(subject, f"num_{grade_type.lower()}_columns") or 0
+        if col > limit:
+            errors.append(f"Ô {cell_numbers[key]}: Môn {subject.name} chỉ có {limit} cột {grade_type} (nhận cột {col})")
+    
+    # 3. Quyền học sinh
+    students = {s.id: s for s in get_accessible_students().filter(Student.id.in_(student_ids)).all()} if student_ids else {}
+    missing = student_ids - set(students)
+    if missing:
+        errors.append(f"Không tìm thấy hoặc không có quyền với học sinh id: {', '.join(str(i) for i in sorted(missing))}")
+    
+    if errors or not parsed:
+        return result
+    
+    # 4. Lấy trước điểm đã có
+    existing = Grade.query.filter(
+        Grade.student_id.in_(student_ids),
+        Grade.subject_id.in_(subject_ids),
+        Grade.semester == semester,
+        Grade.school_year == school_year
+    ).all()
+    existing = {(g.student_id, g.subject_id, g.grade_type, g.column_index): g for g in existing}
+    
+    # 5. Upsert
+    changed_by_id = current_user.id if current_user.is_authenticated else None
+    now = datetime.datetime.utcnow()
+    logs = []
+    avg_keys = set()
+    changes_by_class = {}
+    for (st_id, sub_id, grade_type, col), score in parsed.items():
+        student = students[st_id]
+        subject_name = subjects[sub_id].name
+        grade = existing.get((st_id, sub_id, grade_type, col))
+        if grade:
+            if grade.score == score:
+                result['unchanged'] += 1
+                continue
+            old_score = grade.score
+            grade.score = score
+            result['updated'] += 1
+            change_type = 'grade_update'
+            description = f'Cập nhật điểm {grade_type} môn {subject_name}: {old_score} → {score}'
+        else:
+            db.session.add(Grade(
+                student_id=st_id,
+                subject_id=sub_id,
+                grade_type=grade_type,
+                column_index=col,
+                score=score,
+                semester=semester,
+                school_year=school_year
+            ))
+            old_score = None
+            result['created'] += 1
+            change_type = 'grade'
+            description = f'Thêm điểm {grade_type} môn {subject_name}: {score}'
+        
+        logs.append(dict(
+            changed_by_id=changed_by_id,
+            change_type=change_type,
+            student_id=st_id,
+            student_name=student.name,
+            student_class=student.student_class,
+            description=description,
+            old_value=str(old_score) if old_score is not None else None,
+            new_value=str(score),
+            created_at=now
+        ))
+        avg_keys.add((st_id, sub_id, semester, school_year))
+        if student.student_class:
+            changes_by_class.setdefault(student.student_class, set()).add(subject_name)
+    
+    if not logs:
+        return result
+    
+    db.session.bulk_insert_mappings(ChangeLog, logs)
+    refresh_subject_averages(avg_keys)
+    db.session.commit()
+    
+    # 6. Thông báo tổng hợp cho GVCN từng lớp
+    for class_name, subject_names in changes_by_class.items():
+        try:
+            create_notification(
+                title=f"📊 Điểm mới - Lớp {class_name}",
+                message=f"{current_user.full_name} đã nhập điểm {', '.join(sorted(subject_names))} cho học sinh lớp {class_name}",
+                notification_type='grade',
+                target_role=class_name
+            )
+        except:
+            pass  # Không để lỗi notification làm gián đoạn
+    
+    return result
+
+@app.route("/api/bulk_update_grades", methods=["POST"])
+@login_required
+def bulk_update_grades_api():
+    """
+    API nhập điểm hàng loạt (VD: cả 1 cột điểm của lớp)
+    Body: {"semester": 1, "school_year": "2023-2024", "cells": [{student_id, subject_id, grade_type, column_index, score}]}
+    """
+    data = request.get_json() or {}
+    cells = data.get("cells") or []
+    if not cells:
+        return jsonify({"success": False, "error": "Không có điểm để lưu"}), 400
+    try:
+        semester = int(data.get("semester", 1))
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "error": "Học kỳ không hợp lệ"}), 400
+    school_year = data.get("school_year", "2023-2024")
+    
+    try:
+        result = upsert_grades(cells, semester, school_year)
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"success": False, "error": str(e)}), 500
+    
+    if result['errors']:
+        return jsonify({"success": False, **result}), 400
+    return jsonify({"success": True, **result})
+
+GRADE_COLUMN_PATTERN = r'^(TX|GK|HK)\s*([1-9]\d*)?$'
+
+def parse_grade_sheet(filepath, subject, class_name=None):
+    """
+    Đọc & kiểm tra file Excel điểm của 1 môn (mỗi dòng 1 học sinh, cột Mã HS + TX1..TXn/GK/HK).
+    File có thể gồm nhiều sheet (VD: mỗi lớp 1 sheet). Toàn bộ kiểm tra được làm trên DataFrame:
+    điểm không phải số / ngoài khoảng 0-10, cột vượt quá số cột của môn, mã HS không tồn tại.
+    
+    Returns:
+        dict: {
+            'columns': [label],
+            'rows': [{'student_code', 'name', 'class', 'values': {label: (text, is_error)}, 'error'}],
+            'cells': [{student_id, subject_id, grade_type, column_index, score}],
+            'errors': [str]
+        }
+    """
+    sheets = pd.read_excel(filepath, sheet_name=None, dtype=object)
+    df = pd.concat([s for s in sheets.values() if not s.empty], ignore_index=True) if sheets else pd.DataFrame()
+    result = {'columns': [], 'rows': [], 'cells': [], 'errors': []}
+    errors = result['errors']
+    
+    df.columns = [str(c).strip() for c in df.columns]
+    code_col = next((c for c in df.columns if "mã" in c.lower() or "code" in c.lower()), None)
+    grade_cols = {c: re.match(GRADE_COLUMN_PATTERN, c.upper()) for c in df.columns}
+    grade_cols = {c: (m.group(1), int(m.group(2) or 1)) for c, m in grade_cols.items() if m}
+    if not code_col or not grade_cols:
+        errors.append("File Excel cần có cột 'Mã học sinh' và các cột điểm TX1, TX2, ..., GK, HK")
+        return result
+    
+    # Cột số thứ tự 0 (TX0, GK00...) / 2 tiêu đề cùng 1 cột điểm (TX và TX1) -> ghi đè lẫn nhau
+    for col in df.columns:
+        if re.match(r'^(TX|GK|HK)\s*0\d*$', col.upper()):
+            errors.append(f"Cột '{col}': số thứ tự cột điểm phải bắt đầu từ 1")
+    seen = {}
+    for col, key in grade_cols.items():
+        if key in seen:
+            errors.append(f"Cột '{col}' trùng với cột '{seen[key]}' ({key[0]}{key[1]})")
+        seen.setdefault(key, col)
+    
+    # Giới hạn số cột theo cấu hình môn học
+    for col, (grade_type, idx) in grade_cols.items():
+        limit = getattr(subject, f"num_{grade_type.lower()}_columns") or 0
+        if idx > limit:
+            errors.append(f"Cột '{col}': Môn {subject.name} chỉ có {limit} cột {grade_type}")
+    
+    df[code_col] = df[code_col].astype(str).str.strip()
+    df = df[~df[code_col].str.lower().isin(['', 'nan', 'none'])].reset_index(drop=True)
+    labels = list(grade_cols)
+    result['columns'] = labels
+    
+    # Điểm: ô trống bỏ qua, ô có chữ hoặc ngoài khoảng 0-10 là lỗi
+    raw = df[labels]
+    blank = raw.isna() | raw.astype(str).apply(lambda s: s.str.strip() == '')
+    scores = raw.apply(lambda s: pd.to_numeric(s.astype(str).str.strip().str.replace(',', '.'), errors='coerce')).where(~blank)
+    bad = ~blank & (scores.isna() | (scores < 0) | (scores > 10))
+    if bad.any().any():
+        errors.append(f"Có {int(bad.sum().sum())} ô điểm không hợp lệ (phải là số từ 0 đến 10)")
+    
+    # Mã học sinh: trùng trong file / không tồn tại hoặc không có quyền
+    dup = df[code_col].duplicated(keep=False)
+    if dup.any():
+        errors.append(f"Mã học sinh bị lặp: {', '.join(sorted(set(df.loc[dup, code_col])))}")
+    
+    students_q = get_accessible_students().filter(Student.student_code.in_(df[code_col].unique().tolist()))
+    if class_name:
+        students_q = students_q.filter(Student.student_class == class_name)
+    students = pd.DataFrame(
+        students_q.with_entities(Student.id, Student.student_code, Student.name, Student.student_class).all(),
+        columns=['student_id', 'student_code', 'name', 'class']
+    )
+    matched = df[[code_col]].merge(students, how='left', left_on=code_col, right_on='student_code')
+    unknown = matched['student_id'].isna()
+    if unknown.any():
+        scope = f" trong lớp {class_name}" if class_name else ""
+        errors.append(f"Không tìm thấy {int(unknown.sum())} mã học sinh{scope}: {', '.join(df.loc[unknown, code_col].head(10))}")
+    
+    # Dữ liệu xem trước
+    text = raw.astype(str).where(~blank, '')
+    for i in range(len(df)):
+        result['rows'].append({
+            'student_code': df.at[i, code_col],
+            'name': matched.at[i, 'name'] if not unknown[i] else None,
+            'class': matched.at[i, 'class'] if not unknown[i] else None,
+            'values': {c: (text.at[i, c], bool(bad.at[i, c])) for c in labels},
+            'error': bool(unknown[i] or dup[i])
+        })
+    
+    if errors:
+        return result
+    
+    # Chuyển sang dạng dài (1 ô điểm / dòng) để upsert
+    long_df = scores.assign(student_id=matched['student_id'].astype('int64'))\
+        .melt(id_vars='student_id', var_name='label', value_name='score').dropna(subset=['score'])
+    for st_id, label, score in long_df.itertuples(index=False):
+        grade_type, idx = grade_cols[label]
+        result['cells'].append({
+            'student_id': st_id, 'subject_id': subject.id,
+            'grade_type': grade_type, 'column_index': idx, 'score': float(score)
+        })
+    return result
+
+@app.route("/import_grades", methods=["GET", "POST"])
+@login_required
+def import_grades():
+    """Bước 1: Tải lên file Excel điểm và xem trước"""
+    subjects = get_subjects()
+    if current_user.role == 'subject_teacher' and current_user.assigned_subject_id:
+        subjects = [s for s in subjects if s.id == current_user.assigned_subject_id]
+    class_list = get_class_names()
+    
+    if request.method == "POST":
+        file = request.files.get("file")
+        subject = db.session.get(Subject, request.form.get("subject_id", type=int) or 0)
+        semester = request.form.get("semester", 1, type=int)
+        school_year = request.form.get("school_year", "2023-2024").strip()
+        class_name = request.form.get("class_select", "").strip() or None
+        
+        if not file:
+            flash("Vui lòng chọn file Excel!", "error")
+            return redirect(request.url)
+        if not subject or not can_access_subject(subject.id):
+            flash("Vui lòng chọn môn học bạn được phân công!", "error")
+            return redirect(request.url)
+        
+        try:
+            if not os.path.exists("uploads"):
+                os.makedirs("uploads")
+            filepath = os.path.join("uploads", f"import_grades_{uuid.uuid4().hex[:8]}.xlsx")
+            file.save(filepath)
+            
+            preview = parse_grade_sheet(filepath, subject, class_name)
+            if not preview['rows'] and preview['errors']:
+                os.remove(filepath)
+                for err in preview['errors']:
+                    flash(err, "error")
+                return redirect(request.url)
+            
+            return render_template("confirm_import_grades.html",
+                                   preview=preview,
+                                   subject=subject,
+                                   semester=semester,
+                                   school_year=school_year,
+                                   class_name=class_name,
+                                   file_path=filepath)
+        except Exception as e:
+            flash(f"Lỗi đọc file: {str(e)}", "error")
+            return redirect(request.url)
+    
+    return render_template("import_grades.html", subjects=subjects, class_list=class_list)
+
+@app.route("/download_grade_template")
+@login_required
+def download_grade_template():
+    """Tải file mẫu nhập điểm: nếu chọn lớp thì điền sẵn danh sách HS và điểm hiện có"""
+    subject = db.session.get(Subject, request.args.get("subject_id", type=int) or 0) or Subject.query.order_by(Subject.name).first()
+    if not subject:
+        flash("Chưa có môn học nào", "error")
+        return redirect(url_for('import_grades'))
+    class_name = request.args.get("class_select", "").strip()
+    semester = request.args.get("semester", 1, type=int)
+    school_year = request.args.get("school_year", "2023-2024")
+    
+    if class_name:
+        gradebook = build_class_gradebook(class_name, semester, school_year, subject.id)
+        labels = gradebook['subjects'][0]['columns'][:-1]
+        data = [{'Mã học sinh': st['student_code'], 'Họ và tên': st['name'],
+                 **{label: gradebook['scores'][st['id']][subject.id].get(label) for label in labels}}
+                for st in gradebook['students']]
+        df = pd.DataFrame(data, columns=['Mã học sinh', 'Họ và tên'] + labels)
+    else:
+        labels = [c[2] for c in _gradebook_columns(subject, set())]
+        df = pd.DataFrame({'Mã học sinh': ['36 ANHA - 001001'], 'Họ và tên': ['Nguyễn Văn A'],
+                           **{label: [None] for label in labels}})
+    
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name=(class_name or 'Bảng điểm')[:31])
+    output.seek(0)
+    
+    filename = f"mau_nhap_diem_{subject.code}_{class_name or 'lop'}_HK{semester}.xlsx".replace(" ", "_")
+    return send_file(output, download_name=filename, as_attachment=True, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+@app.route("/save_imported_grades", methods=["POST"])
+@login_required
+def save_imported_grades():
+    """Bước 2: Lưu điểm vào CSDL sau khi xác nhận"""
+    filepath = request.form.get("file_path")
+    if not filepath or not os.path.exists(filepath) or not os.path.basename(filepath).startswith("import_grades_"):
+        flash("File nhập liệu không tồn tại hoặc đã hết hạn. Vui lòng thử lại.", "error")
+        return redirect(url_for('import_grades'))
+    subject = db.session.get(Subject, request.form.get("subject_id", type=int) or 0)
+    semester = request.form.get("semester", 1, type=int)
+    school_year = request.form.get("school_year", "2023-2024")
+    class_name = request.form.get("class_name") or None
+    if not subject or not can_access_subject(subject.id):
+        flash("Bạn không có quyền nhập điểm môn này!", "error")
+        return redirect(url_for('import_grades'))
+    
+    try:
+        preview = parse_grade_sheet(filepath, subject, class_name)
+        errors = preview['errors']
+        result = upsert_grades(preview['cells'], semester, school_year) if not errors else None
+        if result:
+            errors = result['errors']
+        if errors:
+            for err in errors:
+                flash(err, "error")
+            return redirect(url_for('import_grades'))
+        
+        os.remove(filepath)
+        flash(f"Kết quả nhập điểm môn {subject.name}: Thêm mới {result['created']}, cập nhật {result['updated']}, không đổi {result['unchanged']} ô điểm.", "success")
+        return redirect(url_for('manage_grades'))
+    except Exception as e:
+        db.session.rollback()
+        flash(f"Lỗi khi lưu: {str(e)}", "error")
+        return redirect(url_for('import_grades'))
+
+# === PHỔ ĐIỂM MÔN HỌC ===
+
+DISTRIBUTION_BINS = np.linspace(0, 10, 11)  # 10 khoảng [0,1), [1,2), ..., [9,10]
+_distribution_cache = {}
+_distribution_cache_lock = threading.Lock()
+
+def build_subject_distribution(subject_id, semester, school_year):
+    """
+    Phổ điểm 1 môn theo lớp và loại điểm (TX, GK, HK), tính trong 1 lượt đọc bảng Grade:
+    gán khoảng điểm cho toàn bộ điểm bằng numpy rồi gom nhóm bằng pandas.
+    std là độ lệch chuẩn tổng thể (ddof=0). Nhóm có class_name=None là toàn trường.
+    
+    Returns:
+        dict: {
+            'bins': [nhãn khoảng],
+            'groups': [{'class_name', 'grade_type', 'count', 'mean', 'median', 'std', 'min', 'max', 'histogram'}]
+        }
+    """
+    labels = [f"{int(lo)}-{int(hi)}" for lo, hi in zip(DISTRIBUTION_BINS[:-1], DISTRIBUTION_BINS[1:])]
+    rows = db.session.query(Student.student_class, Grade.grade_type, Grade.score)\
+        .join(Student, Grade.student_id == Student.id)\
+        .filter(Grade.subject_id == subject_id, Grade.semester == semester, Grade.school_year == school_year).all()
+    df = pd.DataFrame(rows, columns=['class_name', 'grade_type', 'score'])
+    if df.empty:
+        return {'bins': labels, 'groups': []}
+    
+    # Điểm 10 thuộc khoảng cuối
+    df['bin'] = np.clip(np.digitize(df['score'].to_numpy(), DISTRIBUTION_BINS) - 1, 0, len(labels) - 1)
+    full = pd.concat([df.assign(class_name=''), df], ignore_index=True)  # '' = toàn trường
+    
+    grouped = full.groupby(['class_name', 'grade_type'])['score']
+    stats = grouped.agg(['count', 'mean', 'median', 'min', 'max'])
+    stats['std'] = grouped.std(ddof=0)
+    hist = full.groupby(['class_name', 'grade_type', 'bin']).size()\
+        .unstack('bin', fill_value=0).reindex(columns=range(len(labels)), fill_value=0)
+    
+    type_order = {t: i for i, t in enumerate(GRADE_TYPES)}
+    keys = sorted(stats.index, key=lambda k: (k[0], type_order.get(k[1], len(type_order))))
+    groups = []
+    for class_name, grade_type in keys:
+        st = stats.loc[(class_name, grade_type)]
+        groups.append({
+            'class_name': class_name or None,
+            'grade_type': grade_type,
+            'count': int(st['count']),
+            'mean': round(float(st['mean']), 2),
+            'median': round(float(st['median']), 2),
+            'std': round(float(st['std']), 2),
+            'min': float(st['min']),
+            'max': float(st['max']),
+            'histogram': [int(v) for v in hist.loc[(class_name, grade_type)]]
+        })
+    return {'bins': labels, 'groups': groups}
+
+def get_subject_distribution(subject_id, semester, school_year):
+    """Phổ điểm (đã cache) của 1 môn; cache bị bỏ khi điểm môn đó / danh sách lớp / học sinh thay đổi"""
+    key = (subject_id, semester, school_year)
+    stamp = get_cache_stamps(REF_CACHE_VERSION_KEY, subject_stamp_key(subject_id), STUDENTS_STAMP_KEY)
+    with _distribution_cache_lock:
+        entry = _distribution_cache.get(key)
+    if entry and entry[0] == stamp:
+        return entry[1]
+    
+    data = build_subject_distribution(subject_id, semester, school_year)
+    with _distribution_cache_lock:
+        _distribution_cache[key] = (stamp, data)
+    return data
+
+@app.route("/api/subject_distribution")
+@login_required
+def subject_distribution_api():
+    """
+    API phổ điểm môn học theo lớp và loại điểm
+    Query: subject_id (mặc định môn được phân công), semester, school_year, class_select (chỉ lấy lớp này + toàn trường)
+    """
+    subjects = get_subjects()
+    subject_id = request.args.get('subject_id', type=int) or current_user.assigned_subject_id or (subjects[0].id if subjects else None)
+    subject = next((s for s in subjects if s.id == subject_id), None)
+    if not subject:
+        return jsonify({"error": "Không tìm thấy môn học"}), 404
+    semester = request.args.get('semester', 1, type=int)
+    school_year = request.args.get('school_year', '2023-2024')
+    class_name = request.args.get('class_select', '').strip()
+    
+    data = get_subject_distribution(subject.id, semester, school_year)
+    groups = data['groups']
+    if class_name:
+        groups = [grp for grp in groups if grp['class_name'] in (None, class_name)]
+    return jsonify({
+        "subject": {"id": subject.id, "name": subject.name},
+        "semester": semester,
+        "school_year": school_year,
+        "bins": data['bins'],
+        "groups": groups
+    })
+
 @app.route("/delete_grade/<int:grade_id>", methods=["POST"])
 @login_required
 def delete_grade(grade_id):
@@ -2338,7 +4120,9 @@ def delete_grade(grade_id):
         student = db.session.get(Student, student_id)
         subject = db.session.get(Subject, grade.subject_id)
         log_change('grade_delete', f'Xóa điểm {grade.grade_type} môn {subject.name if subject else "N/A"}: {grade.score}', student_id=student_id, student_name=student.name if student else None, student_class=student.student_class if student else None, old_value=grade.score)
+        avg_key = (grade.student_id, grade.subject_id, grade.semester, grade.school_year)
         db.session.delete(grade)
+        refresh_subject_averages([avg_key])
         db.session.commit()
         flash("Đã xóa điểm!", "success")
         return redirect(url_for("student_grades", student_id=student_id))
@@ -2364,6 +4148,7 @@ def update_grade_api(grade_id):
         student = db.session.get(Student, grade.student_id)
         subject = db.session.get(Subject, grade.subject_id)
         log_change('grade_update', f'Cập nhật điểm inline {grade.grade_type} môn {subject.name if subject else "N/A"}: {old_score_val} → {new_score}', student_id=grade.student_id, student_name=student.name if student else None, student_class=student.student_class if student else None, old_value=old_score_val, new_value=new_score)
+        refresh_subject_averages([(grade.student_id, grade.subject_id, grade.semester, grade.school_year)])
         db.session.commit()
         
         return jsonify({"success": True, "score": new_score})
@@ -2385,38 +4170,9 @@ def student_transcript(student_id):
     semester = int(request.args.get('semester', 1))
     school_year = request.args.get('school_year', '2023-2024')
     
-    subjects = Subject.query.order_by(Subject.name).all()
-    
-    transcript_data = []
-    for subject in subjects:
-        grades = Grade.query.filter_by(
-            student_id=student_id,
-            subject_id=subject.id,
-            semester=semester,
-            school_year=school_year
-        ).all()
-        
-        tx_scores = [g.score for g in grades if g.grade_type == 'TX']
-        gk_scores = [g.score for g in grades if g.grade_type == 'GK']
-        hk_scores = [g.score for g in grades if g.grade_type == 'HK']
-        
-        avg_score = None
-        if tx_scores and gk_scores and hk_scores:
-            avg_tx = sum(tx_scores) / len(tx_scores)
-            avg_gk = sum(gk_scores) / len(gk_scores)
-            avg_hk = sum(hk_scores) / len(hk_scores)
-            avg_score = round((avg_tx + avg_gk * 2 + avg_hk * 3) / 6, 2)
-        
-        transcript_data.append({
-            'subject': subject,
-            'tx_scores': tx_scores,
-            'gk_scores': gk_scores,
-            'hk_scores': hk_scores,
-            'avg_score': avg_score
-        })
-    
-    valid_averages = [item['avg_score'] for item in transcript_data if item['avg_score'] is not None]
-    gpa = round(sum(valid_averages) / len(valid_averages), 2) if valid_averages else None
+    transcript = build_transcripts([student_id], semester, school_year)[student_id]
+    transcript_data = transcript['transcript_data']
+    gpa = transcript['gpa']
     
     return render_template(
         "student_transcript.html",
@@ -2424,7 +4180,8 @@ def student_transcript(student_id):
         transcript_data=transcript_data,
         semester=semester,
         school_year=school_year,
-        gpa=gpa
+        gpa=gpa,
+        ranks=get_student_ranks(student, semester, school_year)
     )
 
 
@@ -2484,40 +4241,11 @@ def parent_report(student_id):
     semester = int(request.args.get('semester', 1))
     school_year = request.args.get('school_year', '2023-2024')
     
-    subjects = Subject.query.order_by(Subject.name).all()
-    transcript_data = []
-    for subject in subjects:
-        grades = Grade.query.filter_by(
-            student_id=student_id,
-            subject_id=subject.id,
-            semester=semester,
-            school_year=school_year
-        ).all()
-        
-        tx_scores = [g.score for g in grades if g.grade_type == 'TX']
-        gk_scores = [g.score for g in grades if g.grade_type == 'GK']
-        hk_scores = [g.score for g in grades if g.grade_type == 'HK']
-        
-        avg_score = None
-        if tx_scores and gk_scores and hk_scores:
-            avg_tx = sum(tx_scores) / len(tx_scores)
-            avg_gk = sum(gk_scores) / len(gk_scores)
-            avg_hk = sum(hk_scores) / len(hk_scores)
-            avg_score = round((avg_tx + avg_gk * 2 + avg_hk * 3) / 6, 2)
-        
-        transcript_data.append({
-            'subject': subject,
-            'tx_scores': tx_scores,
-            'gk_scores': gk_scores,
-            'hk_scores': hk_scores,
-            'avg_score': avg_score
-        })
+    transcript = build_transcripts([student_id], semester, school_year)[student_id]
+    transcript_data = transcript['transcript_data']
+    gpa = transcript['gpa']
     
-    valid_averages = [item['avg_score'] for item in transcript_data if item['avg_score'] is not None]
-    gpa = round(sum(valid_averages) / len(valid_averages), 2) if valid_averages else None
-    
-    current_week_cfg = SystemConfig.query.filter_by(key="current_week").first()
-    current_week = int(current_week_cfg.value) if current_week_cfg else 1
+    current_week = get_current_week()
     
     recent_violations = Violation.query.filter_by(student_id=student_id)\
         .filter(Violation.week_number >= max(1, current_week - 4))\
@@ -2531,6 +4259,7 @@ def parent_report(student_id):
         student=student,
         transcript_data=transcript_data,
         gpa=gpa,
+        ranks=get_student_ranks(student, semester, school_year),
         semester=semester,
         school_year=school_year,
         recent_violations=recent_violations,
@@ -2550,29 +4279,9 @@ def generate_parent_report(student_id):
     semester = int(request.json.get('semester', 1))
     school_year = request.json.get('school_year', '2023-2024')
     
-    subjects = Subject.query.all()
-    grades_info = []
-    for subject in subjects:
-        grades = Grade.query.filter_by(
-            student_id=student_id,
-            subject_id=subject.id,
-            semester=semester,
-            school_year=school_year
-        ).all()
-        
-        tx_scores = [g.score for g in grades if g.grade_type == 'TX']
-        gk_scores = [g.score for g in grades if g.grade_type == 'GK']
-        hk_scores = [g.score for g in grades if g.grade_type == 'HK']
-        
-        if tx_scores and gk_scores and hk_scores:
-            avg_tx = sum(tx_scores) / len(tx_scores)
-            avg_gk = sum(gk_scores) / len(gk_scores)
-            avg_hk = sum(hk_scores) / len(hk_scores)
-            avg_score = round((avg_tx + avg_gk * 2 + avg_hk * 3) / 6, 2)
-            grades_info.append(f"{subject.name}: {avg_score}")
-    
-    valid_avg = [float(g.split(': ')[1]) for g in grades_info if g]
-    gpa = round(sum(valid_avg) / len(valid_avg), 2) if valid_avg else 0
+    transcript = build_transcripts([student_id], semester, school_year)[student_id]
+    grades_info = [f"{item['subject'].name}: {item['avg_score']}" for item in transcript['transcript_data'] if item['avg_score'] is not None]
+    gpa = transcript['gpa'] or 0
     
     violations = Violation.query.filter_by(student_id=student_id)\
         .order_by(Violation.date_committed.desc())\
@@ -2600,44 +4309,192 @@ Hãy viết nhận xét xúc tích, chân thành, khích lệ học sinh và đ
     return jsonify({"report": response})
 
 
+# === TÁC VỤ NỀN (Job) ===
+# Thao tác nặng (nhập file, tính lại điểm, kết thúc tuần) chạy trong ThreadPoolExecutor của tiến trình thay vì
+# trong request. Trạng thái lưu ở bảng Job (SQLite) nên đọc được từ mọi worker qua /api/jobs/<id>, không cần broker.
+# Tiến độ ghi bằng kết nối riêng (ngoài session của tác vụ) và chỉ sau mỗi lần commit của tác vụ,
+# để không phải chờ khóa ghi SQLite mà chính tác vụ đang giữ.
+
+JOB_WORKERS = 1  # SQLite chỉ cho 1 luồng ghi - các tác vụ chạy lần lượt thay vì chờ khóa của nhau
+JOB_MAX_ERRORS = 200  # số dòng lỗi tối đa lưu trong Job.errors
+_job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+
+def update_job(job_id, **values):
+    """Ghi trạng thái tác vụ bằng kết nối riêng và commit ngay"""
+    with db.engine.begin() as conn:
+        conn.execute(update(Job).where(Job.id == job_id).values(**values))
+
+def submit_job(job_type, fn, *args, created_by_id=None, unique=False):
+    """
+    Tạo Job và chạy fn(report, *args) trong luồng nền.
+    fn trả về dict kết quả, các key 'success', 'errors', 'message' được lưu vào cột tương ứng của Job.
+    unique=True: đã có tác vụ cùng loại đang chờ / chạy thì trả về tác vụ đó thay vì tạo mới.
+    
+    Returns:
+        Job
+    """
+    if unique:
+        active = Job.query.filter(Job.job_type == job_type, Job.status.in_(('queued', 'running'))).first()
+        if active:
+            return active
+    job = Job(id=uuid.uuid4().hex, job_type=job_type, status='queued', created_by_id=created_by_id)
+    db.session.add(job)
+    db.session.commit()
+    _job_executor.submit(_run_job, job.id, fn, args)
+    return job
+
+def _run_job(job_id, fn, args):
+    with app.app_context():
+        update_job(job_id, status='running', started_at=datetime.datetime.utcnow())
+        
+        def report(processed=None, total=None):
+            """Ghi tiến độ: số dòng đã xử lý / tổng số dòng (None = chưa biết)"""
+            values = {}
+            if processed is not None:
+                values['processed_rows'] = processed
+            if total is not None:
+                values['total_rows'] = total
+                if processed is not None and total:
+                    values['progress'] = min(99, round(processed * 100 / total))
+            if values:
+                update_job(job_id, **values)
+        
+        try:
+            result = dict(fn(report, *args) or {})
+            errors = result.pop('errors', None) or []
+            update_job(job_id, status='done', progress=100, success_count=result.get('success', 0),
+                       error_count=len(errors), errors=json.dumps(errors[:JOB_MAX_ERRORS], ensure_ascii=False),
+                       result=json.dumps(result, ensure_ascii=False, default=str),
+                       message=(result.get('message') or '')[:500], finished_at=datetime.datetime.utcnow())
+        except Exception as e:
+            db.session.rollback()
+            update_job(job_id, status='error', message=str(e)[:500], finished_at=datetime.datetime.utcnow())
+        finally:
+            db.session.remove()
+
+def job_to_dict(job):
+    finished = job.finished_at or datetime.datetime.utcnow()
+    return {
+        'id': job.id,
+        'type': job.job_type,
+        'status': job.status,
+        'progress': job.progress or 0,
+        'total_rows': job.total_rows,
+        'processed_rows': job.processed_rows or 0,
+        'success_count': job.success_count or 0,
+        'error_count': job.error_count or 0,
+        'errors': json.loads(job.errors or '[]'),
+        'result': json.loads(job.result) if job.result else None,
+        'message': job.message,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'duration_seconds': round((finished - job.started_at).total_seconds(), 2) if job.started_at else None
+    }
+
+def get_visible_job(job_id):
+    """Job của người dùng hiện tại (Admin xem được mọi tác vụ), None nếu không có / không có quyền"""
+    job = db.session.get(Job, job_id)
+    if not job or (current_user.role != 'admin' and job.created_by_id != current_user.id):
+        return None
+    return job
+
+def fail_stale_jobs():
+    """Khi khởi động: tác vụ còn 'queued' / 'running' từ lần chạy trước không còn luồng xử lý -> đánh dấu lỗi"""
+    Job.query.filter(Job.status.in_(('queued', 'running'))).update(
+        {Job.status: 'error', Job.message: 'Máy chủ đã khởi động lại khi tác vụ đang chạy', Job.finished_at: datetime.datetime.utcnow()},
+        synchronize_session=False)
+    db.session.commit()
+
+@app.route("/api/jobs/<job_id>")
+@login_required
+def job_status_api(job_id):
+    """Tiến độ, số dòng, lỗi và thời gian chạy của 1 tác vụ nền"""
+    job = get_visible_job(job_id)
+    if not job:
+        return jsonify({"error": "Không tìm thấy tác vụ"}), 404
+    response = jsonify(job_to_dict(job))
+    response.cache_control.no_store = True
+    return response
+
+@app.route("/jobs/<job_id>")
+@login_required
+def job_page(job_id):
+    """Trang theo dõi tác vụ nền (dùng cho các form POST), xong thì chuyển về ?next="""
+    job = get_visible_job(job_id)
+    if not job:
+        flash("Không tìm thấy tác vụ!", "error")
+        return redirect(url_for('dashboard'))
+    next_url = request.args.get('next', '')
+    # Chỉ cho phép đường dẫn nội bộ: trình duyệt coi '/\evil' như '//evil' và bỏ qua tab / xuống dòng
+    parsed = urlparse(next_url)
+    if (not next_url.startswith('/') or next_url.startswith('//') or '\\' in next_url
+            or any(ord(ch) < 32 for ch in next_url) or parsed.scheme or parsed.netloc):
+        next_url = url_for('dashboard')
+    return render_template("job_status.html", job=job_to_dict(job), next_url=next_url)
+
+def run_reset_week_job(report):
+    """Tác vụ nền: kết thúc tuần đang mở (lưu trữ + snapshot + reset điểm + sang tuần mới) trong 1 transaction"""
+    # 1. Lấy tuần hiển thị hiện tại
+    week_cfg = SystemConfig.query.filter_by(key="current_week").first()
+    current_week_num = int(week_cfg.value) if week_cfg else 1
+    
+    # 2. Lưu trữ dữ liệu tuần cũ + đóng băng số liệu tổng hợp của tuần (cùng transaction với reset điểm)
+    archive = save_weekly_archive(current_week_num)
+    save_week_snapshot(current_week_num)
+    
+    # 3. Reset điểm toàn bộ học sinh về 100 (mỗi học sinh 1 dòng 'reset' mở đầu tuần mới trong sổ điểm)
+    db.session.execute(insert(ScoreLedger).from_select(
+        ['student_id', 'week_number', 'event_type', 'delta', 'running_total', 'created_at'],
+        select(Student.id, literal(current_week_num + 1), literal('reset'), literal(0), literal(SCORE_BASE),
+               literal(datetime.datetime.utcnow()))
+    ))
+    db.session.query(Student).update({Student.current_score: SCORE_BASE})
+    
+    # 4. Tăng số tuần hiển thị lên 1
+    if week_cfg:
+        week_cfg.value = str(current_week_num + 1)
+    
+    # Tổng hợp theo lớp: tuần vừa đóng lấy từ kho lưu trữ, tuần mới bắt đầu từ điểm đã reset
+    refresh_weekly_class_stats(current_week_num, from_archive=True)
+    refresh_weekly_class_stats(current_week_num + 1, from_archive=False)
+    bump_cache_stamps([conduct_stamp_key(current_week_num + 1)])
+        
+    # 5. Cập nhật "Dấu vết" tuần ISO để tắt cảnh báo
+    current_iso = get_current_iso_week()
+    last_reset_cfg = SystemConfig.query.filter_by(key="last_reset_week_id").first()
+    if not last_reset_cfg:
+        db.session.add(SystemConfig(key="last_reset_week_id", value=current_iso))
+    else:
+        last_reset_cfg.value = current_iso
+        
+    invalidate_reference_cache()
+    db.session.commit()
+    report(archive['rows'], archive['rows'])
+    return {
+        'success': archive['rows'],
+        'week': current_week_num + 1,
+        'message': f"Đã kết thúc Tuần {current_week_num} (lưu trữ {archive['rows']} học sinh trong {archive['seconds']}s). Hệ thống chuyển sang Tuần {current_week_num + 1}."
+    }
+
 @app.route("/admin/reset_week", methods=["POST"])
 @login_required
 def reset_week():
-    try:
-        # 1. Lấy tuần hiển thị hiện tại
-        week_cfg = SystemConfig.query.filter_by(key="current_week").first()
-        current_week_num = int(week_cfg.value) if week_cfg else 1
-        
-        # 2. Lưu trữ dữ liệu tuần cũ
-        save_weekly_archive(current_week_num)
-        
-        # 3. Reset điểm toàn bộ học sinh về 100
-        db.session.query(Student).update({Student.current_score: 100})
-        
-        # 4. Tăng số tuần hiển thị lên 1
-        if week_cfg:
-            week_cfg.value = str(current_week_num + 1)
-            
-        # 5. Cập nhật "Dấu vết" tuần ISO để tắt cảnh báo
-        current_iso = get_current_iso_week()
-        last_reset_cfg = SystemConfig.query.filter_by(key="last_reset_week_id").first()
-        if not last_reset_cfg:
-            db.session.add(SystemConfig(key="last_reset_week_id", value=current_iso))
-        else:
-            last_reset_cfg.value = current_iso
-            
-        db.session.commit()
-        flash(f"Đã kết thúc Tuần {current_week_num}. Hệ thống chuyển sang Tuần {current_week_num + 1}.", "success")
-        
-    except Exception as e:
-        db.session.rollback()
-        flash(f"Lỗi: {str(e)}", "error")
-        
-    return redirect(url_for("dashboard"))
+    """Kết thúc tuần chạy nền - chuyển sang trang theo dõi tác vụ, xong thì quay lại dashboard"""
+    job = submit_job('reset_week', run_reset_week_job, created_by_id=current_user.id, unique=True)
+    return redirect(url_for('job_page', job_id=job.id, next=url_for('dashboard')))
+
 @app.route("/admin/update_week", methods=["POST"])
 def update_week():
     c = SystemConfig.query.filter_by(key="current_week").first()
-    if c: c.value = str(request.form["new_week"]); db.session.commit()
+    if c:
+        c.value = str(request.form["new_week"])
+        if c.value.isdigit():
+            sync_current_scores(int(c.value))
+            refresh_weekly_class_stats(int(c.value), from_archive=False)
+            bump_cache_stamps([conduct_stamp_key(int(c.value))])
+        invalidate_reference_cache()
+        db.session.commit()
     return redirect(url_for("dashboard"))
 
 @app.route("/changelog")
@@ -2692,9 +4549,10 @@ def check_duplicate_student(): return jsonify([])
 
 def create_database():
     db.create_all()
+    fail_stale_jobs()
     if not Teacher.query.first(): 
         db.session.add(Teacher(username="admin", password="admin", full_name="Admin", role="admin"))
-    if not SystemConfig.query.first(): db.session.add(SystemConfig(key="current_week", value="1"))
+    if not SystemConfig.query.filter_by(key="current_week").first(): db.session.add(SystemConfig(key="current_week", value="1"))
     if not ViolationType.query.first(): db.session.add(ViolationType(name="Đi muộn", points_deducted=2))
     db.session.commit()
 
@@ -2710,17 +4568,16 @@ def delete_violation(violation_id):
         student = Student.query.get(violation.student_id)
         
         # 2. KHÔI PHỤC ĐIỂM SỐ
-        # Cộng trả lại điểm đã trừ
+        # Cộng trả lại đúng số điểm đã trừ vào tuần của vi phạm (không chặn ở 100 vì điểm cộng có thể vượt 100)
         if student:
-            old_score = student.current_score
-            student.current_score += violation.points_deducted
-            # Đảm bảo điểm không vượt quá 100 (nếu quy chế là max 100)
-            if student.current_score > 100:
-                student.current_score = 100
-            log_change('violation_delete', f'Xóa vi phạm: {violation.violation_type_name} (hoàn +{violation.points_deducted} điểm)', student_id=student.id, student_name=student.name, student_class=student.student_class, old_value=old_score, new_value=student.current_score)
+            old_score, new_score = record_score_event(student, violation.points_deducted, 'violation_delete', violation.week_number, note=violation.violation_type_name)
+            log_change('violation_delete', f'Xóa vi phạm: {violation.violation_type_name} (hoàn +{violation.points_deducted} điểm)', student_id=student.id, student_name=student.name, student_class=student.student_class, old_value=old_score, new_value=new_score)
         
         # 3. Xóa vi phạm
         db.session.delete(violation)
+        if student:
+            refresh_conduct_stats({student.student_class})
+        bump_cache_stamps([conduct_stamp_key(violation.week_number)])
         db.session.commit()
         
         flash(f"Đã xóa vi phạm và khôi phục {violation.points_deducted} điểm cho học sinh.", "success")
@@ -2826,15 +4683,8 @@ def download_student_template():
 
 
 
-@app.route("/save_imported_students", methods=["POST"])
-@login_required
-def save_imported_students():
-    """Bước 2: Lưu vào CSDL sau khi xác nhận"""
-    filepath = request.form.get("file_path")
-    if not filepath or not os.path.exists(filepath):
-        flash("File nhập liệu không tồn tại hoặc đã hết hạn. Vui lòng thử lại.", "error")
-        return redirect(url_for('import_students'))
-        
+def run_student_import_job(report, filepath):
+    """Tác vụ nền: lưu học sinh từ file Excel đã xác nhận (bỏ qua mã đã tồn tại, tự tạo lớp mới), xóa file khi xong"""
     try:
         df = pd.read_excel(filepath)
         df.columns = [str(c).strip().lower() for c in df.columns]
@@ -2842,9 +4692,16 @@ def save_imported_students():
         code_col = next((c for c in df.columns if "mã" in c or "code" in c), None)
         name_col = next((c for c in df.columns if "tên" in c or "name" in c), None)
         class_col = next((c for c in df.columns if "lớp" in c or "class" in c), None)
+        report(0, len(df))
+        
+        # Mã học sinh / lớp đã có: 1 truy vấn mỗi loại thay vì 1 truy vấn mỗi dòng
+        existing_codes = {code for (code,) in db.session.query(Student.student_code)}
+        existing_classes = {name for (name,) in db.session.query(ClassRoom.name)}
         
         count = 0
         skipped = 0
+        new_class = False
+        touched_classes = set()
         for index, row in df.iterrows():
             student_code = str(row[code_col]).strip()
             name = str(row[name_col]).strip()
@@ -2854,65 +4711,161 @@ def save_imported_students():
             if not student_code or student_code.lower() == 'nan': continue
             
             # 1. Kiểm tra trùng mã trong DB
-            if Student.query.filter_by(student_code=student_code).first():
+            if student_code in existing_codes:
                 skipped += 1
                 continue 
             
             # 2. Tự động tạo Lớp mới nếu chưa có
-            if not ClassRoom.query.filter_by(name=s_class).first():
+            if s_class not in existing_classes:
                 db.session.add(ClassRoom(name=s_class))
+                existing_classes.add(s_class)
+                new_class = True
             
             # 3. Thêm học sinh
-            new_student = Student(name=name, student_class=s_class, student_code=student_code)
-            db.session.add(new_student)
+            db.session.add(Student(name=name, student_class=s_class, student_code=student_code))
+            existing_codes.add(student_code)
+            touched_classes.add(s_class)
             
             count += 1
             
+        if new_class:
+            invalidate_reference_cache()
+        if count:
+            refresh_conduct_stats(touched_classes)
+            bump_cache_stamps([STUDENTS_STAMP_KEY])
         db.session.commit()
-        
+        report(len(df), len(df))
+    finally:
         # Cleanup
         if os.path.exists(filepath):
             os.remove(filepath)
-            
-        flash(f"Kết quả nhập liệu: Thêm mới {count} học sinh. Bỏ qua {skipped} học sinh (đã tồn tại).", "success" if count > 0 else "warning")
-        return redirect(url_for('manage_students'))
-        
-    except Exception as e:
-        db.session.rollback()
-        flash(f"Lỗi khi lưu: {str(e)}", "error")
+    
+    return {'success': count, 'skipped': skipped,
+            'message': f"Kết quả nhập liệu: Thêm mới {count} học sinh. Bỏ qua {skipped} học sinh (đã tồn tại)."}
+
+@app.route("/save_imported_students", methods=["POST"])
+@login_required
+def save_imported_students():
+    """Bước 2: Lưu vào CSDL sau khi xác nhận (chạy nền, chuyển sang trang theo dõi tác vụ)"""
+    filepath = request.form.get("file_path")
+    if not filepath or not os.path.exists(filepath):
+        flash("File nhập liệu không tồn tại hoặc đã hết hạn. Vui lòng thử lại.", "error")
         return redirect(url_for('import_students'))
+    
+    job = submit_job('student_import', run_student_import_job, filepath, created_by_id=current_user.id)
+    return redirect(url_for('job_page', job_id=job.id, next=url_for('manage_students')))
 # --- DÁN ĐOẠN NÀY XUỐNG CUỐI FILE app.py ---
 
-@app.route("/admin/fix_scores")
-@login_required
-def fix_scores():
-    """Hàm này giúp tính lại điểm cho toàn bộ học sinh dựa trên lỗi vi phạm"""
-    try:
-        # 1. Lấy danh sách tất cả học sinh
-        students = Student.query.all()
-        count = 0
-        
-        for s in students:
-            # 2. Tìm tất cả lỗi vi phạm của học sinh này trong DB
-            violations = Violation.query.filter_by(student_id=s.id).all()
-            
-            # 3. Cộng tổng điểm phạt
-            total_deducted = sum(v.points_deducted for v in violations)
-            
-            # 4. Reset điểm về 100 rồi trừ đi tổng lỗi
-            s.current_score = 100 - total_deducted
-            
-            count += 1
-            
-        # 5. Lưu tất cả thay đổi vào Database
+# === TÍNH LẠI ĐIỂM NỀ NẾP ===
+# current_score = 100 - tổng điểm trừ + tổng điểm cộng của tuần đang mở (mỗi tuần bắt đầu lại từ 100,
+# giống biểu đồ trong student_detail). Sổ điểm được bù 1 dòng 'adjust' rồi current_score được ghi
+# bằng UPDATE ... FROM theo từng khoảng id học sinh, chạy nền.
+
+SCORE_RECOMPUTE_CHUNK = 500  # số id học sinh mỗi lượt UPDATE - giữ khóa ghi SQLite ngắn
+
+def expected_scores_subquery(week_number, id_from=None, id_to=None):
+    """Subquery (student_id, expected_score) cho các học sinh có id trong [id_from, id_to]"""
+    id_filter = (lambda col: col.between(id_from, id_to)) if id_from is not None else (lambda col: True)
+    deduct = db.session.query(Violation.student_id, func.sum(Violation.points_deducted).label('total'))\
+        .filter(Violation.week_number == week_number, id_filter(Violation.student_id))\
+        .group_by(Violation.student_id).subquery()
+    bonus = db.session.query(BonusRecord.student_id, func.sum(BonusRecord.points_added).label('total'))\
+        .filter(BonusRecord.week_number == week_number, id_filter(BonusRecord.student_id))\
+        .group_by(BonusRecord.student_id).subquery()
+    return db.session.query(
+        Student.id.label('student_id'),
+        (100 - func.coalesce(deduct.c.total, 0) + func.coalesce(bonus.c.total, 0)).label('expected_score')
+    ).outerjoin(deduct, deduct.c.student_id == Student.id)\
+        .outerjoin(bonus, bonus.c.student_id == Student.id)\
+        .filter(id_filter(Student.id)).subquery()
+
+def get_score_drift(week_number):
+    """
+    Chạy thử: các học sinh có current_score (hoặc điểm lũy kế trong sổ) khác điểm tính lại từ vi phạm / điểm cộng của tuần.
+    
+    Returns:
+        list: [{'id', 'code', 'name', 'class', 'current', 'expected', 'drift'}]
+    """
+    expected = expected_scores_subquery(week_number)
+    ledger = ledger_totals_subquery(week_number)
+    rows = db.session.query(Student.id, Student.student_code, Student.name, Student.student_class,
+                            Student.current_score, expected.c.expected_score)\
+        .join(expected, expected.c.student_id == Student.id)\
+        .outerjoin(ledger, ledger.c.student_id == Student.id)\
+        .filter(or_(Student.current_score.is_distinct_from(expected.c.expected_score),
+                    func.coalesce(ledger.c.running_total, SCORE_BASE) != expected.c.expected_score))\
+        .order_by(Student.student_class, Student.student_code).all()
+    return [{'id': sid, 'code': code, 'name': name, 'class': class_name, 'current': current, 'expected': exp,
+             'drift': (current if current is not None else 100) - exp}
+            for sid, code, name, class_name, current, exp in rows]
+
+def recompute_scores(week_number, progress=None):
+    """
+    Ghi lại current_score cho mọi học sinh bị lệch, mỗi khoảng SCORE_RECOMPUTE_CHUNK id là 1 lệnh
+    INSERT ... SELECT dòng 'adjust' vào sổ điểm, 1 lệnh UPDATE ... FROM (subquery gom nhóm) và 1 commit.
+    progress(đã xong, tổng số lượt, số HS đã sửa).
+    
+    Returns:
+        int: số học sinh đã sửa điểm
+    """
+    min_id, max_id = db.session.query(func.min(Student.id), func.max(Student.id)).one()
+    if min_id is None:
+        return 0
+    
+    chunks = list(range(min_id, max_id + 1, SCORE_RECOMPUTE_CHUNK))
+    fixed = 0
+    for done, id_from in enumerate(chunks, 1):
+        id_to = id_from + SCORE_RECOMPUTE_CHUNK - 1
+        expected = expected_scores_subquery(week_number, id_from, id_to)
+        ledger = ledger_totals_subquery(week_number)
+        ledger_total = func.coalesce(ledger.c.running_total, SCORE_BASE)
+        db.session.execute(insert(ScoreLedger).from_select(
+            ['student_id', 'week_number', 'event_type', 'delta', 'running_total', 'note', 'created_at'],
+            select(expected.c.student_id, literal(week_number), literal('adjust'),
+                   expected.c.expected_score - ledger_total, expected.c.expected_score,
+                   literal('Tính lại điểm từ vi phạm / điểm cộng'), literal(datetime.datetime.utcnow()))
+            .outerjoin(ledger, ledger.c.student_id == expected.c.student_id)
+            .where(ledger_total != expected.c.expected_score)
+        ))
+        result = db.session.execute(
+            update(Student)
+            .values(current_score=expected.c.expected_score)
+            .where(Student.id == expected.c.student_id,
+                   Student.current_score.is_distinct_from(expected.c.expected_score))
+            .execution_options(synchronize_session=False)
+        )
+        fixed += result.rowcount
         db.session.commit()
-        
-        flash(f"Đã sửa điểm thành công cho {count} học sinh!", "success")
-        return redirect(url_for('index'))
-        
-    except Exception as e:
-        db.session.rollback()
-        return f"Có lỗi xảy ra: {str(e)}"   
+        if progress:
+            progress(done, len(chunks), fixed)
+    return fixed
+
+def run_score_recompute_job(report, week_number, admin_id):
+    """Tác vụ nền: recompute_scores + tổng hợp lớp + ghi ChangeLog. Tiến độ tính theo lượt id học sinh."""
+    fixed = recompute_scores(week_number, lambda done, total, fixed: report(done, total))
+    refresh_conduct_stats(None)
+    bump_cache_stamps([conduct_stamp_key(week_number)])
+    log_change('score_reset', f'Tính lại điểm nề nếp tuần {week_number}: sửa {fixed} học sinh', changed_by_id=admin_id)
+    db.session.commit()
+    return {'success': fixed, 'fixed': fixed, 'week': week_number,
+            'message': f"Đã tính lại điểm tuần {week_number}: sửa {fixed} học sinh."}
+
+@app.route("/admin/fix_scores", methods=["GET", "POST"])
+@admin_required
+def fix_scores():
+    """
+    Tính lại điểm nề nếp tuần đang mở từ vi phạm và điểm cộng.
+    GET: chạy thử, liệt kê học sinh bị lệch điểm. POST: chạy nền, trả về job_id.
+    """
+    week_number = get_current_week()
+    if request.method == "POST":
+        job = submit_job('score_recompute', run_score_recompute_job, week_number, current_user.id,
+                         created_by_id=current_user.id, unique=True)
+        return jsonify({"success": True, "job_id": job.id,
+                        "status_url": url_for('job_status_api', job_id=job.id)})
+    
+    drift = get_score_drift(week_number)
+    return render_template("fix_scores.html", week_number=week_number, drift=drift)
 
 
 # === BONUS POINTS ROUTES ===
@@ -2929,6 +4882,7 @@ def manage_bonus_types():
         if name and points > 0:
             if not BonusType.query.filter_by(name=name).first():
                 db.session.add(BonusType(name=name, points_added=points, description=description or None))
+                invalidate_reference_cache()
                 db.session.commit()
                 flash("Đã thêm loại điểm cộng mới!", "success")
             else:
@@ -2937,7 +4891,7 @@ def manage_bonus_types():
             flash("Vui lòng nhập đầy đủ thông tin!", "error")
         return redirect(url_for("manage_bonus_types"))
     
-    bonus_types = BonusType.query.order_by(BonusType.points_added.desc()).all()
+    bonus_types = get_bonus_types()
     return render_template("manage_bonus_types.html", bonus_types=bonus_types)
 
 
@@ -2954,6 +4908,7 @@ def edit_bonus_type(bonus_id):
         bonus.name = request.form.get("bonus_name", "").strip()
         bonus.points_added = int(request.form.get("points", 0))
         bonus.description = request.form.get("description", "").strip() or None
+        invalidate_reference_cache()
         db.session.commit()
         flash("Đã cập nhật loại điểm cộng!", "success")
         return redirect(url_for("manage_bonus_types"))
@@ -2968,6 +4923,7 @@ def delete_bonus_type(bonus_id):
     bonus = db.session.get(BonusType, bonus_id)
     if bonus:
         db.session.delete(bonus)
+        invalidate_reference_cache()
         db.session.commit()
         flash("Đã xóa loại điểm cộng!", "success")
     return redirect(url_for("manage_bonus_types"))
@@ -2991,10 +4947,11 @@ def add_bonus():
             return redirect(url_for("add_bonus"))
         
         # Lấy tuần hiện tại
-        w_cfg = SystemConfig.query.filter_by(key="current_week").first()
-        current_week = int(w_cfg.value) if w_cfg else 1
+        current_week = get_current_week()
         
         count = 0
+        touched_classes = set()
+        totals = {}  # điểm lũy kế trong sổ theo (học sinh, tuần)
         for bonus_id in selected_bonus_ids:
             bonus_type = db.session.get(BonusType, int(bonus_id))
             if not bonus_type:
@@ -3004,8 +4961,7 @@ def add_bonus():
                 student = db.session.get(Student, int(s_id))
                 if student:
                     # Cộng điểm
-                    old_score = student.current_score or 100
-                    student.current_score = old_score + bonus_type.points_added
+                    old_score, _ = record_score_event(student, bonus_type.points_added, 'bonus', current_week, note=bonus_type.name, totals=totals)
                     
                     # Lưu lịch sử
                     db.session.add(BonusRecord(
@@ -3016,9 +4972,12 @@ def add_bonus():
                         week_number=current_week
                     ))
                     log_change('bonus', f'Điểm cộng: {bonus_type.name} (+{bonus_type.points_added} điểm){" - " + reason if reason else ""}', student_id=student.id, student_name=student.name, student_class=student.student_class, old_value=old_score, new_value=student.current_score)
+                    touched_classes.add(student.student_class)
                     count += 1
         
         if count > 0:
+            refresh_conduct_stats(touched_classes)
+            bump_cache_stamps([conduct_stamp_key(current_week)])
             db.session.commit()
             flash(f"Đã ghi nhận điểm cộng cho {len(selected_student_ids)} học sinh x {len(selected_bonus_ids)} loại!", "success")
         else:
@@ -3026,10 +4985,9 @@ def add_bonus():
         
         return redirect(url_for("add_bonus"))
     
-    # GET: Render form (filtered by role)
-    students = get_accessible_students().order_by(Student.student_class, Student.name).all()
-    bonus_types = BonusType.query.order_by(BonusType.points_added.desc()).all()
-    return render_template("add_bonus.html", students=students, bonus_types=bonus_types)
+    # GET: Render form, danh sách học sinh được tải dần qua /api/students
+    bonus_types = get_bonus_types()
+    return render_template("add_bonus.html", bonus_types=bonus_types)
 
 
 # === ADMIN PANEL - QUẢN LÝ GIÁO VIÊN ===
@@ -3039,8 +4997,8 @@ def add_bonus():
 def manage_teachers():
     """Danh sách giáo viên - Chỉ Admin"""
     teachers = Teacher.query.filter(Teacher.id != current_user.id).order_by(Teacher.created_at.desc()).all()
-    subjects = Subject.query.order_by(Subject.name).all()
-    classes = ClassRoom.query.order_by(ClassRoom.name).all()
+    subjects = get_subjects()
+    classes = get_class_list()
     return render_template("manage_teachers.html", teachers=teachers, subjects=subjects, classes=classes)
 
 
@@ -3088,8 +5046,8 @@ def add_teacher():
             return redirect(url_for("add_teacher"))
     
     # GET: Render form
-    subjects = Subject.query.order_by(Subject.name).all()
-    classes = ClassRoom.query.order_by(ClassRoom.name).all()
+    subjects = get_subjects()
+    classes = get_class_list()
     return render_template("add_teacher.html", subjects=subjects, classes=classes)
 
 
@@ -3133,8 +5091,8 @@ def edit_teacher(teacher_id):
             flash(f"Lỗi cập nhật: {str(e)}", "error")
     
     # GET: Render form
-    subjects = Subject.query.order_by(Subject.name).all()
-    classes = ClassRoom.query.order_by(ClassRoom.name).all()
+    subjects = get_subjects()
+    classes = get_class_list()
     return render_template("edit_teacher.html", teacher=teacher, subjects=subjects, classes=classes)
 
 
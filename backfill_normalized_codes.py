@@ -0,0 +1,48 @@
+"""
+Migration script để thêm cột normalized_code (mã học sinh đã chuẩn hóa, có chỉ mục) cho bảng student
+và điền giá trị cho các học sinh đã có. Có thể chạy lại bất cứ lúc nào để đồng bộ.
+Chạy: python backfill_normalized_codes.py
+"""
+import sqlite3
+import os
+
+from models import normalize_student_code
+
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database.db')
+
+def migrate():
+    print("🔧 Bắt đầu migration mã học sinh chuẩn hóa...")
+    
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='student'")
+    if not cursor.fetchone():
+        print("⚠️  Chưa có bảng student - bảng sẽ được tạo đầy đủ khi khởi động ứng dụng, bỏ qua migration!")
+        conn.close()
+        return
+    
+    cursor.execute("PRAGMA table_info(student)")
+    existing_columns = [row[1] for row in cursor.fetchall()]
+    
+    if "normalized_code" not in existing_columns:
+        cursor.execute("ALTER TABLE student ADD COLUMN normalized_code VARCHAR(50)")
+        print("✅ Đã thêm cột: normalized_code")
+    else:
+        print("⏭️ Cột normalized_code đã tồn tại, bỏ qua")
+    
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_student_normalized_code ON student (normalized_code)")
+    print("✅ Đã tạo chỉ mục: ix_student_normalized_code")
+    
+    cursor.execute("SELECT id, student_code, normalized_code FROM student")
+    updates = [(normalize_student_code(code), sid) for sid, code, current in cursor.fetchall()
+               if normalize_student_code(code) != current]
+    cursor.executemany("UPDATE student SET normalized_code = ? WHERE id = ?", updates)
+    print(f"✅ Đã cập nhật mã chuẩn hóa cho {len(updates)} học sinh")
+    
+    conn.commit()
+    conn.close()
+    print("\n🎉 Migration hoàn tất!")
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,33 @@
+"""
+Tạo bảng WeekSnapshot (nếu chưa có) và đóng băng số liệu tổng hợp của mọi tuần đã kết thúc (< tuần hiện tại).
+Không bắt buộc: tuần cũ chưa có snapshot sẽ được tạo ở lần xem đầu tiên.
+Chạy: python build_week_snapshots.py
+"""
+import os
+import sys
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, basedir)
+
+from app import app, db, get_current_week, save_week_snapshot
+from models import Violation, BonusRecord
+
+
+def migrate():
+    with app.app_context():
+        db.create_all()
+        print("✅ Đã tạo bảng week_snapshot (nếu chưa có)")
+        
+        current_week = get_current_week()
+        weeks = {w for (w,) in db.session.query(Violation.week_number).distinct()}
+        weeks |= {w for (w,) in db.session.query(BonusRecord.week_number).distinct()}
+        closed_weeks = sorted(w for w in weeks if w and w < current_week)
+        for week in closed_weeks:
+            save_week_snapshot(week)
+        db.session.commit()
+        print(f"✅ Đã tạo snapshot cho {len(closed_weeks)} tuần đã kết thúc")
+        print("\n🎉 Hoàn tất!")
+
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,36 @@
+"""
+Migration script để thêm chỉ mục (student_id, week_number) cho bảng violation và bonus_record
+(danh sách tuần trong trang chi tiết học sinh chỉ quét dữ liệu của học sinh đó)
+Chạy: python migrate_student_week_index.py
+"""
+import sqlite3
+import os
+
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database.db')
+
+INDEXES = [
+    ("violation", "ix_violation_student_week"),
+    ("bonus_record", "ix_bonus_record_student_week"),
+]
+
+def migrate():
+    print("🔧 Bắt đầu migration chỉ mục tuần theo học sinh...")
+    
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    
+    for table, index_name in INDEXES:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
+        if not cursor.fetchone():
+            print(f"⚠️  Chưa có bảng {table} - chỉ mục sẽ được tạo cùng bảng khi khởi động ứng dụng, bỏ qua!")
+            continue
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} (student_id, week_number)")
+        print(f"✅ Đã tạo chỉ mục: {index_name}")
+    
+    cursor.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+    print("\n🎉 Migration hoàn tất!")
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,39 @@
+"""
+Migration script để thêm cột total_bonuses và chỉ mục week_number cho bảng WeeklyArchive
+Chạy: python migrate_weekly_archive.py
+"""
+import sqlite3
+import os
+
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database.db')
+
+def migrate():
+    print("🔧 Bắt đầu migration bảng lưu trữ tuần...")
+    
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='weekly_archive'")
+    if not cursor.fetchone():
+        print("⚠️  Chưa có bảng weekly_archive - bảng sẽ được tạo đầy đủ khi khởi động ứng dụng, bỏ qua migration!")
+        conn.close()
+        return
+    
+    cursor.execute("PRAGMA table_info(weekly_archive)")
+    existing_columns = [row[1] for row in cursor.fetchall()]
+    
+    if "total_bonuses" not in existing_columns:
+        cursor.execute("ALTER TABLE weekly_archive ADD COLUMN total_bonuses INTEGER DEFAULT 0")
+        print("✅ Đã thêm cột: total_bonuses")
+    else:
+        print("⏭️ Cột total_bonuses đã tồn tại, bỏ qua")
+    
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_weekly_archive_week_number ON weekly_archive (week_number)")
+    print("✅ Đã tạo chỉ mục: ix_weekly_archive_week_number")
+    
+    conn.commit()
+    conn.close()
+    print("\n🎉 Migration hoàn tất!")
+
+if __name__ == "__main__":
+    migrate()
@@ -1,10 +1,54 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy.orm import validates
 import datetime
+import re
+import unicodedata
 
 db = SQLAlchemy()
 
 
+def normalize_student_code(code):
+    """
+    Chuẩn hóa mã học sinh để tăng khả năng matching khi OCR đọc sai format
+    
+    Xử lý:
+    - Bỏ dấu tiếng Việt (TOÁN → TOAN, Đạt → DAT)
+    - Uppercase toàn bộ
+    - Chuẩn hóa khoảng trắng (nhiều space → 1 space, trim đầu cuối)
+    - Giữ nguyên dấu gạch ngang (-)
+    
+    Examples:
+        "34 TOÁN - 001035" → "34 TOAN - 001035"
+        "12  tin-001" → "12 TIN-001"
+        "11a1  -  005" → "11A1 - 005"
+        "Nguyễn Văn A" → "NGUYEN VAN A"
+    
+    Args:
+        code (str): Mã học sinh cần chuẩn hóa
+    
+    Returns:
+        str: Mã đã chuẩn hóa
+    """
+    if not code:
+        return ""
+    
+    # 1. Bỏ dấu tiếng Việt bằng unicodedata
+    code = unicodedata.normalize('NFD', str(code))
+    code = ''.join(char for char in code if unicodedata.category(char) != 'Mn')
+    
+    # 2. Uppercase
+    code = code.upper()
+    
+    # 3. Chuẩn hóa khoảng trắng: nhiều space → 1 space
+    code = re.sub(r'\s+', ' ', code)
+    
+    # 4. Trim đầu cuối
+    code = code.strip()
+    
+    return code
+
+
 class ClassRoom(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), unique=True, nullable=False)
@@ -42,6 +86,12 @@ class Student(db.Model):
     name = db.Column(db.String(100), nullable=False)
     student_class = db.Column(db.String(20), nullable=False)
     current_score = db.Column(db.Integer, default=100)
+    normalized_code = db.Column(db.String(50), index=True)  # normalize_student_code(student_code) - tra cứu OCR / đăng nhập
+
+    @validates('student_code')
+    def _sync_normalized_code(self, key, value):
+        self.normalized_code = normalize_student_code(value)
+        return value
 
 
 class ViolationType(db.Model):
@@ -51,6 +101,9 @@ class ViolationType(db.Model):
 
 
 class Violation(db.Model):
+    __table_args__ = (
+        db.Index('ix_violation_student_week', 'student_id', 'week_number'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
     violation_type_name = db.Column(db.String(200), nullable=False)
@@ -62,13 +115,64 @@ class Violation(db.Model):
 
 class WeeklyArchive(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    week_number = db.Column(db.Integer, nullable=False)
+    week_number = db.Column(db.Integer, nullable=False, index=True)
     student_id = db.Column(db.Integer, nullable=True)
     student_name = db.Column(db.String(100))
     student_code = db.Column(db.String(50))
     student_class = db.Column(db.String(20))
     final_score = db.Column(db.Integer)
     total_deductions = db.Column(db.Integer)
+    total_bonuses = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+
+class WeeklyClassStats(db.Model):
+    """Tổng hợp nề nếp theo lớp / tuần (class_name = '' là toàn trường) - dùng cho phân tích xu hướng nhiều tuần"""
+    __table_args__ = (
+        db.UniqueConstraint('class_name', 'week_number', name='uq_weekly_class_stats_key'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    week_number = db.Column(db.Integer, nullable=False)
+    class_name = db.Column(db.String(20), nullable=False, default="")
+    student_count = db.Column(db.Integer, default=0)
+    avg_score = db.Column(db.Float, default=0)
+    count_good = db.Column(db.Integer, default=0)  # Tốt (>= 90)
+    count_fair = db.Column(db.Integer, default=0)  # Khá (70-89)
+    count_weak = db.Column(db.Integer, default=0)  # Cần cố gắng (< 70)
+    total_deductions = db.Column(db.Integer, default=0)
+    top_violations = db.Column(db.Text, default="[]")  # JSON [[tên lỗi, số lượt], ...]
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+class ClassAnalysisCache(db.Model):
+    """Kết quả AI phân tích nề nếp đã có - dùng lại khi cùng lớp / tuần / số liệu"""
+    id = db.Column(db.Integer, primary_key=True)
+    stats_hash = db.Column(db.String(64), unique=True, nullable=False, index=True)  # sha256 của prompt (lớp, tuần, số liệu)
+    class_name = db.Column(db.String(20), default="")
+    weeks = db.Column(db.String(200))  # VD: "1,2,3"
+    analysis = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+class WeekSnapshot(db.Model):
+    """Số liệu tổng hợp đóng băng của 1 tuần đã kết thúc (JSON) - ghi khi reset tuần"""
+    id = db.Column(db.Integer, primary_key=True)
+    week_number = db.Column(db.Integer, unique=True, nullable=False, index=True)
+    stamp = db.Column(db.String(50), nullable=False, default="")  # version stamp dữ liệu tuần lúc tạo snapshot
+    data = db.Column(db.Text, nullable=False)  # tier_counts, class_rankings, top_violations, students, violations
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+class ScoreLedger(db.Model):
+    """Sổ điểm nề nếp chỉ ghi thêm - mỗi sự kiện lưu điểm lũy kế của học sinh trong tuần (mỗi tuần bắt đầu từ 100)"""
+    __table_args__ = (
+        db.Index('ix_score_ledger_student_week', 'student_id', 'week_number', 'id'),
+        db.Index('ix_score_ledger_student_time', 'student_id', 'created_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
+    week_number = db.Column(db.Integer, nullable=False)
+    event_type = db.Column(db.String(30), nullable=False)  # 'violation', 'bonus', 'violation_delete', 'reset', 'adjust'
+    delta = db.Column(db.Integer, nullable=False, default=0)
+    running_total = db.Column(db.Integer, nullable=False)
+    note = db.Column(db.String(200))
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
 
 
@@ -97,6 +201,25 @@ class Grade(db.Model):
     subject = db.relationship('Subject', backref=db.backref('grades', lazy=True, cascade='all, delete-orphan'))
 
 
+class SubjectAverage(db.Model):
+    """Bảng tổng hợp điểm TB môn - cập nhật cùng transaction với mọi thao tác ghi điểm"""
+    __table_args__ = (
+        db.UniqueConstraint('student_id', 'subject_id', 'semester', 'school_year', name='uq_subject_average_key'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
+    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id'), nullable=False)
+    semester = db.Column(db.Integer, nullable=False)
+    school_year = db.Column(db.String(20))
+    avg_tx = db.Column(db.Float)
+    avg_gk = db.Column(db.Float)
+    avg_hk = db.Column(db.Float)
+    subject_avg = db.Column(db.Float)  # (TX + GK*2 + HK*3) / 6, None nếu thiếu loại điểm
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    student = db.relationship('Student', backref=db.backref('subject_averages', lazy=True, cascade='all, delete-orphan'))
+    subject = db.relationship('Subject', backref=db.backref('subject_averages', lazy=True, cascade='all, delete-orphan'))
+
+
 class ChatConversation(db.Model):
     """Model lưu trữ lịch sử hội thoại chatbot với context awareness"""
     id = db.Column(db.Integer, primary_key=True)
@@ -122,6 +245,9 @@ class BonusType(db.Model):
 
 class BonusRecord(db.Model):
     """Lịch sử điểm cộng của học sinh"""
+    __table_args__ = (
+        db.Index('ix_bonus_record_student_week', 'student_id', 'week_number'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
     bonus_type_name = db.Column(db.String(200), nullable=False)
@@ -171,6 +297,24 @@ class PrivateMessage(db.Model):
     receiver = db.relationship('Teacher', foreign_keys=[receiver_id], backref='received_private_messages')
 
 
+class Job(db.Model):
+    """Tác vụ nền (nhập file, tính lại điểm, kết thúc tuần) - tiến độ và kết quả đọc qua /api/jobs/<id>"""
+    id = db.Column(db.String(32), primary_key=True)  # uuid hex
+    job_type = db.Column(db.String(50), nullable=False, index=True)  # 'violation_import', 'student_import', 'score_recompute', 'reset_week'
+    status = db.Column(db.String(20), nullable=False, default='queued')  # 'queued', 'running', 'done', 'error'
+    progress = db.Column(db.Integer, default=0)  # 0-100
+    total_rows = db.Column(db.Integer)
+    processed_rows = db.Column(db.Integer, default=0)
+    success_count = db.Column(db.Integer, default=0)
+    error_count = db.Column(db.Integer, default=0)
+    errors = db.Column(db.Text, default="[]")  # JSON danh sách lỗi (tối đa JOB_MAX_ERRORS dòng)
+    result = db.Column(db.Text)  # JSON kết quả trả về cho giao diện
+    message = db.Column(db.String(500))
+    created_by_id = db.Column(db.Integer, db.ForeignKey('teacher.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
 class ChangeLog(db.Model):
     """Lịch sử thay đổi CSDL - ghi nhận mọi thay đổi về điểm, vi phạm, điểm cộng"""
     id = db.Column(db.Integer, primary_key=True)
@@ -0,0 +1,82 @@
+"""
+Tạo bảng ScoreLedger (nếu chưa có) và dựng lại sổ điểm nề nếp từ vi phạm / điểm cộng đã có:
+mỗi (học sinh, tuần) mở đầu bằng 1 dòng 'reset' = 100 tại thời điểm bắt đầu tuần (giữ thời điểm reset cũ /
+lúc lưu trữ tuần trước, không có thì lấy sự kiện sớm nhất của tuần), sau đó cộng dồn các sự kiện theo thời gian ghi nhận.
+Sau đó chép điểm lũy kế của tuần đang mở vào current_score. Có thể chạy lại bất cứ lúc nào để đồng bộ.
+Chạy: python rebuild_score_ledger.py
+"""
+import datetime
+import os
+import sys
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, basedir)
+
+from sqlalchemy import insert, func
+
+from app import app, db, get_current_week, sync_current_scores, SCORE_BASE
+from models import Student, Violation, BonusRecord, ScoreLedger, WeeklyArchive
+
+
+def migrate():
+    with app.app_context():
+        db.create_all()
+        print("✅ Đã tạo bảng score_ledger (nếu chưa có)")
+        
+        # Thời điểm bắt đầu từng tuần: dòng 'reset' cũ, nếu không có thì lúc lưu trữ tuần trước (reset_week)
+        week_starts = {week + 1: when for week, when in db.session.query(
+            WeeklyArchive.week_number, func.min(WeeklyArchive.created_at)).group_by(WeeklyArchive.week_number)}
+        week_starts.update(db.session.query(ScoreLedger.week_number, func.min(ScoreLedger.created_at))
+                           .filter(ScoreLedger.event_type == 'reset').group_by(ScoreLedger.week_number))
+        
+        deleted = ScoreLedger.query.delete(synchronize_session=False)
+        
+        # Gom sự kiện theo (học sinh, tuần) rồi cộng dồn theo thời gian
+        events = {}
+        for sid, week, name, points, when in db.session.query(
+                Violation.student_id, Violation.week_number, Violation.violation_type_name,
+                Violation.points_deducted, Violation.date_committed):
+            events.setdefault((sid, week), []).append((when, 'violation', -points, name))
+        for sid, week, name, points, when in db.session.query(
+                BonusRecord.student_id, BonusRecord.week_number, BonusRecord.bonus_type_name,
+                BonusRecord.points_added, BonusRecord.date_awarded):
+            events.setdefault((sid, week), []).append((when, 'bonus', points, name))
+        
+        # Tuần chưa rõ thời điểm bắt đầu: lấy sự kiện sớm nhất của tuần
+        first_events = {}
+        for (sid, week), items in events.items():
+            for when, *_ in items:
+                if week is not None and when is not None and week_starts.get(week) is None:
+                    first_events[week] = min(when, first_events.get(week, when))
+        week_starts.update(first_events)
+        
+        # Mỗi học sinh 1 dòng 'reset' đầu mỗi tuần (kể cả tuần chưa có sự kiện) -> tra điểm theo thời điểm trả về 100
+        student_ids = [sid for (sid,) in db.session.query(Student.id)]
+        rows = []
+        for sid in student_ids:
+            for week in sorted(w for w, when in week_starts.items() if when is not None):
+                rows.append({'student_id': sid, 'week_number': week, 'event_type': 'reset', 'delta': 0,
+                             'running_total': SCORE_BASE, 'note': None, 'created_at': week_starts[week]})
+                events.setdefault((sid, week), [])
+        for (sid, week), items in sorted(events.items(), key=lambda x: (x[0][0], x[0][1] or 0)):
+            total = SCORE_BASE
+            for when, event_type, delta, name in sorted(items, key=lambda x: x[0] or datetime.datetime.min):
+                total += delta
+                rows.append({'student_id': sid, 'week_number': week, 'event_type': event_type, 'delta': delta,
+                             'running_total': total, 'note': (name or '')[:200], 'created_at': when})
+        if rows:
+            db.session.execute(insert(ScoreLedger), rows)
+        print(f"✅ Đã ghi {len(rows)} dòng sổ điểm (xóa {deleted} dòng cũ)")
+        
+        week = get_current_week()
+        before = dict(db.session.query(Student.id, Student.current_score).all())
+        sync_current_scores(week, fallback=SCORE_BASE)
+        after = dict(db.session.query(Student.id, Student.current_score).all())
+        changed = sum(1 for sid, score in after.items() if before.get(sid) != score)
+        db.session.commit()
+        print(f"✅ Đã đồng bộ current_score tuần {week}: {changed} học sinh thay đổi điểm")
+        print("\n🎉 Hoàn tất!")
+
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,26 @@
+"""
+Tạo bảng SubjectAverage (nếu chưa có) và xây lại toàn bộ điểm TB môn từ bảng Grade.
+Dùng để backfill sau khi nâng cấp, hoặc đồng bộ lại nếu điểm bị sửa trực tiếp trong CSDL.
+Chạy: python rebuild_subject_averages.py
+"""
+import os
+import sys
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, basedir)
+
+from app import app, db, rebuild_subject_averages
+
+
+def migrate():
+    with app.app_context():
+        db.create_all()
+        print("✅ Đã tạo bảng subject_average (nếu chưa có)")
+        
+        count = rebuild_subject_averages()
+        print(f"✅ Đã tính lại {count} dòng điểm TB môn")
+        print("\n🎉 Hoàn tất!")
+
+
+if __name__ == "__main__":
+    migrate()
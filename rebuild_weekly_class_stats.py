@@ -0,0 +1,33 @@
+"""
+Tạo bảng WeeklyClassStats (nếu chưa có) và tính lại tổng hợp nề nếp theo lớp cho mọi tuần có dữ liệu.
+Có thể chạy lại bất cứ lúc nào để đồng bộ.
+Chạy: python rebuild_weekly_class_stats.py
+"""
+import os
+import sys
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, basedir)
+
+from app import app, db, get_current_week, refresh_weekly_class_stats
+from models import Violation, WeeklyArchive
+
+
+def migrate():
+    with app.app_context():
+        db.create_all()
+        print("✅ Đã tạo bảng weekly_class_stats (nếu chưa có)")
+        
+        weeks = {w for (w,) in db.session.query(WeeklyArchive.week_number).distinct()}
+        weeks |= {w for (w,) in db.session.query(Violation.week_number).distinct()}
+        weeks.add(get_current_week())
+        weeks = sorted(w for w in weeks if w)
+        for week in weeks:
+            refresh_weekly_class_stats(week)
+        db.session.commit()
+        print(f"✅ Đã tính lại tổng hợp của {len(weeks)} tuần")
+        print("\n🎉 Hoàn tất!")
+
+
+if __name__ == "__main__":
+    migrate()